@@ -0,0 +1,127 @@
+"""Сравнение маршрутизации кнопок: цепочка фильтров F.data против словаря.
+
+Запуск:
+    python bench_callbacks.py --presses 2000 --extra 0 100 500
+
+Старая схема - обработчик на каждую кнопку с фильтром F.data == ... или
+F.data.startswith(...); aiogram проверяет их по порядку (HandlerObject.check),
+затем обработчик разбирает callback_data через replace. Новая - один
+route_callback: parse_callback() и поиск (префикс, действие) в CALLBACK_ROUTES.
+--extra добавляет фиктивные кнопки в обе схемы, чтобы увидеть рост стоимости.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("DB_NAME", os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+from aiogram import F, types
+from aiogram.dispatcher.event.handler import FilterObject, HandlerObject
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pido  # noqa: E402
+
+# Фильтры в порядке регистрации до маршрутизатора
+LEGACY_FILTERS = [
+    F.data == "main_menu", F.data == "buy_stars", F.data == "buy_premium",
+    F.data.startswith("premium_"), F.data == "exchange", F.data == "info",
+    F.data.startswith("card_pay_"), F.data.startswith("crypto_pay_"),
+    F.data.startswith("check_crypto_"), F.data.startswith("confirm_paid_"),
+    F.data.startswith("cancel_photo_"), F.data.startswith("order_confirm_"),
+    F.data.startswith("order_reject_"), F.data.startswith("order_complete_"),
+    F.data.startswith("order_finish_"), F.data.startswith("order_cancel_"),
+    F.data.startswith("order_msg_"), F.data.startswith("order_refresh_"),
+    F.data.startswith("crypto_status_"), F.data == "admin_orders",
+    F.data.startswith("orders_"), F.data == "admin_stats", F.data == "admin_pending",
+    F.data == "admin_completed", F.data == "admin_back",
+]
+
+# Нажатия: частые кнопки покупателя и админские из конца цепочки
+PRESSES = [
+    ("main_menu", pido.CB_MAIN_MENU),
+    ("card_pay_1042", pido.PayCB(action="card", id=1042).pack()),
+    ("confirm_paid_1042", pido.PayCB(action="paid", id=1042).pack()),
+    ("order_complete_1042", pido.OrderCB(action="complete", id=1042).pack()),
+    ("orders_pending_n900", pido.OrdersCB(action="pending", before=900).pack()),
+    ("admin_back", pido.CB_ADMIN_BACK),
+]
+
+
+async def noop(*args, **kwargs):
+    pass
+
+
+def make_callback(data):
+    return types.CallbackQuery(
+        id="1",
+        from_user=types.User(id=1, is_bot=False, first_name="bench"),
+        chat_instance="bench",
+        data=data,
+    )
+
+
+def legacy_handlers(extra):
+    # Фиктивные кнопки регистрировались бы раньше админских разделов
+    filters = LEGACY_FILTERS[:19] + [F.data.startswith(f"extra{i}_") for i in range(extra)] + LEGACY_FILTERS[19:]
+    return [HandlerObject(callback=noop, filters=[FilterObject(callback=f)]) for f in filters]
+
+
+async def legacy_dispatch(handlers, callback):
+    for handler in handlers:
+        matched, _ = await handler.check(callback)
+        if matched:
+            # Разбор в обработчике, как было: int(callback.data.replace(...))
+            tail = callback.data.rpartition("_")[2]
+            if tail.isdigit():
+                int(tail)
+            return handler
+    return None
+
+
+async def router_dispatch(callback):
+    cb = pido.parse_callback(callback.data)
+    return pido.CALLBACK_ROUTES.get((cb.__prefix__, cb.action)) if cb is not None else None
+
+
+async def measure(dispatch, callbacks, presses):
+    start = time.perf_counter()
+    for i in range(presses):
+        if await dispatch(callbacks[i % len(callbacks)]) is None:
+            raise RuntimeError(f"Кнопка не найдена: {callbacks[i % len(callbacks)].data}")
+    return (time.perf_counter() - start) / presses * 1e6
+
+
+async def run(presses, extras):
+    legacy_callbacks = [make_callback(old) for old, _ in PRESSES]
+    new_callbacks = [make_callback(new) for _, new in PRESSES]
+
+    print(f"{'кнопок':>8} {'фильтры, мкс':>14} {'словарь, мкс':>14} {'старый формат, мкс':>20}")
+    for extra in extras:
+        handlers = legacy_handlers(extra)
+        for i in range(extra):
+            pido.CALLBACK_ROUTES[("x", f"extra{i}")] = (noop, False)
+        try:
+            legacy = await measure(lambda c: legacy_dispatch(handlers, c), legacy_callbacks, presses)
+            routed = await measure(router_dispatch, new_callbacks, presses)
+            translated = await measure(router_dispatch, legacy_callbacks, presses)
+        finally:
+            for i in range(extra):
+                pido.CALLBACK_ROUTES.pop(("x", f"extra{i}"), None)
+        print(f"{len(handlers):>8} {legacy:>14.1f} {routed:>14.1f} {translated:>20.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк маршрутизации кнопок")
+    parser.add_argument("--presses", type=int, default=2000, help="нажатий на замер")
+    parser.add_argument("--extra", type=int, nargs="*", default=[0, 100, 500],
+                        help="сколько фиктивных кнопок добавить")
+    args = parser.parse_args()
+    asyncio.run(run(args.presses, args.extra))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""Микробенчмарк методов Database на реалистичных объемах.
+
+Запуск:
+    python bench_db.py                          # 10k, 100k, 1M заказов, сравнить с базовой линией
+    python bench_db.py --sizes 10000 100000     # только часть объемов
+    python bench_db.py --save                   # записать результаты как базовую линию
+    python bench_db.py --data-dir /tmp/benchdb  # переиспользовать заполненные базы между запусками
+
+Для каждого объема заполняется временная база (пользователей - пятая часть
+от заказов, смесь статусов и details как в продакшене), затем замеряются
+методы Database и печатаются планы их запросов (EXPLAIN QUERY PLAN).
+
+Базовая линия - bench_db_baseline.json рядом со скриптом (лежит в репозитории).
+Если метод стал медленнее базовой линии больше чем на --tolerance (и больше
+чем на шум --noise-ms), изменился план запроса или базовой линии нет -
+скрипт завершается с кодом 1. Время зависит от машины: на другой машине
+перезапишите базовую линию (--save) до изменений и сравнивайте после.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("DB_NAME", os.path.join(tempfile.mkdtemp(), "bench.db"))
+os.environ["METRICS_PORT"] = "0"
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pido  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_db_baseline.json")
+FILL_CHUNK = 50_000
+
+# Смесь статусов: большинство заказов завершены, активных - несколько процентов
+STATUS_MIX = [
+    ("completed", 0.80),
+    ("cancelled", 0.12),
+    ("pending", 0.03),
+    ("waiting_payment", 0.02),
+    ("waiting_confirmation", 0.015),
+    ("waiting_crypto", 0.01),
+    ("confirmed", 0.005),
+]
+TYPE_MIX = [("stars", 0.6), ("premium", 0.25), ("exchange", 0.15)]
+
+
+def pick(mix, rng):
+    value = rng.random()
+    for name, share in mix:
+        value -= share
+        if value < 0:
+            return name
+    return mix[-1][0]
+
+
+def synthetic_order(rng, user_count, created_at):
+    order_type = pick(TYPE_MIX, rng)
+    status = pick(STATUS_MIX, rng)
+    if order_type == "stars":
+        details = {"stars": rng.randint(50, 10_000)}
+        amount_rub = details["stars"] * pido.STAR_RATE
+        recipient = f"user{rng.randrange(user_count)}"
+    elif order_type == "premium":
+        period = rng.choice(list(pido.PREMIUM_PRICES))
+        details = {"period": period}
+        amount_rub = pido.PREMIUM_PRICES[period]["rub"]
+        recipient = f"user{rng.randrange(user_count)}"
+    else:
+        amount_rub = float(rng.randint(100, 50_000))
+        details = {"amount_usd": round(amount_rub / pido.USD_RATE, 2), "exchange_rate": pido.USD_RATE}
+        recipient = ""
+
+    payment_method = "crypto" if status == "waiting_crypto" or rng.random() < 0.2 else "card"
+    invoice_id = str(rng.randrange(10**9)) if payment_method == "crypto" else None
+    if payment_method == "card" and status in ("waiting_confirmation", "confirmed", "completed"):
+        details["payment_photo"] = f"AgACAgIAAxkBAAI{rng.randrange(10**12):012d}"
+
+    return (
+        rng.randrange(1, user_count + 1), order_type, recipient, json.dumps(details), amount_rub,
+        payment_method, status, invoice_id, created_at.strftime("%Y-%m-%d %H:%M:%S"),
+        *(details.get(name) for name in pido.ORDER_DETAIL_FIELDS)
+    )
+
+
+def fill(db, orders, seed=1):
+    """Наполнить пустую базу: orders заказов, orders // 5 пользователей, счетчики"""
+    rng = random.Random(seed)
+    user_count = max(orders // 5, 1)
+    conn = db.conn
+
+    conn.executemany(
+        "INSERT INTO users (user_id, username, full_name) VALUES (?, ?, ?)",
+        ((user_id, f"user{user_id}", f"User {user_id}") for user_id in range(1, user_count + 1))
+    )
+    conn.commit()
+
+    # Заказы равномерно за последний год, id растет вместе с created_at
+    start = datetime.now() - timedelta(days=365)
+    step = timedelta(days=365) / orders
+    columns = ("user_id", "order_type", "recipient", "details", "amount_rub", "payment_method", "status",
+               "invoice_id", "created_at", *pido.ORDER_DETAIL_FIELDS)
+    sql = f"INSERT INTO orders ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    for first in range(0, orders, FILL_CHUNK):
+        count = min(FILL_CHUNK, orders - first)
+        conn.executemany(sql, (synthetic_order(rng, user_count, start + step * (first + i)) for i in range(count)))
+        conn.commit()
+
+    db.check_counters(fix=True)
+
+
+def remove_database(path):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def open_database(data_dir, orders):
+    """Рабочая копия заполненной базы на orders заказов.
+    Замеры пишут в базу, поэтому шаблон не трогаем - каждый запуск с одинаковых данных"""
+    template = os.path.join(data_dir, f"orders_{orders}.template.db")
+    ready = False
+    if os.path.exists(template):
+        with closing(sqlite3.connect(template)) as conn:
+            ready = conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == orders
+
+    if ready:
+        print(f"  шаблон {template} уже заполнен")
+    else:
+        remove_database(template)
+        db = pido.Database(template)
+        start = time.perf_counter()
+        fill(db, orders)
+        db.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        db.close()
+        print(f"  заполнено {orders} заказов за {time.perf_counter() - start:.1f} с")
+
+    work = os.path.join(data_dir, f"orders_{orders}.db")
+    remove_database(work)
+    shutil.copyfile(template, work)
+    return pido.Database(work)
+
+
+def query_plans(db, call):
+    """Планы всех запросов, которые выполняет call()"""
+    statements = []
+    connections = [db.conn] + list(db._readers)
+    for conn in connections:
+        conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        for conn in connections:
+            conn.set_trace_callback(None)
+
+    plans = []
+    for sql in statements:
+        verb = sql.lstrip().split(None, 1)[0].upper()
+        if verb not in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+            continue
+        try:
+            rows = db.conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+        except sqlite3.Error as e:
+            plans.append(f"{' '.join(sql.split())[:80]}: план недоступен ({e})")
+            continue
+        plans.extend(row[-1] for row in rows)
+    return plans
+
+
+def measure(call, min_runs, max_runs, budget):
+    """Время вызовов в мс: не меньше min_runs, не больше max_runs или budget секунд"""
+    times = []
+    deadline = time.perf_counter() + budget
+    while len(times) < max_runs and (len(times) < min_runs or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        call()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        "median_ms": times[len(times) // 2],
+        "p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))],
+        "runs": len(times)
+    }
+
+
+def benchmark(db, orders, budget):
+    rng = random.Random(2)
+    max_id = db.conn.execute("SELECT MAX(id) FROM orders").fetchone()[0]
+    active_ids = [row[0] for row in db.conn.execute(
+        "SELECT id FROM orders WHERE status NOT IN ('completed', 'cancelled') LIMIT 1000"
+    )]
+    statuses = iter(lambda: rng.choice(("pending", "waiting_payment")), None)
+
+    # (метод, вызов, min_runs, max_runs). Чтение - до записей, чтобы новые заказы не искажали выборки
+    cases = [
+        ("get_order", lambda: db.get_order(rng.randint(1, max_id)), 100, 5000),
+        ("get_pending_orders", db.get_pending_orders, 5, 200),
+        ("get_all_active_orders", db.get_all_active_orders, 5, 200),
+        ("get_completed_orders", db.get_completed_orders, 5, 500),
+        ("get_statistics", db.get_statistics, 100, 5000),
+        ("update_order_status", lambda: db.update_order_status(rng.choice(active_ids), next(statuses)), 50, 1000),
+        ("add_order", lambda: db.add_order(
+            rng.randint(1, orders // 5), "stars", "bench", {"stars": 100}, 150.0, "card"), 50, 500),
+    ]
+
+    results = {}
+    for name, call, min_runs, max_runs in cases:
+        call()  # прогрев: читатели пула, кэш страниц
+        result = measure(call, min_runs, max_runs, budget)
+        result["plan"] = query_plans(db, call)
+        results[name] = result
+        print(f"  {name:<24} медиана {result['median_ms']:>9.3f} мс  p95 {result['p95_ms']:>9.3f} мс  "
+              f"({result['runs']} вызовов)")
+        for line in result["plan"]:
+            print(f"      {line}")
+    return results
+
+
+def compare(results, baseline, tolerance, noise_ms):
+    """Список регрессий относительно базовой линии"""
+    regressions = []
+    for size, methods in results.items():
+        for name, result in methods.items():
+            base = baseline.get(size, {}).get(name)
+            if base is None:
+                continue
+            limit = base["median_ms"] * (1 + tolerance)
+            if result["median_ms"] > limit and result["median_ms"] - base["median_ms"] > noise_ms:
+                regressions.append(
+                    f"{size} заказов, {name}: медиана {result['median_ms']:.3f} мс, "
+                    f"базовая {base['median_ms']:.3f} мс (+{result['median_ms'] / base['median_ms'] - 1:.0%})"
+                )
+            if result["plan"] != base["plan"]:
+                regressions.append(
+                    f"{size} заказов, {name}: изменился план запроса\n"
+                    f"      было:  {' | '.join(base['plan'])}\n"
+                    f"      стало: {' | '.join(result['plan'])}"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарк методов Database")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="сколько заказов в базе")
+    parser.add_argument("--data-dir", default=None, help="каталог для баз (по умолчанию - временный)")
+    parser.add_argument("--budget", type=float, default=2.0, help="секунд на замер одного метода")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="файл базовой линии")
+    parser.add_argument("--save", action="store_true", help="записать результаты как базовую линию")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="допустимое замедление (0.5 = +50%%)")
+    parser.add_argument("--noise-ms", type=float, default=0.05, help="разница меньше этой - шум")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="bench_db_")
+    os.makedirs(data_dir, exist_ok=True)
+
+    results = {}
+    for size in args.sizes:
+        print(f"=== {size} заказов")
+        db = open_database(data_dir, size)
+        try:
+            results[str(size)] = benchmark(db, size, args.budget)
+        finally:
+            db.close()
+
+    if args.save:
+        baseline = {"sizes": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline["sizes"].update(results)
+        baseline["machine"] = {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "saved_at": datetime.now().isoformat(timespec="seconds")
+        }
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, ensure_ascii=False)
+        print(f"✅ Базовая линия записана: {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        # Без базовой линии сравнивать не с чем - это ошибка, а не молчаливый успех
+        print(f"❌ Базовой линии нет ({args.baseline}) - запишите её: python bench_db.py --save")
+        sys.exit(1)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline["sizes"], args.tolerance, args.noise_ms)
+    if regressions:
+        print("❌ РЕГРЕССИИ относительно базовой линии:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print("✅ Регрессий нет")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""Нагрузочный прогон бота без Telegram: настоящий dp, заглушка Bot API.
+
+Запуск:
+    python bench_load.py --users 500 --concurrency 50 --api-latency 30
+
+Каждый синтетический пользователь проходит покупку звезд целиком:
+/start -> Купить звезды -> получатель -> количество -> Перевод на карту ->
+Я оплатил -> фото, затем админ делает /check и помечает заказ выполненным.
+Апдейты идут через dp.feed_update, запросы к Bot API попадают в StubSession
+(с задержкой --api-latency ± --api-jitter мс) и записываются.
+
+Лимиты Telegram (TG_*_RATE) по умолчанию сняты, чтобы мерить сам бот;
+--real-limits оставляет их как в продакшене. База - временный файл.
+
+Число вызовов Bot API каждого метода сверяется с EXPECTED_CALLS на покупку:
+если шаг молча ответил ошибкой, прогон завершается с кодом 1.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Union, get_args, get_origin
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота с заглушкой Bot API")
+    parser.add_argument("--users", type=int, default=200, help="сколько покупок провести")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных пользователей")
+    parser.add_argument("--api-latency", type=float, default=30.0, help="задержка Bot API, мс")
+    parser.add_argument("--api-jitter", type=float, default=10.0, help="разброс задержки, мс")
+    parser.add_argument("--real-limits", action="store_true", help="оставить лимиты отправки Telegram")
+    parser.add_argument("--db", default=None, help="файл базы (по умолчанию - временный)")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+# Окружение - до импорта бота: конфигурация читается при импорте
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+os.environ["DB_NAME"] = args.db or os.path.join(tempfile.mkdtemp(), "load.db")
+os.environ["CRYPTOBOT_TOKEN"] = ""
+os.environ["METRICS_PORT"] = "0"
+if not args.real_limits:
+    for name in ("TG_GLOBAL_RATE", "TG_CHAT_RATE", "TG_GROUP_RATE"):
+        os.environ[name] = "1000000"
+    os.environ["TG_CHAT_BURST"] = "1000000"
+
+from aiogram import types  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pido  # noqa: E402
+
+# Вызовов Bot API на одну покупку (при одном админе в ADMIN_IDS). Расхождение значит,
+# что какой-то шаг молча ответил ошибкой вместо дела - такой прогон не считается
+EXPECTED_CALLS = {
+    "sendMessage": 8,
+    "answerCallbackQuery": 4,
+    "editMessageText": 3,
+    "sendPhoto": 2,  # фото админу при получении + фото в карточке /check
+    "deleteMessage": 1,
+}
+STEPS = ["start", "buy_stars", "recipient", "amount", "card_pay", "confirm_paid", "photo", "admin_check", "order_finish"]
+USER_BASE_ID = 10_000_000
+
+
+class StubSession(BaseSession):
+    """Сессия Bot API без сети: задержка, запись вызовов, правдоподобные ответы"""
+
+    def __init__(self, latency, jitter):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = Counter()  # метод -> вызовов
+        self.last_markup = {}  # chat_id -> последняя inline клавиатура
+        self.message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        chat_id = getattr(method, "chat_id", None)
+        self.calls[method.__api_method__] += 1
+        markup = getattr(method, "reply_markup", None)
+        if isinstance(markup, types.InlineKeyboardMarkup):
+            self.last_markup[chat_id] = markup
+        return self.fake_result(method, chat_id)
+
+    def fake_result(self, method, chat_id):
+        returning = method.__returning__
+        if returning is types.Message or (get_origin(returning) is Union and types.Message in get_args(returning)):
+            return types.Message(
+                message_id=next(self.message_ids),
+                date=datetime.now(),
+                chat=types.Chat(id=chat_id or 0, type="private")
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class LoadTest:
+    def __init__(self, session):
+        self.session = session
+        self.update_ids = itertools.count(1)
+        self.timings = defaultdict(list)  # шаг -> секунды
+        self.errors = Counter()
+        self.admin = types.User(id=pido.ADMIN_IDS[0], is_bot=False, first_name="admin")
+
+    def message(self, user, text=None, photo=None):
+        return types.Update(update_id=next(self.update_ids), message=types.Message(
+            message_id=next(self.session.message_ids),
+            date=datetime.now(),
+            chat=types.Chat(id=user.id, type="private"),
+            from_user=user,
+            text=text,
+            photo=photo
+        ))
+
+    def callback(self, user, data):
+        return types.Update(update_id=next(self.update_ids), callback_query=types.CallbackQuery(
+            id=str(next(self.update_ids)),
+            from_user=user,
+            chat_instance=str(user.id),
+            data=data,
+            message=types.Message(
+                message_id=next(self.session.message_ids),
+                date=datetime.now(),
+                chat=types.Chat(id=user.id, type="private")
+            )
+        ))
+
+    async def step(self, name, update):
+        start = time.perf_counter()
+        try:
+            await pido.dp.feed_update(pido.bot, update)
+        except Exception:
+            self.errors[name] += 1
+            raise
+        finally:
+            self.timings[name].append(time.perf_counter() - start)
+
+    def order_id_from_keyboard(self, user_id):
+        markup = self.session.last_markup.get(user_id)
+        for row in markup.inline_keyboard if markup else []:
+            for button in row:
+                cb = pido.parse_callback(button.callback_data)
+                if isinstance(cb, pido.PayCB) and cb.action == "card":
+                    return cb.id
+        raise RuntimeError(f"Пользователь {user_id}: нет кнопки оплаты после ввода количества")
+
+    async def purchase(self, index):
+        user = types.User(id=USER_BASE_ID + index, is_bot=False, first_name=f"load{index}", username=f"load{index}")
+        photo = [types.PhotoSize(file_id=f"photo{index}", file_unique_id=f"u{index}", width=800, height=600)]
+
+        await self.step("start", self.message(user, "/start"))
+        await self.step("buy_stars", self.callback(user, pido.CB_BUY_STARS))
+        await self.step("recipient", self.message(user, f"@recipient{index}"))
+        await self.step("amount", self.message(user, str(random.randint(50, 5000))))
+        order_id = self.order_id_from_keyboard(user.id)
+        await self.step("card_pay", self.callback(user, pido.PayCB(action="card", id=order_id).pack()))
+        await self.step("confirm_paid", self.callback(user, pido.PayCB(action="paid", id=order_id).pack()))
+        await self.step("photo", self.message(user, photo=photo))
+        await self.step("admin_check", self.message(self.admin, f"/check {order_id}"))
+        await self.step("order_finish", self.callback(self.admin, pido.OrderCB(action="finish", id=order_id).pack()))
+
+    async def run(self, users, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        failed = 0
+
+        async def one(index):
+            nonlocal failed
+            async with semaphore:
+                try:
+                    await self.purchase(index)
+                except Exception as e:
+                    failed += 1
+                    if failed <= 5:
+                        print(f"❌ Покупка {index}: {type(e).__name__}: {e}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(users)))
+        await pido.admin_notifier.drain()
+        return time.perf_counter() - start, users - failed
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def main():
+    session = StubSession(args.api_latency / 1000, args.api_jitter / 1000)
+    session.middleware = pido.bot.session.middleware  # очередь отправки и метрики остаются
+    pido.bot.session = session
+
+    test = LoadTest(session)
+    try:
+        elapsed, completed = await test.run(args.users, args.concurrency)
+    finally:
+        await pido.db.close()
+
+    updates = sum(len(values) for values in test.timings.values())
+    api_calls = sum(session.calls.values())
+    print("=" * 60)
+    print(f"Покупок: {completed}/{args.users} за {elapsed:.2f} с, одновременно {args.concurrency}")
+    print(f"Пропускная способность: {completed / elapsed:.1f} покупок/с, {updates / elapsed:.1f} апдейтов/с")
+    print(f"Bot API: {api_calls} вызовов, {api_calls / max(completed, 1):.1f} на заказ "
+          f"(задержка {args.api_latency:.0f}±{args.api_jitter:.0f} мс, "
+          f"лимиты {'как в Telegram' if args.real_limits else 'сняты'})")
+    print("=" * 60)
+    print(f"{'шаг':<14} {'p50, мс':>9} {'p99, мс':>9} {'ошибок':>7}")
+    for name in STEPS:
+        values = test.timings.get(name, [])
+        print(f"{name:<14} {percentile(values, 0.5) * 1000:>9.1f} {percentile(values, 0.99) * 1000:>9.1f} "
+              f"{test.errors[name]:>7}")
+    print("=" * 60)
+    print("Вызовы по методам:")
+    for method, count in session.calls.most_common():
+        print(f"  {method:<22} {count:>7} ({count / max(completed, 1):.2f} на заказ)")
+    
+    mismatches = [
+        f"{method}: {session.calls[method]}, ожидалось {per_order * args.users} ({per_order} на заказ)"
+        for method, per_order in sorted({**dict.fromkeys(session.calls, 0), **EXPECTED_CALLS}.items())
+        if session.calls[method] != per_order * args.users
+    ]
+    if completed != args.users or mismatches:
+        print("❌ Прогон не прошел: покупки провалились или шаги отработали не так")
+        for line in mismatches:
+            print(f"  {line}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,187 @@
+"""Локальная заглушка Crypto Pay API для офлайн тестов.
+
+Запуск:
+    python fake_cryptopay.py --port 8081 --token TEST \\
+        --webhook http://127.0.0.1:8080/cryptopay/webhook
+
+Бот направляется на заглушку переменными окружения:
+    CRYPTOBOT_TOKEN=TEST
+    CRYPTOBOT_API_URL=http://127.0.0.1:8081/api
+    CRYPTO_WEBHOOK_PORT=8080
+
+Управление счетами (имитация действий покупателя):
+    POST /fake/pay/{invoice_id}     - оплатить счет и отправить вебхук invoice_paid
+    POST /fake/expire/{invoice_id}  - просрочить счет
+    POST /fake/rate/{rub}           - сменить курс USDT/RUB в getExchangeRates
+    GET  /fake/invoices             - все счета
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger("fake_cryptopay")
+
+
+def sign_body(token, body):
+    """Подпись вебхука так же, как это делает Crypto Pay"""
+    secret = hashlib.sha256(token.encode()).digest()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakeCryptoPay:
+    def __init__(self, token, webhook_url=None, usdt_rub=85.0):
+        self.token = token
+        self.webhook_url = webhook_url
+        self.usdt_rub = usdt_rub
+        self.invoices = {}
+        self.next_invoice_id = 1
+        self.next_update_id = 1
+        self.calls = {}
+
+    def build_app(self):
+        app = web.Application(middlewares=[self.auth_middleware])
+        app.router.add_post("/api/createInvoice", self.create_invoice)
+        app.router.add_get("/api/getInvoices", self.get_invoices)
+        app.router.add_get("/api/getExchangeRates", self.get_exchange_rates)
+        app.router.add_post("/fake/pay/{invoice_id}", self.pay)
+        app.router.add_post("/fake/expire/{invoice_id}", self.expire)
+        app.router.add_post("/fake/rate/{rub}", self.set_rate)
+        app.router.add_get("/fake/invoices", self.list_invoices)
+        return app
+
+    @web.middleware
+    async def auth_middleware(self, request, handler):
+        if request.path.startswith("/api/"):
+            method = request.path.rsplit("/", 1)[-1]
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if request.headers.get("Crypto-Pay-API-Token") != self.token:
+                return self.error(401, "UNAUTHORIZED")
+        return await handler(request)
+
+    @staticmethod
+    def ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def error(code, name):
+        return web.json_response({"ok": False, "error": {"code": code, "name": name}}, status=code)
+
+    async def create_invoice(self, request):
+        data = await request.json()
+        invoice_id = self.next_invoice_id
+        self.next_invoice_id += 1
+
+        invoice = {
+            "invoice_id": invoice_id,
+            "hash": f"IV{invoice_id:08d}",
+            "currency_type": "crypto",
+            "asset": data.get("asset", "USDT"),
+            "amount": data["amount"],
+            "pay_url": f"https://t.me/CryptoBot?start=IV{invoice_id:08d}",
+            "bot_invoice_url": f"https://t.me/CryptoBot?start=IV{invoice_id:08d}",
+            "description": data.get("description", ""),
+            "status": "active",
+            "created_at": now_iso(),
+            "allow_comments": True,
+            "allow_anonymous": data.get("allow_anonymous", True),
+            "payload": data.get("payload", ""),
+        }
+        self.invoices[invoice_id] = invoice
+        return self.ok(invoice)
+
+    async def get_invoices(self, request):
+        ids = request.query.get("invoice_ids")
+        if ids:
+            items = [self.invoices[int(i)] for i in ids.split(",") if int(i) in self.invoices]
+        else:
+            items = list(self.invoices.values())
+        count = int(request.query.get("count", "100"))
+        return self.ok({"items": items[:count]})
+
+    async def get_exchange_rates(self, request):
+        rates = [("USDT", "RUB", self.usdt_rub), ("USDT", "USD", 1.0), ("TON", "USD", 5.2)]
+        return self.ok([
+            {"is_valid": True, "is_crypto": True, "is_fiat": False, "source": source, "target": target,
+             "rate": str(rate)}
+            for source, target, rate in rates
+        ])
+
+    async def pay(self, request):
+        invoice = self.invoices.get(int(request.match_info["invoice_id"]))
+        if not invoice:
+            return self.error(404, "INVOICE_NOT_FOUND")
+
+        invoice["status"] = "paid"
+        invoice.setdefault("paid_at", now_iso())
+        delivered = await self.send_webhook(invoice)
+        return self.ok({"invoice": invoice, "webhook_delivered": delivered})
+
+    async def expire(self, request):
+        invoice = self.invoices.get(int(request.match_info["invoice_id"]))
+        if not invoice:
+            return self.error(404, "INVOICE_NOT_FOUND")
+
+        invoice["status"] = "expired"
+        return self.ok(invoice)
+
+    async def set_rate(self, request):
+        self.usdt_rub = float(request.match_info["rub"])
+        return self.ok({"USDT/RUB": self.usdt_rub})
+
+    async def list_invoices(self, request):
+        return self.ok({"items": list(self.invoices.values()), "calls": self.calls})
+
+    async def send_webhook(self, invoice):
+        """Отправить invoice_paid на вебхук бота (если он задан)"""
+        if not self.webhook_url:
+            return False
+
+        update = {
+            "update_id": self.next_update_id,
+            "update_type": "invoice_paid",
+            "request_date": now_iso(),
+            "payload": invoice,
+        }
+        self.next_update_id += 1
+        body = json.dumps(update).encode()
+        headers = {
+            "Content-Type": "application/json",
+            "crypto-pay-api-signature": sign_body(self.token, body),
+        }
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(self.webhook_url, data=body, headers=headers) as response:
+                    logger.info(f"webhook invoice {invoice['invoice_id']}: HTTP {response.status}")
+                    return response.status == 200
+        except aiohttp.ClientError as e:
+            logger.warning(f"webhook invoice {invoice['invoice_id']}: {e}")
+            return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка Crypto Pay API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--token", default="TEST")
+    parser.add_argument("--webhook", default=None, help="URL вебхука бота")
+    parser.add_argument("--usdt-rub", type=float, default=85.0, help="курс USDT/RUB в getExchangeRates")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    fake = FakeCryptoPay(args.token, args.webhook, args.usdt_rub)
+    web.run_app(fake.build_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,144 @@
 import asyncio
 import logging
 import sqlite3
+import queue
+import threading
+import time
+import atexit
+import bisect
+import multiprocessing
+import signal
 import os
 import json
-import requests
+import hmac
+import hashlib
+import heapq
+import itertools
+import random
+import contextvars
+import inspect
+import aiohttp
+from aiohttp import web
 from datetime import datetime
-from aiogram import Bot, Dispatcher, types, F
+from typing import Optional
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
 from aiogram.filters import Command, CommandStart, CommandObject
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramForbiddenError
+)
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # ========== КОНФИГУРАЦИЯ ==========
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 ADMIN_IDS = [6997318168]  # ⬅️ ВАШ ID ОТКРЫТО
 CRYPTOBOT_TOKEN = os.environ.get("CRYPTOBOT_TOKEN", "")
+CRYPTOBOT_API_URL = os.environ.get("CRYPTOBOT_API_URL", "https://pay.crypt.bot/api")  # для тестов - fake_cryptopay.py
+CRYPTOBOT_TIMEOUT = float(os.environ.get("CRYPTOBOT_TIMEOUT", "3"))  # секунд на одну попытку - заметно меньше CRYPTOBOT_DEADLINE
+CRYPTOBOT_DEADLINE = float(os.environ.get("CRYPTOBOT_DEADLINE", "8"))  # секунд на весь вызов вместе с повторами
+CRYPTOBOT_RETRIES = int(os.environ.get("CRYPTOBOT_RETRIES", "2"))  # повторов после сетевой ошибки
+CRYPTOBOT_RETRY_BASE = 0.3  # секунд, пауза перед повтором: случайная до base * 2^попытка
+CRYPTOBOT_MAX_INFLIGHT = int(os.environ.get("CRYPTOBOT_MAX_INFLIGHT", "50"))  # больше одновременных вызовов - отказ сразу
+CRYPTOBOT_BREAKER_FAILURES = int(os.environ.get("CRYPTOBOT_BREAKER_FAILURES", "5"))  # неудач подряд до размыкания
+CRYPTOBOT_BREAKER_COOLDOWN = float(os.environ.get("CRYPTOBOT_BREAKER_COOLDOWN", "30"))  # секунд до пробного вызова
+CRYPTOBOT_POOL_SIZE = int(os.environ.get("CRYPTOBOT_POOL_SIZE", "20"))  # соединений в пуле
+CRYPTOBOT_BATCH_SIZE = 1000  # максимум invoice_ids в одном getInvoices
+CRYPTO_POLL_MIN = float(os.environ.get("CRYPTO_POLL_MIN", "5"))  # секунд, пока есть неоплаченные счета
+CRYPTO_POLL_MAX = float(os.environ.get("CRYPTO_POLL_MAX", "60"))  # секунд, когда ждать нечего
+CRYPTO_STRAY_WINDOW = int(os.environ.get("CRYPTO_STRAY_WINDOW", str(24 * 3600)))  # секунд: счета заказов, ушедших из waiting_crypto, поллер проверяет столько после создания
+CRYPTO_STATUS_TTL = float(os.environ.get("CRYPTO_STATUS_TTL", "3"))  # секунд кэша статуса неоплаченного счета
+CRYPTO_FINAL_TTL = 3600  # paid/expired уже не меняются - держим дольше
+CRYPTO_STATUS_CACHE_SIZE = 10000  # счетов в кэше статусов
+
+# Режим получения обновлений Telegram: polling, webhook или cluster (webhook + WORKERS процессов)
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # публичный адрес (https://example.com), пусто - не трогать setWebhook
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")  # X-Telegram-Bot-Api-Secret-Token, обязателен для webhook/cluster
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+
+# Кластер: фронт на WEBHOOK_PORT раздает апдейты воркерам по user_id
+WORKERS = int(os.environ.get("WORKERS", str(os.cpu_count() or 1)))
+WORKER_BASE_PORT = int(os.environ.get("WORKER_BASE_PORT", "8100"))  # воркер i слушает 127.0.0.1:WORKER_BASE_PORT+i
+WORKER_HEALTH_INTERVAL = float(os.environ.get("WORKER_HEALTH_INTERVAL", "5"))  # секунд между проверками
+WORKER_START_TIMEOUT = float(os.environ.get("WORKER_START_TIMEOUT", "30"))  # секунд на запуск воркера
+
+# Вебхук CryptoBot (invoice_paid). Пустой порт - вебхук выключен
+CRYPTO_WEBHOOK_HOST = os.environ.get("CRYPTO_WEBHOOK_HOST", "0.0.0.0")
+CRYPTO_WEBHOOK_PORT = int(os.environ.get("CRYPTO_WEBHOOK_PORT", "0") or 0)
+CRYPTO_WEBHOOK_PATH = os.environ.get("CRYPTO_WEBHOOK_PATH", "/cryptopay/webhook")
+
+# База данных
+DB_NAME = os.environ.get("DB_NAME", "digistore.db")
+DB_READERS = int(os.environ.get("DB_READERS", "4"))  # потоков для чтения
+DB_COMMIT_WINDOW = float(os.environ.get("DB_COMMIT_WINDOW", "0.005"))  # секунд на сбор записей в один commit
+DB_COMMIT_BATCH = int(os.environ.get("DB_COMMIT_BATCH", "256"))  # максимум записей в одном commit
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")  # OFF / NORMAL / FULL (в WAL NORMAL безопасен)
+DB_CACHE_SIZE = int(os.environ.get("DB_CACHE_SIZE", "-20000"))  # страниц, отрицательное - в KiB
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(256 * 1024 * 1024)))  # байт
+DB_BUSY_TIMEOUT = int(os.environ.get("DB_BUSY_TIMEOUT", "5000"))  # мс ожидания блокировки
+
+ORDERS_PAGE_SIZE = 10  # заказов на странице админки
+ORDER_CACHE_SIZE = int(os.environ.get("ORDER_CACHE_SIZE", "5000"))  # заказов в памяти
+# В кластере заказ могут изменить другие процессы - держим в кэше недолго
+ORDER_CACHE_TTL = float(os.environ.get("ORDER_CACHE_TTL", "2" if BOT_MODE == "cluster" else "300"))  # секунд
+
+# Состояния пользователей (FSM)
+FSM_CACHE_SIZE = int(os.environ.get("FSM_CACHE_SIZE", "10000"))  # записей в памяти
+FSM_TTL = int(os.environ.get("FSM_TTL", str(24 * 3600)))  # секунд, после - брошенный сценарий удаляется
+# В кластере при отказе воркера его пользователей обслуживает другой - состояние из
+# памяти вернувшегося воркера устарело, поэтому там каждый раз читаем из базы
+FSM_CACHE_TTL = float(os.environ.get("FSM_CACHE_TTL", "0" if BOT_MODE == "cluster" else str(FSM_TTL)))  # секунд
+
+# Кэш клавиатур заказов
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "1024"))  # клавиатур в памяти
+
+# Исходящие сообщения (лимиты Telegram)
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "30"))  # сообщений в секунду на бота
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", "1"))  # сообщений в секунду в личный чат
+TG_CHAT_BURST = int(os.environ.get("TG_CHAT_BURST", "3"))  # короткий всплеск в личный чат
+TG_GROUP_RATE = float(os.environ.get("TG_GROUP_RATE", str(20 / 60)))  # сообщений в секунду в группу
+TG_MAX_RETRIES = int(os.environ.get("TG_MAX_RETRIES", "5"))  # повторов при сетевых ошибках/флуде
+TG_RETRY_BACKOFF = float(os.environ.get("TG_RETRY_BACKOFF", "0.5"))  # секунд, удваивается с каждым повтором
+TG_RETRY_BACKOFF_MAX = 30.0
+
+# Рассылка
+BROADCAST_CHUNK = int(os.environ.get("BROADCAST_CHUNK", "200"))  # получателей за шаг (прогресс сохраняется после шага)
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "50"))  # одновременных отправок
+BROADCAST_REPORT_INTERVAL = 5  # секунд между обновлениями прогресса
+BROADCAST_STALE = 60  # секунд без отметки - рассылку можно подхватить после падения
+BROADCAST_HEARTBEAT = 15  # секунд между отметками ведущего процесса, независимо от длины пачки
+
+# Уведомления админам
+ADMIN_NOTIFY_CONCURRENCY = int(os.environ.get("ADMIN_NOTIFY_CONCURRENCY", "10"))  # одновременных отправок
+
+# Метрики (GET /metrics в формате Prometheus). Порт 0 - выключено (по умолчанию).
+# В кластере воркер i слушает METRICS_PORT + 1 + i
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0") or 0)
+
+# Курсы: static - значения из настроек ниже, file - JSON файл RATES_FILE,
+# cryptopay - USDT/RUB из getExchangeRates (звезды - из настроек)
+RATES_SOURCE = os.environ.get("RATES_SOURCE", "static")
+RATES_FILE = os.environ.get("RATES_FILE", "rates.json")
+RATES_TTL = float(os.environ.get("RATES_TTL", "300"))  # секунд между обновлениями
+RATES_TIMEOUT = float(os.environ.get("RATES_TIMEOUT", "5"))  # секунд на запрос к источнику
+RATES_RETRY = 30  # секунд до повтора, если источник недоступен
+RATES_USD_MARKUP = float(os.environ.get("RATES_USD_MARKUP", "0"))  # наценка к курсу Crypto Pay (0.03 = +3%)
 
 # Настройки
 CARD_NUMBER = "2200700527205453"
-STAR_RATE = 1.5  # 1 звезда = 1.5 RUB
-USD_RATE = 85.0  # 1 USD = 85 RUB
+STAR_RATE = 1.5  # 1 звезда = 1.5 RUB (до первого обновления курсов)
+USD_RATE = 85.0  # 1 USD = 85 RUB (он же курс USDT для счетов CryptoBot)
 
 PREMIUM_PRICES = {
     "3m": {"rub": 1124.11, "name": "3 месяца"},
@@ -29,21 +150,320 @@ REPUTATION_CHANNEL = "https://t.me/+3pbAABRgo1ljOTJi"
 NEWS_CHANNEL = "https://t.me/NewsDigistars"
 SUPPORT_USER = "swordSar"
 
+# ========== МЕТРИКИ ==========
+# Верхние границы бакетов гистограмм задержек, секунд
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Семейство -> (имя метрики, имя метки, описание)
+METRIC_FAMILIES = {
+    "update": ("pido_update_seconds", "type", "Обработка апдейта целиком"),
+    "update_lag": ("pido_update_lag_seconds", "type", "Задержка от отправки сообщения до начала обработки"),
+    "handler": ("pido_handler_seconds", "handler", "Время обработчика"),
+    "db": ("pido_db_seconds", "method", "Вызов метода базы с ожиданием очереди"),
+    "external": ("pido_external_seconds", "call", "Запрос к внешнему API")
+}
+
+class Histogram:
+    """Накопительные бакеты как в Prometheus + число ошибок"""
+    __slots__ = ("counts", "total", "count", "errors")
+    
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # последний - +Inf
+        self.total = 0.0
+        self.count = 0
+        self.errors = 0
+    
+    def observe(self, seconds, error=False):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        if error:
+            self.errors += 1
+
+class Metrics:
+    """Гистограммы задержек по (семейство, имя) и показатели, которые читаются при выдаче /metrics"""
+    
+    def __init__(self):
+        self.histograms = {}
+        self.gauges = []  # (имя, тип, описание, функция без аргументов)
+    
+    def observe(self, family, name, seconds, error=False):
+        histogram = self.histograms.get((family, name))
+        if histogram is None:
+            histogram = self.histograms[(family, name)] = Histogram()
+        histogram.observe(seconds, error)
+    
+    @contextmanager
+    def timer(self, family, name):
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(family, name, time.perf_counter() - start, error)
+    
+    def timed(self, family, name=None):
+        """Декоратор для корутин: время и ошибки каждого вызова"""
+        def decorate(func):
+            label = name or func.__name__
+            async def wrapper(*args, **kwargs):
+                with self.timer(family, label):
+                    return await func(*args, **kwargs)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return decorate
+    
+    def gauge(self, name, description, read, kind="gauge"):
+        self.gauges.append((name, kind, description, read))
+    
+    @staticmethod
+    def _escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    
+    def render(self):
+        """Текстовый формат Prometheus"""
+        lines = []
+        for family, (metric, label, description) in METRIC_FAMILIES.items():
+            series = sorted((name, h) for (f, name), h in list(self.histograms.items()) if f == family)
+            if not series:
+                continue
+            
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} histogram")
+            for name, histogram in series:
+                labels = f'{label}="{self._escape(name)}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{metric}_sum{{{labels}}} {histogram.total:.6f}")
+                lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+            
+            if family == "update_lag":
+                continue
+            errors = metric.replace("_seconds", "_errors_total")
+            lines.append(f"# TYPE {errors} counter")
+            for name, histogram in series:
+                lines.append(f'{errors}{{{label}="{self._escape(name)}"}} {histogram.errors}')
+        
+        for name, kind, description, read in self.gauges:
+            try:
+                value = read()
+            except Exception as e:
+                logger.warning(f"Метрика {name} не прочитана: {e}")
+                continue
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+        
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class UpdateMetrics(BaseMiddleware):
+    """Внешний middleware апдейтов: время обработки, задержка и число апдейтов в работе"""
+    
+    def __init__(self):
+        self.in_flight = 0
+    
+    async def __call__(self, handler, event, data):
+        kind = event.event_type
+        # У callback_query нет даты - задержку видно только по сообщениям (точность - секунда)
+        message = event.message or event.edited_message
+        if message is not None:
+            metrics.observe("update_lag", kind, max(0.0, time.time() - message.date.timestamp()))
+        
+        self.in_flight += 1
+        try:
+            with metrics.timer("update", kind):
+                return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+
+class HandlerMetrics(BaseMiddleware):
+    """Внутренний middleware: время выбранного обработчика"""
+    
+    async def __call__(self, handler, event, data):
+        with metrics.timer("handler", data["handler"].callback.__name__):
+            return await handler(event, data)
+
+class ApiMetrics(BaseRequestMiddleware):
+    """Время запросов к Bot API (без ожидания в очереди отправки)"""
+    
+    async def __call__(self, make_request, bot, method):
+        with metrics.timer("external", f"telegram.{method.__api_method__}"):
+            return await make_request(bot, method)
+
+async def metrics_handler(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server(port=None):
+    """Поднять HTTP сервер с /metrics"""
+    port = METRICS_PORT if port is None else port
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    
+    logger.info(f"Метрики: http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
 # ========== CRYPTOBOT ==========
+class CircuitBreaker:
+    """Предохранитель: после failures неудач подряд размыкается, и вызовы
+    cooldown секунд отклоняются сразу. Потом пропускает один пробный вызов
+    (полуоткрыт): успех замыкает цепь, неудача - снова размыкает"""
+    
+    def __init__(self, name, failures=CRYPTOBOT_BREAKER_FAILURES, cooldown=CRYPTOBOT_BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.state = "closed"  # closed, open, half_open
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.opens = 0
+        self.rejected = 0
+    
+    @property
+    def available(self):
+        """Стоит ли предлагать сервис пользователю: замкнут или пора пробовать"""
+        return self.state != "open" or time.monotonic() - self.opened_at >= self.cooldown
+    
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+            logger.info(f"{self.name}: пробный вызов после {self.cooldown:.0f} с паузы")
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        return False
+    
+    def success(self):
+        if self.state != "closed":
+            logger.info(f"{self.name}: связь восстановлена")
+        self.state = "closed"
+        self.failures = 0
+        self.probing = False
+    
+    def failure(self):
+        self.failures += 1
+        if self.state == "open" or (self.state == "closed" and self.failures < self.threshold):
+            return
+        logger.warning(f"{self.name}: недоступен ({self.failures} неудач подряд), "
+                       f"вызовы отклоняются {self.cooldown:.0f} с")
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.probing = False
+        self.opens += 1
+    
+    def abandon(self):
+        """Пробный вызов отменен, не дойдя до ответа - пробовать может следующий"""
+        self.probing = False
+    
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "opens": self.opens, "rejected": self.rejected}
+
 class CryptoBotAPI:
-    def __init__(self, token):
+    def __init__(self, token, base_url=CRYPTOBOT_API_URL, timeout=CRYPTOBOT_TIMEOUT):
         self.token = token
-        self.base_url = "https://pay.crypt.bot/api"
-    
-    async def create_invoice(self, amount, description=""):
-        """Создать счет для оплаты"""
+        self.base_url = base_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+        self.breaker = CircuitBreaker("CryptoBot")
+        self.inflight = 0
+        self.retries = 0
+        self.overloaded = 0
+    
+    async def get_session(self):
+        """Общая сессия с пулом соединений (keep-alive + кэш DNS)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=CRYPTOBOT_POOL_SIZE,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"Crypto-Pay-API-Token": self.token}
+            )
+        return self._session
+    
+    async def close(self):
+        """Закрыть сессию (при остановке бота)"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def _request(self, http_method, api_method, timeout=None, **kwargs):
+        """Запрос к Crypto Pay API через предохранитель. Весь вызов вместе с
+        повторами укладывается в timeout (по умолчанию CRYPTOBOT_DEADLINE).
+        Отмена (CancelledError) пробрасывается наверх"""
+        if self.inflight >= CRYPTOBOT_MAX_INFLIGHT:
+            self.overloaded += 1
+            raise RuntimeError("CryptoBot перегружен")
+        if not self.breaker.allow():
+            raise RuntimeError("CryptoBot временно недоступен")
+        
+        session = await self.get_session()
+        deadline = time.monotonic() + (timeout if timeout is not None else CRYPTOBOT_DEADLINE)
+        self.inflight += 1
         try:
-            url = f"{self.base_url}/createInvoice"
-            headers = {"Crypto-Pay-API-Token": self.token}
-            
-            # Конвертируем рубли в USDT по курсу 85 RUB = 1 USDT
-            amount_usdt = amount / 85.0
+            for attempt in range(CRYPTOBOT_RETRIES + 1):
+                try:
+                    return await self._attempt(session, http_method, api_method, deadline, kwargs)
+                except Exception as e:
+                    error = e
+                
+                # createInvoice повторяем, только если запрос не ушел - иначе второй счет
+                retriable = http_method == "GET" or isinstance(error, aiohttp.ClientConnectorError)
+                delay = random.uniform(0, CRYPTOBOT_RETRY_BASE * 2 ** attempt)
+                if not retriable or attempt == CRYPTOBOT_RETRIES or time.monotonic() + delay >= deadline:
+                    break
+                self.retries += 1
+                await asyncio.sleep(delay)
             
+            self.breaker.failure()
+            raise error
+        except asyncio.CancelledError:
+            self.breaker.abandon()
+            raise
+        finally:
+            self.inflight -= 1
+    
+    async def _attempt(self, session, http_method, api_method, deadline, kwargs):
+        """Одна попытка: не дольше CRYPTOBOT_TIMEOUT и оставшегося до deadline"""
+        remaining = min(deadline - time.monotonic(), self.timeout.total)
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        
+        with metrics.timer("external", f"cryptopay.{api_method}"):
+            async with session.request(http_method, f"{self.base_url}/{api_method}",
+                                       timeout=aiohttp.ClientTimeout(total=remaining), **kwargs) as response:
+                if response.status >= 500 or response.status == 429:
+                    response.raise_for_status()
+                result = await response.json(content_type=None)
+        
+        self.breaker.success()
+        return result
+    
+    async def create_invoice(self, amount_usdt, description="", timeout=None):
+        """Создать счет для оплаты (сумма уже в USDT - пересчитывает вызывающий по USD_RATE)"""
+        try:
             data = {
                 "asset": "USDT",
                 "amount": str(round(amount_usdt, 2)),
@@ -54,8 +474,7 @@ class CryptoBotAPI:
                 "allow_anonymous": False
             }
             
-            response = requests.post(url, json=data, headers=headers, timeout=30)
-            result = response.json()
+            result = await self._request("POST", "createInvoice", json=data, timeout=timeout)
             
             if result.get("ok"):
                 invoice = result["result"]
@@ -68,20 +487,18 @@ class CryptoBotAPI:
                 }
             else:
                 return {"success": False, "error": result.get("error", {}).get("name", "Unknown error")}
-                
+        
+        except asyncio.TimeoutError:
+            return {"success": False, "error": "Timeout"}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
-    async def check_invoice_status(self, invoice_id):
+    async def check_invoice_status(self, invoice_id, timeout=None):
         """Проверить статус инвойса в CryptoBot"""
         try:
-            url = f"{self.base_url}/getInvoices"
-            headers = {"Crypto-Pay-API-Token": self.token}
+            params = {"invoice_ids": str(invoice_id)}
             
-            params = {"invoice_ids": invoice_id}
-            
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-            result = response.json()
+            result = await self._request("GET", "getInvoices", params=params, timeout=timeout)
             
             if result.get("ok"):
                 invoice = result["result"]["items"][0]
@@ -89,47 +506,331 @@ class CryptoBotAPI:
                     "success": True,
                     "status": invoice["status"],  # "active", "paid", "expired"
                     "paid_at": invoice.get("paid_at"),
-                    "amount": invoice.get("amount")
+                    "amount": invoice.get("amount"),
+                    "pay_url": invoice.get("pay_url") or invoice.get("bot_invoice_url")
                 }
             else:
                 return {"success": False, "error": result.get("error", {}).get("name", "Unknown error")}
+        
+        except asyncio.TimeoutError:
+            return {"success": False, "error": "Timeout"}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    async def get_exchange_rates(self, timeout=None):
+        """Курсы Crypto Pay: {(source, target): курс}, только действительные"""
+        try:
+            result = await self._request("GET", "getExchangeRates", timeout=timeout)
+            
+            if not result.get("ok"):
+                return {"success": False, "error": result.get("error", {}).get("name", "Unknown error")}
+            
+            return {"success": True, "rates": {
+                (rate["source"], rate["target"]): float(rate["rate"])
+                for rate in result["result"] if rate.get("is_valid", True)
+            }}
+        
+        except asyncio.TimeoutError:
+            return {"success": False, "error": "Timeout"}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    async def get_invoices(self, invoice_ids, timeout=None):
+        """Статусы сразу нескольких инвойсов (по CRYPTOBOT_BATCH_SIZE за запрос)"""
+        invoice_ids = [str(invoice_id) for invoice_id in invoice_ids]
+        items = {}
+        
+        try:
+            for i in range(0, len(invoice_ids), CRYPTOBOT_BATCH_SIZE):
+                chunk = invoice_ids[i:i + CRYPTOBOT_BATCH_SIZE]
+                params = {"invoice_ids": ",".join(chunk), "count": str(len(chunk))}
+                
+                result = await self._request("GET", "getInvoices", params=params, timeout=timeout)
+                
+                if not result.get("ok"):
+                    return {"success": False, "error": result.get("error", {}).get("name", "Unknown error")}
                 
+                for invoice in result["result"]["items"]:
+                    items[str(invoice["invoice_id"])] = {
+                        "status": invoice["status"],
+                        "paid_at": invoice.get("paid_at"),
+                        "amount": invoice.get("amount"),
+                        "pay_url": invoice.get("pay_url") or invoice.get("bot_invoice_url")
+                    }
+            
+            return {"success": True, "items": items}
+        
+        except asyncio.TimeoutError:
+            return {"success": False, "error": "Timeout"}
         except Exception as e:
             return {"success": False, "error": str(e)}
 
 # Инициализируем CryptoBot если есть токен
 cryptobot = CryptoBotAPI(CRYPTOBOT_TOKEN) if CRYPTOBOT_TOKEN else None
 
+def crypto_available():
+    """Показывать ли оплату CryptoBot: токен есть и предохранитель не разомкнут"""
+    return cryptobot is not None and cryptobot.breaker.available
+
 # ========== БАЗА ДАННЫХ ==========
+# Схема таблиц. Новую колонку достаточно дописать сюда - при старте
+# она добавится через ALTER TABLE (без PRIMARY KEY/UNIQUE и с константным DEFAULT)
+SCHEMA = {
+    "users": [
+        ("user_id", "INTEGER PRIMARY KEY"),
+        ("username", "TEXT"),
+        ("full_name", "TEXT"),
+        ("created_at", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
+        ("blocked", "INTEGER NOT NULL DEFAULT 0")  # заблокировал бота (рассылка пропускает)
+    ],
+    "orders": [
+        ("id", "INTEGER PRIMARY KEY AUTOINCREMENT"),
+        ("user_id", "INTEGER"),
+        ("order_type", "TEXT"),
+        ("recipient", "TEXT"),
+        ("details", "TEXT"),
+        ("amount_rub", "REAL"),
+        ("payment_method", "TEXT"),
+        ("status", "TEXT DEFAULT 'pending'"),
+        ("invoice_id", "TEXT"),
+        ("created_at", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP"),
+        # Поля из details, вынесенные в колонки (details остается для совместимости)
+        ("stars", "INTEGER"),
+        ("period", "TEXT"),
+        ("amount_usd", "REAL"),
+        ("exchange_rate", "REAL"),
+        ("payment_photo", "TEXT")
+    ],
+    # Состояния пользователей (FSM) - переживают перезапуск
+    "fsm_states": [
+        ("key", "TEXT PRIMARY KEY"),
+        ("state", "TEXT"),
+        ("data", "TEXT"),
+        ("updated_at", "REAL")
+    ],
+    # Счетчики для статистики: users, orders:<status>, revenue:<status>
+    "counters": [
+        ("name", "TEXT PRIMARY KEY"),
+        ("value", "REAL NOT NULL DEFAULT 0")
+    ],
+    # Рассылки: прогресс по user_id, чтобы продолжить после падения
+    "broadcasts": [
+        ("id", "INTEGER PRIMARY KEY AUTOINCREMENT"),
+        ("text", "TEXT"),
+        ("status", "TEXT DEFAULT 'running'"),  # running / done / cancelled
+        ("last_user_id", "INTEGER NOT NULL DEFAULT 0"),
+        ("total", "INTEGER NOT NULL DEFAULT 0"),
+        ("sent", "INTEGER NOT NULL DEFAULT 0"),
+        ("failed", "INTEGER NOT NULL DEFAULT 0"),
+        ("blocked", "INTEGER NOT NULL DEFAULT 0"),
+        ("report_chat_id", "INTEGER"),
+        ("report_message_id", "INTEGER"),
+        ("heartbeat", "REAL"),
+        ("created_at", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+    ]
+}
+
+# Пересчет счетчиков с нуля (бэкфилл и проверка)
+COUNTERS_SQL = """
+    SELECT 'users', COUNT(*) FROM users
+    UNION ALL
+    SELECT 'orders:' || status, COUNT(*) FROM orders GROUP BY status
+    UNION ALL
+    SELECT 'revenue:' || status, COALESCE(SUM(amount_rub), 0) FROM orders GROUP BY status
+"""
+
+# Версионные миграции (PRAGMA user_version): (версия, описание, шаги).
+# Шаг - SQL строка или функция, принимающая cursor. Только дописывать в конец!
+MIGRATIONS = [
+    (1, "индексы заказов", [
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_invoice ON orders (invoice_id)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id)",
+        # Частичный индекс под get_all_active_orders (условие должно совпадать с запросом)
+        "CREATE INDEX IF NOT EXISTS idx_orders_active ON orders (created_at) "
+        "WHERE status NOT IN ('completed', 'cancelled')"
+    ]),
+    (2, "бэкфилл счетчиков статистики", [
+        "DELETE FROM counters",
+        "INSERT INTO counters (name, value) " + COUNTERS_SQL
+    ]),
+    (3, "индекс для очистки FSM", [
+        "CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm_states (updated_at)"
+    ]),
+    (4, "поля details в колонки заказа", [
+        """UPDATE orders SET
+            stars = json_extract(details, '$.stars'),
+            period = json_extract(details, '$.period'),
+            amount_usd = json_extract(details, '$.amount_usd'),
+            exchange_rate = json_extract(details, '$.exchange_rate'),
+            payment_photo = json_extract(details, '$.payment_photo')
+        WHERE json_valid(details)"""
+    ])
+]
+
+# ========== ЗАКАЗ ==========
+ORDER_COLUMNS = (
+    "id", "user_id", "order_type", "recipient", "amount_rub", "payment_method", "status", "invoice_id",
+    "created_at", "stars", "period", "amount_usd", "exchange_rate", "payment_photo"
+)
+ORDER_SELECT = f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders"
+ORDER_DETAIL_FIELDS = ("stars", "period", "amount_usd", "exchange_rate", "payment_photo")
+
+class Order:
+    """Заказ из БД. Поля details уже разложены по колонкам - json не разбирается"""
+    __slots__ = ORDER_COLUMNS
+    
+    def __init__(self, *values):
+        for name, value in zip(ORDER_COLUMNS, values):
+            setattr(self, name, value)
+    
+    @staticmethod
+    def row_factory(cursor, row):
+        return Order(*row)
+    
+    def usd(self):
+        """Сумма к выдаче для обмена (старые заказы - по текущему курсу)"""
+        return self.amount_usd if self.amount_usd is not None else self.amount_rub / USD_RATE
+    
+    @property
+    def period_name(self):
+        return PREMIUM_PRICES.get(self.period, {}).get("name", "")
+    
+    def __repr__(self):
+        return f"<Order #{self.id} {self.order_type} {self.status}>"
+
 class Database:
-    def __init__(self, db_name="digistore.db"):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+    def __init__(self, db_name=DB_NAME, readers=DB_READERS):
+        self.db_name = db_name
+        self.conn = self._connect()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self._readers = []
+        self._reader_pool = queue.Queue()
+        self._reader_limit = readers
+        self._pool_lock = threading.Lock()
+        self._in_batch = False
         self.create_tables()
     
+    def _connect(self, readonly=False):
+        """Соединение с общими настройками производительности"""
+        if readonly:
+            conn = sqlite3.connect(f"file:{self.db_name}?mode=ro", uri=True, check_same_thread=False,
+                                   timeout=DB_BUSY_TIMEOUT / 1000)
+            conn.execute("PRAGMA query_only=1")
+        else:
+            conn = sqlite3.connect(self.db_name, check_same_thread=False, timeout=DB_BUSY_TIMEOUT / 1000)
+            conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT}")
+        conn.execute(f"PRAGMA cache_size={DB_CACHE_SIZE}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        return conn
+    
+    @contextmanager
+    def _reading(self):
+        """Read-only соединение из пула. Чтение (WAL) не блокирует запись и наоборот"""
+        try:
+            conn = self._reader_pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                if len(self._readers) < self._reader_limit:
+                    conn = self._connect(readonly=True)
+                    self._readers.append(conn)
+                else:
+                    conn = None
+            if conn is None:
+                conn = self._reader_pool.get()
+        
+        try:
+            yield conn
+        finally:
+            self._reader_pool.put(conn)
+    
+    def _commit(self):
+        """Commit после записи. Внутри write_batch - один общий commit в конце"""
+        if not self._in_batch:
+            self.conn.commit()
+    
+    def write_batch(self, calls):
+        """Group commit: пачка записей [(method, args, kwargs)] одной транзакцией.
+        Ошибка одной записи откатывает только её (SAVEPOINT). Возвращает [(result, error)]"""
+        outcomes = []
+        self._in_batch = True
+        try:
+            # IMMEDIATE - блокировка записи сразу: проверки статуса атомарны и между процессами
+            self.conn.execute("BEGIN IMMEDIATE")
+            for method, args, kwargs in calls:
+                self.conn.execute("SAVEPOINT write")
+                try:
+                    result = method(*args, **kwargs)
+                except Exception as e:
+                    self.conn.execute("ROLLBACK TO write")
+                    outcomes.append((None, e))
+                else:
+                    outcomes.append((result, None))
+                self.conn.execute("RELEASE write")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self._in_batch = False
+        return outcomes
+    
+    def close(self):
+        for conn in self._readers:
+            conn.close()
+        self._readers.clear()
+        self.conn.close()
+    
     def create_tables(self):
+        """Создать таблицы, добавить недостающие колонки из SCHEMA и применить миграции"""
         cursor = self.conn.cursor()
         
-        cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            full_name TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
-        
-        cursor.execute('''CREATE TABLE IF NOT EXISTS orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            order_type TEXT,
-            recipient TEXT,
-            details TEXT,
-            amount_rub REAL,
-            payment_method TEXT,
-            status TEXT DEFAULT 'pending',
-            invoice_id TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
+        for table, columns in SCHEMA.items():
+            columns_sql = ",\n            ".join(f"{name} {decl}" for name, decl in columns)
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {table} (\n            {columns_sql}\n        )")
+            
+            existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+            for name, decl in columns:
+                if name not in existing:
+                    logger.info(f"БД: добавляю колонку {table}.{name}")
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
         
         self.conn.commit()
+        self.migrate()
+    
+    def migrate(self):
+        """Миграции по PRAGMA user_version - каждая в своей транзакции"""
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        
+        for target, description, steps in MIGRATIONS:
+            if target <= version:
+                continue
+            
+            logger.info(f"БД: миграция {target} - {description}")
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute("BEGIN")
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute(f"PRAGMA user_version = {target}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            version = target
+    
+    def _bump(self, cursor, name, delta):
+        """Изменить счетчик (в той же транзакции, что и сама запись)"""
+        cursor.execute(
+            """INSERT INTO counters (name, value) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value""",
+            (name, delta)
+        )
     
     def add_user(self, user_id, username, full_name):
         cursor = self.conn.cursor()
@@ -137,28 +838,84 @@ class Database:
             "INSERT OR IGNORE INTO users (user_id, username, full_name) VALUES (?, ?, ?)",
             (user_id, username, full_name)
         )
-        self.conn.commit()
+        if cursor.rowcount > 0:
+            self._bump(cursor, "users", 1)
+        else:
+            # Вернулся после блокировки - снова получает рассылки
+            cursor.execute("UPDATE users SET blocked = 0 WHERE user_id = ? AND blocked = 1", (user_id,))
+        self._commit()
     
     def add_order(self, user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id=None):
+        """details - dict: известные поля пишутся в свои колонки, весь dict - в details"""
         cursor = self.conn.cursor()
         cursor.execute(
             """INSERT INTO orders 
-            (user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id)
+            (user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id,
+             stars, period, amount_usd, exchange_rate, payment_photo) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (user_id, order_type, recipient, json.dumps(details), amount_rub, payment_method, invoice_id,
+             *(details.get(name) for name in ORDER_DETAIL_FIELDS))
         )
         order_id = cursor.lastrowid
-        self.conn.commit()
+        self._bump(cursor, "orders:pending", 1)
+        self._bump(cursor, "revenue:pending", amount_rub or 0)
+        self._commit()
         return order_id
     
-    def update_order_status(self, order_id, status):
-        cursor = self.conn.cursor()
+    def _set_status(self, cursor, order_id, status, from_status=None):
+        """Сменить статус заказа и перенести его в счетчиках. Без commit"""
+        cursor.execute("SELECT status, amount_rub FROM orders WHERE id = ?", (order_id,))
+        row = cursor.fetchone()
+        if not row or (from_status is not None and row[0] != from_status):
+            return False
+        
+        old_status, amount_rub = row
         cursor.execute(
             "UPDATE orders SET status = ? WHERE id = ?",
             (status, order_id)
         )
-        self.conn.commit()
-        return cursor.rowcount > 0
+        if old_status != status:
+            self._bump(cursor, f"orders:{old_status}", -1)
+            self._bump(cursor, f"revenue:{old_status}", -(amount_rub or 0))
+            self._bump(cursor, f"orders:{status}", 1)
+            self._bump(cursor, f"revenue:{status}", amount_rub or 0)
+        return True
+    
+    def update_order_status(self, order_id, status, from_status=None):
+        """Сменить статус. С from_status - только если заказ ещё в этом статусе"""
+        cursor = self.conn.cursor()
+        changed = self._set_status(cursor, order_id, status, from_status)
+        self._commit()
+        return changed
+    
+    def update_orders_status(self, order_ids, status, from_status=None):
+        """Сменить статус пачке заказов одной транзакцией. Возвращает id изменённых"""
+        cursor = self.conn.cursor()
+        changed = [
+            order_id for order_id in order_ids
+            if self._set_status(cursor, order_id, status, from_status)
+        ]
+        self._commit()
+        return changed
+    
+    def check_counters(self, fix=False):
+        """Сверить счетчики с таблицами. Возвращает {счетчик: (было, должно быть)}"""
+        cursor = self.conn.cursor()
+        actual = dict(cursor.execute(COUNTERS_SQL).fetchall())
+        stored = dict(cursor.execute("SELECT name, value FROM counters").fetchall())
+        
+        mismatches = {}
+        for name in actual.keys() | stored.keys():
+            expected = actual.get(name, 0)
+            value = stored.get(name, 0)
+            if abs(value - expected) > 0.005:
+                mismatches[name] = (value, expected)
+        
+        if fix and mismatches:
+            cursor.execute("DELETE FROM counters")
+            cursor.execute("INSERT INTO counters (name, value) " + COUNTERS_SQL)
+            self._commit()
+        return mismatches
     
     def update_invoice_id(self, order_id, invoice_id):
         cursor = self.conn.cursor()
@@ -166,78 +923,730 @@ class Database:
             "UPDATE orders SET invoice_id = ? WHERE id = ?",
             (invoice_id, order_id)
         )
-        self.conn.commit()
+        self._commit()
     
     def add_payment_photo(self, order_id, file_id):
-        """Сохранить photo_file_id в details заказа"""
+        """Сохранить photo_file_id заказа"""
         cursor = self.conn.cursor()
         cursor.execute(
-            "UPDATE orders SET details = json_set(details, '$.payment_photo', ?) WHERE id = ?",
-            (file_id, order_id)
+            "UPDATE orders SET payment_photo = ?, details = json_set(details, '$.payment_photo', ?) WHERE id = ?",
+            (file_id, file_id, order_id)
         )
-        self.conn.commit()
+        self._commit()
         return cursor.rowcount > 0
     
     def get_pending_orders(self):
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT id, user_id, order_type, recipient, amount_rub, payment_method, created_at 
-            FROM orders 
-            WHERE status = 'pending' 
-            ORDER BY created_at DESC
-        """)
-        return cursor.fetchall()
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = Order.row_factory
+            cursor.execute(f"""
+                {ORDER_SELECT}
+                WHERE status = 'pending' 
+                ORDER BY created_at DESC
+            """)
+            return cursor.fetchall()
     
     def get_completed_orders(self):
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT id, user_id, order_type, recipient, amount_rub, payment_method, created_at 
-            FROM orders 
-            WHERE status = 'completed' 
-            ORDER BY created_at DESC
-            LIMIT 50
-        """)
-        return cursor.fetchall()
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = Order.row_factory
+            cursor.execute(f"""
+                {ORDER_SELECT}
+                WHERE status = 'completed' 
+                ORDER BY created_at DESC
+                LIMIT 50
+            """)
+            return cursor.fetchall()
     
     def get_all_active_orders(self):
         """Все заказы кроме completed и cancelled"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT id, user_id, order_type, recipient, amount_rub, payment_method, status, created_at 
-            FROM orders 
-            WHERE status NOT IN ('completed', 'cancelled')
-            ORDER BY created_at DESC
-        """)
-        return cursor.fetchall()
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = Order.row_factory
+            cursor.execute(f"""
+                {ORDER_SELECT}
+                WHERE status NOT IN ('completed', 'cancelled')
+                ORDER BY created_at DESC
+            """)
+            return cursor.fetchall()
+    
+    def get_orders_page(self, status=None, before_id=None, after_id=None, limit=ORDERS_PAGE_SIZE):
+        """Страница заказов, keyset по (created_at, id) - один индексный запрос.
+        status=None - все активные. before_id - страница старше заказа, after_id - новее.
+        Возвращает (заказы от новых к старым, есть ли ещё заказы в направлении листания)"""
+        if status is None:
+            where, params = ["status NOT IN ('completed', 'cancelled')"], []
+        else:
+            where, params = ["status = ?"], [status]
+        
+        order = "DESC"
+        if before_id is not None:
+            where.append("(created_at, id) < (SELECT created_at, id FROM orders WHERE id = ?)")
+            params.append(before_id)
+        elif after_id is not None:
+            where.append("(created_at, id) > (SELECT created_at, id FROM orders WHERE id = ?)")
+            params.append(after_id)
+            order = "ASC"
+        
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = Order.row_factory
+            cursor.execute(f"""
+                {ORDER_SELECT}
+                WHERE {" AND ".join(where)}
+                ORDER BY created_at {order}, id {order}
+                LIMIT ?
+            """, (*params, limit + 1))
+            rows = cursor.fetchall()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if order == "ASC":
+            rows.reverse()
+        return rows, has_more
+    
+    def get_waiting_crypto_orders(self):
+        """Заказы, ожидающие оплаты в CryptoBot"""
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = Order.row_factory
+            cursor.execute(f"""
+                {ORDER_SELECT}
+                WHERE status = 'waiting_crypto' AND invoice_id IS NOT NULL
+            """)
+            return cursor.fetchall()
+    
+    def get_stray_crypto_orders(self, window=CRYPTO_STRAY_WINDOW):
+        """Недавние заказы со счетом CryptoBot, которые уже не ждут его оплаты
+        (переведены на карту, отменены...) - оплату по ним сам бот не засчитает"""
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = Order.row_factory
+            cursor.execute(f"""
+                {ORDER_SELECT}
+                WHERE status IN ('pending', 'waiting_payment', 'waiting_confirmation', 'confirmed', 'cancelled')
+                  AND created_at >= datetime('now', ?) AND invoice_id IS NOT NULL
+            """, (f"-{int(window)} seconds",))
+            return cursor.fetchall()
+    
+    def get_order_by_invoice(self, invoice_id):
+        """Найти заказ по invoice_id CryptoBot"""
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = Order.row_factory
+            cursor.execute(f"{ORDER_SELECT} WHERE invoice_id = ?", (str(invoice_id),))
+            return cursor.fetchone()
     
     def get_order(self, order_id):
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = Order.row_factory
+            cursor.execute(f"{ORDER_SELECT} WHERE id = ?", (order_id,))
+            return cursor.fetchone()
+    
+    def save_fsm(self, key, state, data, updated_at):
         cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id 
-            FROM orders WHERE id = ?
-        """, (order_id,))
-        return cursor.fetchone()
+        cursor.execute(
+            "INSERT OR REPLACE INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+            (key, state, data, updated_at)
+        )
+        self._commit()
     
-    def get_statistics(self):
+    def delete_fsm(self, key):
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM fsm_states WHERE key = ?", (key,))
+        self._commit()
+    
+    def purge_fsm(self, before):
+        """Удалить состояния, не менявшиеся с момента before"""
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM fsm_states WHERE updated_at < ?", (before,))
+        self._commit()
+        return cursor.rowcount
+    
+    def load_fsm(self, key):
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key,))
+            return cursor.fetchone()
+    
+    def create_broadcast(self, text, report_chat_id=None, report_message_id=None):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """INSERT INTO broadcasts (text, total, report_chat_id, report_message_id, heartbeat)
+               VALUES (?, (SELECT COUNT(*) FROM users WHERE blocked = 0), ?, ?, ?)""",
+            (text, report_chat_id, report_message_id, time.time())
+        )
+        self._commit()
+        return cursor.lastrowid
+    
+    def claim_broadcast(self, broadcast_id, stale_before):
+        """Забрать рассылку, если ее никто не ведет (отметка старше stale_before)"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "UPDATE broadcasts SET heartbeat = ? WHERE id = ? AND status = 'running' AND heartbeat < ?",
+            (time.time(), broadcast_id, stale_before)
+        )
+        self._commit()
+        return cursor.rowcount > 0
+    
+    def touch_broadcast(self, broadcast_id):
+        """Отметка "рассылку ведут" между сохранениями прогресса"""
         cursor = self.conn.cursor()
+        cursor.execute(
+            "UPDATE broadcasts SET heartbeat = ? WHERE id = ? AND status = 'running'",
+            (time.time(), broadcast_id)
+        )
+        self._commit()
+    
+    def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, blocked_ids):
+        """Итог шага рассылки (счетчики - приращения) одной транзакцией"""
+        cursor = self.conn.cursor()
+        if blocked_ids:
+            cursor.executemany("UPDATE users SET blocked = 1 WHERE user_id = ?", [(user_id,) for user_id in blocked_ids])
+        cursor.execute(
+            """UPDATE broadcasts
+               SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?, heartbeat = ?
+               WHERE id = ?""",
+            (last_user_id, sent, failed, len(blocked_ids), time.time(), broadcast_id)
+        )
+        self._commit()
+    
+    def finish_broadcast(self, broadcast_id, status="done"):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "UPDATE broadcasts SET status = ? WHERE id = ? AND status = 'running'",
+            (status, broadcast_id)
+        )
+        self._commit()
+        return cursor.rowcount > 0
+    
+    def get_broadcast(self, broadcast_id=None):
+        """Рассылка по id, без id - последняя"""
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            columns = "id, text, status, last_user_id, total, sent, failed, blocked, report_chat_id, report_message_id, heartbeat"
+            if broadcast_id is None:
+                cursor.execute(f"SELECT {columns} FROM broadcasts ORDER BY id DESC LIMIT 1")
+            else:
+                cursor.execute(f"SELECT {columns} FROM broadcasts WHERE id = ?", (broadcast_id,))
+            return cursor.fetchone()
+    
+    def get_running_broadcasts(self):
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+            return [row[0] for row in cursor.fetchall()]
+    
+    def get_broadcast_recipients(self, after_user_id, limit=BROADCAST_CHUNK):
+        """Следующая пачка получателей (keyset по user_id)"""
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT user_id FROM users WHERE blocked = 0 AND user_id > ? ORDER BY user_id LIMIT ?",
+                (after_user_id, limit)
+            )
+            return [row[0] for row in cursor.fetchall()]
+    
+    def get_statistics(self):
+        """Статистика из счетчиков - O(1) при любом количестве заказов"""
+        with self._reading() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT name, value FROM counters WHERE name IN (?, ?, ?, ?)",
+                ("users", "orders:completed", "revenue:completed", "orders:pending")
+            )
+            counters = dict(cursor.fetchall())
+            
+            return {
+                "total_users": int(counters.get("users", 0)),
+                "completed_orders": int(counters.get("orders:completed", 0)),
+                "total_revenue": counters.get("revenue:completed", 0),
+                "pending_orders": int(counters.get("orders:pending", 0))
+            }
+
+class OrderCache:
+    """LRU кэш заказов по id с TTL. Запись в заказ выкидывает его из кэша,
+    а чтение, начатое до любой записи, свой результат уже не кладет (epoch)"""
+    
+    def __init__(self, max_entries=ORDER_CACHE_SIZE, ttl=ORDER_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # order_id -> (Order, истекает)
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, order_id):
+        entry = self.entries.get(order_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            self.entries.move_to_end(order_id)
+            return entry[0]
         
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
+        self.misses += 1
+        if entry is not None:
+            del self.entries[order_id]
+        return None
+    
+    def put(self, order_id, order, epoch):
+        if order is None or epoch != self.epoch:
+            return
+        self.entries[order_id] = (order, time.monotonic() + self.ttl)
+        self.entries.move_to_end(order_id)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def invalidate(self, order_ids):
+        self.epoch += 1
+        for order_id in order_ids:
+            self.entries.pop(order_id, None)
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database: те же методы, но awaitable.
+    Запись - один поток-писатель с очередью и group commit, чтение - небольшой пул потоков.
+    get_order читается через OrderCache"""
+    READ_METHODS = {
+        "get_pending_orders", "get_completed_orders", "get_all_active_orders", "get_orders_page",
+        "get_waiting_crypto_orders", "get_stray_crypto_orders", "get_order_by_invoice", "get_order", "get_statistics", "load_fsm",
+        "get_broadcast", "get_running_broadcasts", "get_broadcast_recipients"
+    }
+    # Записи, меняющие заказ: метод -> id заказов из аргументов
+    ORDER_WRITES = {
+        "update_order_status": lambda args: [args[0]],
+        "update_orders_status": lambda args: args[0],
+        "update_invoice_id": lambda args: [args[0]],
+        "add_payment_photo": lambda args: [args[0]]
+    }
+    
+    def __init__(self, database, readers=DB_READERS, commit_window=DB_COMMIT_WINDOW, commit_batch=DB_COMMIT_BATCH):
+        self.database = database
+        self.commit_window = commit_window
+        self.commit_batch = commit_batch
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="db-writer", daemon=True)
+        self._writer.start()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self.order_cache = OrderCache()
+        # Записи из очереди сохраняются даже если close() не был вызван
+        atexit.register(self._stop_writer)
+    
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        method = getattr(self.database, name)
+        
+        if name in self.READ_METHODS:
+            async def call(*args, **kwargs):
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._readers, lambda: method(*args, **kwargs))
+        elif name in self.ORDER_WRITES:
+            order_ids = self.ORDER_WRITES[name]
+            async def call(*args, **kwargs):
+                future = asyncio.get_running_loop().create_future()
+                self._queue.put((method, args, kwargs, future))
+                try:
+                    return await future
+                finally:
+                    self.order_cache.invalidate(order_ids(args))
+        else:
+            async def call(*args, **kwargs):
+                future = asyncio.get_running_loop().create_future()
+                self._queue.put((method, args, kwargs, future))
+                return await future
+        
+        call = metrics.timed("db", name)(call)
+        setattr(self, name, call)
+        return call
+    
+    @metrics.timed("db")
+    async def get_order(self, order_id):
+        order = self.order_cache.get(order_id)
+        if order is None:
+            epoch = self.order_cache.epoch
+            loop = asyncio.get_running_loop()
+            order = await loop.run_in_executor(self._readers, self.database.get_order, order_id)
+            self.order_cache.put(order_id, order, epoch)
+        return order
+    
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            
+            # Собираем записи, пришедшие в течение окна, в одну транзакцию
+            batch = [item]
+            deadline = time.monotonic() + self.commit_window
+            while len(batch) < self.commit_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            self._flush(batch)
+    
+    def _flush(self, batch):
+        try:
+            outcomes = self.database.write_batch([(method, args, kwargs) for method, args, kwargs, _ in batch])
+        except Exception as e:
+            outcomes = [(None, e)] * len(batch)
+        
+        for (_, _, _, future), (result, error) in zip(batch, outcomes):
+            self._resolve(future, result, error)
+    
+    def _stop_writer(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+    
+    @staticmethod
+    def _resolve(future, result, error):
+        def set_result():
+            if future.cancelled():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        
+        try:
+            future.get_loop().call_soon_threadsafe(set_result)
+        except RuntimeError:
+            pass  # цикл событий уже закрыт, запись при этом сохранена
+    
+    def pending_writes(self):
+        """Записей в очереди писателя"""
+        return self._queue.qsize()
+    
+    async def close(self):
+        """Дождаться всех записей из очереди и закрыть соединения"""
+        await asyncio.to_thread(self._stop_writer)
+        atexit.unregister(self._stop_writer)
+        self._readers.shutdown(wait=True)
+        self.database.close()
+
+# ========== FSM ХРАНИЛИЩЕ ==========
+class SQLiteFSMStorage(BaseStorage):
+    """FSM хранилище aiogram: горячие записи в памяти (TTL + LRU, не больше max_entries),
+    запись насквозь в SQLite - состояния переживают перезапуск"""
+    
+    def __init__(self, database, max_entries=FSM_CACHE_SIZE, ttl=FSM_TTL, cache_ttl=FSM_CACHE_TTL):
+        self.database = database
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_ttl = cache_ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = OrderedDict()  # ключ -> (state, data, updated_at, cached_at)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+    
+    def _put(self, key, record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+    
+    async def _load(self, storage_key):
+        key = self.key_builder.build(storage_key)
+        now = time.time()
+        
+        record = self._cache.get(key)
+        if record is not None:
+            if now - record[2] <= self.ttl and now - record[3] < self.cache_ttl:
+                self.hits += 1
+                self._cache.move_to_end(key)
+                return key, record
+            del self._cache[key]
+            self.expired += 1
+        
+        self.misses += 1
+        row = await self.database.load_fsm(key)
+        if row and now - row[2] <= self.ttl:
+            record = (row[0], json.loads(row[1]) if row[1] else {}, row[2], now)
+        else:
+            # Пустую запись тоже кэшируем - большинство апдейтов без состояния
+            record = (None, {}, now, now)
         
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE status = 'completed'")
-        completed_orders = cursor.fetchone()[0]
+        self._put(key, record)
+        return key, record
+    
+    async def _save(self, key, state, data):
+        now = time.time()
+        record = (state, data, now, now)
+        self._put(key, record)
         
-        cursor.execute("SELECT SUM(amount_rub) FROM orders WHERE status = 'completed'")
-        total_revenue = cursor.fetchone()[0] or 0
+        if state is None and not data:
+            await self.database.delete_fsm(key)
+        else:
+            await self.database.save_fsm(key, state, json.dumps(data, ensure_ascii=False), record[2])
+    
+    async def set_state(self, key, state=None):
+        key, record = await self._load(key)
+        state = state.state if isinstance(state, State) else state
+        await self._save(key, state, record[1])
+    
+    async def get_state(self, key):
+        _, record = await self._load(key)
+        return record[0]
+    
+    async def set_data(self, key, data):
+        key, record = await self._load(key)
+        await self._save(key, record[0], dict(data))
+    
+    async def get_data(self, key):
+        _, record = await self._load(key)
+        return dict(record[1])
+    
+    async def purge_expired(self):
+        """Удалить брошенные сценарии из памяти и из базы"""
+        before = time.time() - self.ttl
+        for key in [key for key, record in self._cache.items() if record[2] < before]:
+            del self._cache[key]
+            self.expired += 1
+        return await self.database.purge_fsm(before)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expired": self.expired
+        }
+    
+    async def close(self):
+        pass
+
+async def fsm_cleanup_loop(storage, interval=3600):
+    """Фоновая очистка брошенных сценариев"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            purged = await storage.purge_expired()
+            if purged:
+                logger.info(f"FSM: удалено {purged} брошенных состояний")
+        except Exception as e:
+            logger.warning(f"FSM: ошибка очистки: {e}")
+
+async def set_user_state(state: FSMContext, action, **data):
+    """Начать шаг сценария: состояние + данные заново"""
+    await state.set_data(data)
+    await state.set_state(action)
+
+# ========== ИСХОДЯЩИЕ СООБЩЕНИЯ ==========
+# Приоритеты отправки: меньше - раньше
+PRIORITY_INTERACTIVE = 0  # ответы на действия пользователя
+PRIORITY_NOTIFY = 1  # уведомления (админам, о статусе заказа)
+PRIORITY_BULK = 2  # рассылки
+
+send_priority = contextvars.ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+@contextmanager
+def sending_priority(priority):
+    """Приоритет для всех отправок внутри блока (и созданных в нем задач)"""
+    token = send_priority.set(priority)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+class TokenBucket:
+    """Ведро токенов с резервированием: take() сразу забирает токен
+    (баланс может уйти в минус) и возвращает, сколько ждать до отправки"""
+    
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+    
+    def try_take(self):
+        """Забрать токен, только если он есть прямо сейчас (без резервирования)"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+    
+    def pause(self, seconds):
+        """Telegram попросил подождать (RetryAfter)"""
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+        self.updated = time.monotonic()
+
+class OutboundQueue(BaseRequestMiddleware):
+    """Все исходящие запросы в чаты проходят через одну очередь:
+    ведро на каждый чат + общее ведро бота, выдача по приоритету на обоих
+    уровнях (ответ в чат не ждет уведомлений и рассылки в тот же чат),
+    ожидание RetryAfter и повторы с backoff при сетевых ошибках"""
+    
+    def __init__(self, global_rate=TG_GLOBAL_RATE, chat_rate=TG_CHAT_RATE, chat_burst=TG_CHAT_BURST,
+                 group_rate=TG_GROUP_RATE, max_retries=TG_MAX_RETRIES, max_chats=10000):
+        self.global_bucket = TokenBucket(global_rate, burst=max(1, int(global_rate)))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.chat_buckets = OrderedDict()
+        self.chat_waiting = {}  # chat_id -> heap (приоритет, номер, future), пока в чате очередь
+        self.chat_pumps = set()
+        self.waiting = []  # heap (приоритет, номер, future)
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.dispatcher = None
+        self.latencies = deque(maxlen=1000)
+        self.sent = 0
+        self.retries = 0
+        self.flood_waits = 0
+        self.failed = 0
+    
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.chat_rate, burst=self.chat_burst)
+            else:
+                bucket = TokenBucket(self.group_rate)
+            self.chat_buckets[chat_id] = bucket
+            if len(self.chat_buckets) > self.max_chats:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+    
+    async def _dispatch(self):
+        """Выдает общие токены ожидающим в порядке приоритета"""
+        while True:
+            if not self.waiting:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            
+            delay = self.global_bucket.take()
+            if delay:
+                await asyncio.sleep(delay)
+            
+            # За время ожидания мог прийти запрос важнее - берем верхний
+            while self.waiting:
+                _, _, future = heapq.heappop(self.waiting)
+                if not future.done():
+                    future.set_result(None)
+                    break
+    
+    async def _pump_chat(self, chat_id):
+        """Выдает токены чата ожидающим в порядке приоритета; завершается, когда очередь чата пуста"""
+        waiting = self.chat_waiting[chat_id]
+        try:
+            while waiting:
+                delay = self.chat_bucket(chat_id).take()
+                if delay:
+                    await asyncio.sleep(delay)
+                
+                while waiting:
+                    _, _, future = heapq.heappop(waiting)
+                    if not future.done():
+                        future.set_result(None)
+                        break
+        finally:
+            del self.chat_waiting[chat_id]
+    
+    async def acquire(self, chat_id, priority):
+        waiting = self.chat_waiting.get(chat_id)
+        # Чат свободен и токен есть - без очереди чата
+        if waiting is not None or not self.chat_bucket(chat_id).try_take():
+            if waiting is None:
+                waiting = self.chat_waiting[chat_id] = []
+                pump = asyncio.create_task(self._pump_chat(chat_id))
+                self.chat_pumps.add(pump)
+                pump.add_done_callback(self.chat_pumps.discard)
+            
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(waiting, (priority, next(self.counter), future))
+            await future
         
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE status = 'pending'")
-        pending_orders = cursor.fetchone()[0]
+        if self.dispatcher is None or self.dispatcher.done():
+            self.wakeup = asyncio.Event()
+            self.dispatcher = asyncio.create_task(self._dispatch())
         
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.counter), future))
+        self.wakeup.set()
+        await future
+    
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # getUpdates, answerCallbackQuery, setWebhook... - без очереди
+            return await make_request(bot, method)
+        
+        priority = send_priority.get()
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(chat_id, priority)
+            started = time.monotonic()
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.flood_waits += 1
+                logger.warning(f"Флуд-лимит ({type(method).__name__} в {chat_id}): ждем {e.retry_after} с")
+                self.chat_bucket(chat_id).pause(e.retry_after)
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    raise
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    raise
+                self.retries += 1
+                backoff = min(TG_RETRY_BACKOFF_MAX, TG_RETRY_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1)
+                logger.info(f"{type(method).__name__} в {chat_id}: {e}, повтор через {backoff:.1f} с")
+                await asyncio.sleep(backoff)
+            else:
+                self.latencies.append(time.monotonic() - started)
+                self.sent += 1
+                return result
+    
+    def stats(self):
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
         return {
-            "total_users": total_users,
-            "completed_orders": completed_orders,
-            "total_revenue": total_revenue,
-            "pending_orders": pending_orders
+            "depth": len(self.waiting) + sum(len(waiting) for waiting in self.chat_waiting.values()),
+            "sent": self.sent,
+            "retries": self.retries,
+            "flood_waits": self.flood_waits,
+            "failed": self.failed,
+            "p50": percentile(0.5),
+            "p99": percentile(0.99)
         }
 
 # ========== ИНИЦИАЛИЗАЦИЯ ==========
@@ -245,45 +1654,549 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-db = Database()
+# В кластере лимит бота делится между воркерами
+outbound = OutboundQueue(global_rate=TG_GLOBAL_RATE / WORKERS if BOT_MODE == "cluster" else TG_GLOBAL_RATE)
+bot.session.middleware(outbound)
+bot.session.middleware(ApiMetrics())
+db = AsyncDatabase(Database())
+fsm_storage = SQLiteFSMStorage(db)
+dp = Dispatcher(storage=fsm_storage)
+update_metrics = UpdateMetrics()
+dp.update.outer_middleware(update_metrics)
+dp.message.middleware(HandlerMetrics())
+dp.callback_query.middleware(HandlerMetrics())
 
-user_states = {}
+# ========== МАРШРУТИЗАЦИЯ КНОПОК ==========
+# callback_data в формате "префикс:действие:id" (до 64 байт). Префикс выбирает
+# фабрику, (префикс, действие) - обработчик в CALLBACK_ROUTES
+class MenuCB(CallbackData, prefix="m"):
+    action: str
+    arg: Optional[str] = None
+
+class PayCB(CallbackData, prefix="p"):
+    action: str
+    id: int
+
+class OrderCB(CallbackData, prefix="o"):
+    action: str
+    id: int
+
+class AdminCB(CallbackData, prefix="a"):
+    action: str
+
+class OrdersCB(CallbackData, prefix="l"):
+    action: str  # ключ фильтра из ORDER_FILTERS
+    before: Optional[int] = None
+    after: Optional[int] = None
+
+CALLBACK_FACTORIES = {factory.__prefix__: factory for factory in (MenuCB, PayCB, OrderCB, AdminCB, OrdersCB)}
+CALLBACK_ROUTES = {}  # (префикс, действие) -> (обработчик, нужен ли state)
+
+# Частые callback_data разделов меню
+CB_MAIN_MENU = MenuCB(action="main").pack()
+CB_BUY_STARS = MenuCB(action="stars").pack()
+CB_BUY_PREMIUM = MenuCB(action="premium").pack()
+CB_EXCHANGE = MenuCB(action="exchange").pack()
+CB_INFO = MenuCB(action="info").pack()
+CB_ADMIN_ORDERS = AdminCB(action="orders").pack()
+CB_ADMIN_STATS = AdminCB(action="stats").pack()
+CB_ADMIN_PENDING = AdminCB(action="pending").pack()
+CB_ADMIN_COMPLETED = AdminCB(action="completed").pack()
+CB_ADMIN_BACK = AdminCB(action="back").pack()
+
+# Старые форматы - кнопки в уже отправленных сообщениях продолжают работать
+LEGACY_CALLBACKS = {
+    "main_menu": MenuCB(action="main"),
+    "buy_stars": MenuCB(action="stars"),
+    "buy_premium": MenuCB(action="premium"),
+    "exchange": MenuCB(action="exchange"),
+    "info": MenuCB(action="info"),
+    "admin_orders": AdminCB(action="orders"),
+    "admin_stats": AdminCB(action="stats"),
+    "admin_pending": AdminCB(action="pending"),
+    "admin_completed": AdminCB(action="completed"),
+    "admin_back": AdminCB(action="back")
+}
+LEGACY_PREFIXES = {
+    "card_pay": (PayCB, "card"),
+    "crypto_pay": (PayCB, "crypto"),
+    "check_crypto": (PayCB, "check"),
+    "confirm_paid": (PayCB, "paid"),
+    "cancel_photo": (PayCB, "cancel_photo"),
+    "order_confirm": (OrderCB, "confirm"),
+    "order_reject": (OrderCB, "reject"),
+    "order_complete": (OrderCB, "complete"),
+    "order_finish": (OrderCB, "finish"),
+    "order_cancel": (OrderCB, "cancel"),
+    "order_msg": (OrderCB, "msg"),
+    "order_refresh": (OrderCB, "refresh"),
+    "crypto_status": (OrderCB, "crypto_status")
+}
+
+def translate_legacy_callback(data):
+    """Старый callback_data ("card_pay_12", "orders_all_n5", ...) -> объект фабрики или None"""
+    cb = LEGACY_CALLBACKS.get(data)
+    if cb is not None:
+        return cb
+    
+    if data.startswith("premium_"):
+        return MenuCB(action="period", arg=data[len("premium_"):])
+    
+    if data.startswith("orders_"):
+        # orders_<фильтр>[_n<id> | _p<id>]
+        parts = data.split("_")
+        before_id = after_id = None
+        if len(parts) > 2 and parts[2][1:].isdigit():
+            if parts[2][0] == "n":
+                before_id = int(parts[2][1:])
+            elif parts[2][0] == "p":
+                after_id = int(parts[2][1:])
+        return OrdersCB(action=parts[1] or "all", before=before_id, after=after_id)
+    
+    name, _, order_id = data.rpartition("_")
+    route = LEGACY_PREFIXES.get(name)
+    if route is None or not order_id.isdigit():
+        return None
+    factory, action = route
+    return factory(action=action, id=int(order_id))
+
+def parse_callback(data):
+    """Разобрать callback_data один раз. None - неизвестный или битый формат"""
+    if not data:
+        return None
+    prefix, sep, _ = data.partition(":")
+    if not sep:
+        return translate_legacy_callback(data)
+    
+    factory = CALLBACK_FACTORIES.get(prefix)
+    if factory is None:
+        return None
+    try:
+        return factory.unpack(data)
+    except (TypeError, ValueError):
+        return None
+
+def callback_route(factory, *actions):
+    """Зарегистрировать обработчик кнопок factory с данными действиями.
+    Обработчик получает (callback, cb) или (callback, cb, state)"""
+    def register(handler):
+        wants_state = "state" in inspect.signature(handler).parameters
+        for action in actions:
+            key = (factory.__prefix__, action)
+            if key in CALLBACK_ROUTES:
+                raise ValueError(f"Кнопка {key} уже занята обработчиком {CALLBACK_ROUTES[key][0].__name__}")
+            CALLBACK_ROUTES[key] = (handler, wants_state)
+        return handler
+    return register
+
+@dp.callback_query()
+async def route_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Единая точка входа для всех кнопок: разбор и поиск обработчика в словаре"""
+    cb = parse_callback(callback.data)
+    route = CALLBACK_ROUTES.get((cb.__prefix__, cb.action)) if cb is not None else None
+    if route is None:
+        logger.warning(f"Неизвестная кнопка {callback.data!r} от {callback.from_user.id}")
+        await callback.answer("❌ Кнопка устарела")
+        return
+    
+    handler, wants_state = route
+    with metrics.timer("handler", handler.__name__):
+        if wants_state:
+            await handler(callback, cb, state)
+        else:
+            await handler(callback, cb)
+
+# ========== КЛАВИАТУРЫ И ШАБЛОНЫ ==========
+def button(text, callback_data=None, url=None):
+    return InlineKeyboardButton(text=text, callback_data=callback_data, url=url)
+
+def keyboard(*rows):
+    return InlineKeyboardMarkup(inline_keyboard=[list(row) for row in rows])
+
+MAIN_MENU_TEXT = (
+    "🪐 **Digi Store - Главное меню**\n\n"
+    "C помощью нашего магазина вы можете:\n"
+    "• ⭐️ Купить Telegram Stars\n"
+    "• 👑 Купить Telegram Premium\n"
+    "• 💱 Обменять рубли на доллары\n\n"
+    "Выберите действие:"
+)
+
+# Статичные клавиатуры строятся один раз. Объекты общие - не изменять!
+MAIN_MENU_KB = keyboard(
+    [button("⭐️ Купить звезды", CB_BUY_STARS)],
+    [button("👑 Купить премиум", CB_BUY_PREMIUM)],
+    [button("💱 Обмен валют", CB_EXCHANGE)],
+    [button("📊 Информация", CB_INFO)],
+    [button("🆘 Тех поддержка", url=f"https://t.me/{SUPPORT_USER}")]
+)
+
+BACK_TO_MAIN_KB = keyboard([button("🔙 Главное меню", CB_MAIN_MENU)])
+
+ADMIN_MENU_KB = keyboard(
+    [button("📦 Заказы", CB_ADMIN_ORDERS)],
+    [button("📊 Статистика", CB_ADMIN_STATS)],
+    [button("⏳ Ожидают проверки", CB_ADMIN_PENDING)],
+    [button("✅ Выполненные", CB_ADMIN_COMPLETED)],
+    [button("🔙 В меню", CB_MAIN_MENU)]
+)
+
+ADMIN_STATS_KB = keyboard(
+    [button("🔄 Обновить", CB_ADMIN_STATS)],
+    [button("🔙 Назад", CB_ADMIN_BACK)]
+)
+
+ADMIN_COMPLETED_KB = keyboard(
+    [button("🔄 Обновить", CB_ADMIN_COMPLETED)],
+    [button("🔙 Назад", CB_ADMIN_BACK)]
+)
+
+INFO_KB = keyboard(
+    [button("📈 Репутация", url=REPUTATION_CHANNEL)],
+    [button("📰 Новости", url=NEWS_CHANNEL)],
+    [button("🔙 Назад", CB_MAIN_MENU)]
+)
+
+BACK_KBS = {}
 
-# ========== КЛАВИАТУРЫ ==========
 def main_menu_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⭐️ Купить звезды", callback_data="buy_stars")],
-        [InlineKeyboardButton(text="👑 Купить премиум", callback_data="buy_premium")],
-        [InlineKeyboardButton(text="💱 Обмен валют", callback_data="exchange")],
-        [InlineKeyboardButton(text="📊 Информация", callback_data="info")],
-        [InlineKeyboardButton(text="🆘 Тех поддержка", url=f"https://t.me/{SUPPORT_USER}")]
-    ])
+    return MAIN_MENU_KB
 
 def back_to_main_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
-    ])
+    return BACK_TO_MAIN_KB
 
 def admin_menu_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📦 Заказы", callback_data="admin_orders")],
-        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="⏳ Ожидают проверки", callback_data="admin_pending")],
-        [InlineKeyboardButton(text="✅ Выполненные", callback_data="admin_completed")],
-        [InlineKeyboardButton(text="🔙 В меню", callback_data="main_menu")]
-    ])
+    return ADMIN_MENU_KB
+
+def back_kb(target):
+    # Целей немного (разделы меню) - храним все
+    kb = BACK_KBS.get(target)
+    if kb is None:
+        kb = BACK_KBS[target] = keyboard([button("🔙 Назад", target)])
+    return kb
+
+class Renderer:
+    """Тексты и клавиатуры, зависящие от цен/курсов и от заказа.
+    Ценовые собираются при старте и после invalidate(), клавиатуры заказов -
+    по шаблонам через LRU кэш"""
+    
+    # Шаблоны кнопок оплаты: (текст, действие PayCB)
+    CARD_BUTTON = ("💳 Перевод на карту", "card")
+    CARD_ONLY_BUTTON = ("💳 Оплатить картой", "card")
+    CRYPTO_BUTTON = ("💎 CryptoBot", "crypto")
+    CHECK_CRYPTO_BUTTON = ("✅ Проверить оплату", "check")
+    
+    def __init__(self, max_entries=RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.build_prices()
+    
+    def build_prices(self):
+        price_text = "".join(
+            f"• {value['name']}: {value['rub']:.2f} RUB\n" for value in PREMIUM_PRICES.values()
+        )
+        self.premium_text = (
+            "👑 **Покупка Telegram Premium**\n\n"
+            "Выберите период:\n\n"
+            f"{price_text}"
+        )
+        self.premium_kb = keyboard(
+            *([button(value["name"], MenuCB(action="period", arg=key).pack())] for key, value in PREMIUM_PRICES.items()),
+            [button("🔙 Назад", CB_MAIN_MENU)]
+        )
+        self.premium_period_texts = {
+            key: (
+                f"👑 **Telegram Premium - {value['name']}**\n\n"
+                f"Цена: **{value['rub']:.2f} RUB**\n\n"
+                "✏️ Введите username получателя (можно с @):"
+            )
+            for key, value in PREMIUM_PRICES.items()
+        }
+        self.stars_text = (
+            "⭐️ **Покупка Telegram Stars**\n\n"
+            f"Курс: **1 звезда = {STAR_RATE} RUB**\n"
+            "Диапазон: от 50 до 1,000,000 звезд\n\n"
+            "✏️ Введите username получателя (можно с @):"
+        )
+        self.exchange_text = (
+            "💱 **Обмен валют**\n\n"
+            f"Курс: **1 USD = {USD_RATE} RUB**\n\n"
+            "Введите сумму в рублях для обмена:\n"
+            "(Минимум: 100 RUB)\n\n"
+            "💳 **Оплата только картой!**"
+        )
+    
+    def invalidate(self):
+        """Цены или курсы изменились - пересобрать тексты и сбросить кэш"""
+        self.cache.clear()
+        self.build_prices()
+    
+    def _cached(self, key, build):
+        kb = self.cache.get(key)
+        if kb is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return kb
+        
+        self.misses += 1
+        kb = self.cache[key] = build()
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return kb
+    
+    @staticmethod
+    def order_button(template, order_id):
+        text, action = template
+        return button(text, PayCB(action=action, id=order_id).pack())
+    
+    def payment_kb(self, order_id, back, crypto=False):
+        """Выбор способа оплаты нового заказа (звезды/премиум)"""
+        def build():
+            rows = [[self.order_button(self.CARD_BUTTON, order_id)], [button("🔙 Назад", back)]]
+            if crypto:
+                rows.insert(0, [self.order_button(self.CRYPTO_BUTTON, order_id)])
+            return keyboard(*rows)
+        return self._cached(("payment", order_id, back, crypto), build)
+    
+    def card_only_kb(self, order_id, back):
+        """Обмен валют - только карта"""
+        return self._cached(("card_only", order_id, back), lambda: keyboard(
+            [self.order_button(self.CARD_ONLY_BUTTON, order_id)],
+            [button("🔙 Назад", back)]
+        ))
+    
+    def confirm_payment_kb(self, order_id):
+        return self._cached(("confirm_paid", order_id), lambda: keyboard(
+            [button("✅ Я оплатил", PayCB(action="paid", id=order_id).pack())],
+            [button("🔙 Главное меню", CB_MAIN_MENU)]
+        ))
+    
+    def cancel_photo_kb(self, order_id):
+        return self._cached(("cancel_photo", order_id), lambda: keyboard(
+            [button("🔙 Отмена", PayCB(action="cancel_photo", id=order_id).pack())]
+        ))
+    
+    def crypto_invoice_kb(self, order_id, pay_url):
+        return self._cached(("crypto_invoice", order_id, pay_url), lambda: keyboard(
+            [button("💎 Оплатить в CryptoBot", url=pay_url)],
+            [self.order_button(self.CHECK_CRYPTO_BUTTON, order_id)],
+            [button("🔙 Главное меню", CB_MAIN_MENU)]
+        ))
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+renderer = Renderer()
 
 def confirm_payment_kb(order_id):
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Я оплатил", callback_data=f"confirm_paid_{order_id}")],
-        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
-    ])
+    return renderer.confirm_payment_kb(order_id)
 
-def back_kb(target):
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data=target)]
-    ])
+def set_prices(star_rate=None, usd_rate=None, premium_prices=None):
+    """Сменить цены/курсы на лету (тексты и клавиатуры пересоберутся)"""
+    global STAR_RATE, USD_RATE, PREMIUM_PRICES
+    if star_rate is not None:
+        STAR_RATE = star_rate
+    if usd_rate is not None:
+        USD_RATE = usd_rate
+    if premium_prices is not None:
+        PREMIUM_PRICES = premium_prices
+    renderer.invalidate()
+
+# ========== КУРСЫ ==========
+class StaticRateSource:
+    """Фиксированные курсы (по умолчанию - из настроек). Заглушка для тестов и офлайна"""
+    name = "static"
+    
+    def __init__(self, rates):
+        self.rates = dict(rates)
+    
+    async def fetch(self):
+        return dict(self.rates)
+
+class FileRateSource:
+    """Курсы из JSON файла вида {"usd": 92.5, "star": 1.6}. Файл перечитывается только после изменения"""
+    name = "file"
+    
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._rates = {}
+    
+    def _read(self):
+        mtime = os.path.getmtime(self.path)
+        if mtime != self._mtime:
+            with open(self.path, encoding="utf-8") as f:
+                self._rates = json.load(f)
+            self._mtime = mtime
+        return dict(self._rates)
+    
+    async def fetch(self):
+        return await asyncio.to_thread(self._read)
+
+class CryptoPayRateSource:
+    """Курс USD из getExchangeRates Crypto Pay (USDT -> RUB) с наценкой магазина"""
+    name = "cryptopay"
+    
+    def __init__(self, api, markup=RATES_USD_MARKUP):
+        self.api = api
+        self.markup = markup
+    
+    async def fetch(self):
+        result = await self.api.get_exchange_rates(timeout=RATES_TIMEOUT)
+        if not result["success"]:
+            raise RuntimeError(result["error"])
+        
+        rate = result["rates"].get(("USDT", "RUB"))
+        if rate is None:
+            raise RuntimeError("нет курса USDT/RUB")
+        return {"usd": round(rate * (1 + self.markup), 2)}
+
+class RateProvider:
+    """Один источник курсов для всех расчетов цен. Курсы лежат в STAR_RATE/USD_RATE
+    (через set_prices) - обработчики читают их без ожидания. Фоновая задача обновляет
+    их раз в ttl, пока идет запрос (или источник лежит) действуют прежние значения"""
+    
+    RATES = {"usd": "usd_rate", "star": "star_rate"}  # курс -> аргумент set_prices
+    
+    def __init__(self, source, ttl=RATES_TTL, timeout=RATES_TIMEOUT):
+        self.source = source
+        self.ttl = ttl
+        self.timeout = timeout
+        self.updated_at = None  # time.time() последнего успешного обновления
+        self.refreshes = 0
+        self.errors = 0
+        self.last_error = None
+    
+    def current(self):
+        return {"usd": USD_RATE, "star": STAR_RATE}
+    
+    async def refresh(self):
+        """Запросить курсы у источника и применить изменившиеся. False - источник недоступен"""
+        try:
+            fetched = await asyncio.wait_for(self.source.fetch(), self.timeout)
+            # Неизвестные ключи и неположительные значения игнорируются
+            rates = {
+                name: float(value) for name, value in fetched.items()
+                if name in self.RATES and float(value) > 0
+            }
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            self.last_error = f"{type(e).__name__}: {e}"
+            logger.warning(f"Курсы ({self.source.name}) не обновлены, действуют прежние: {self.last_error}")
+            return False
+        
+        self.refreshes += 1
+        self.updated_at = time.time()
+        current = self.current()
+        changed = {name: value for name, value in rates.items() if value != current[name]}
+        if changed:
+            set_prices(**{self.RATES[name]: value for name, value in changed.items()})
+            logger.info(f"Курсы ({self.source.name}): " + ", ".join(
+                f"{name} {current[name]} -> {value}" for name, value in changed.items()
+            ))
+        return True
+    
+    async def run(self):
+        """Фоновое обновление (первое - refresh() при старте). После ошибки - повтор раньше срока"""
+        ok = self.updated_at is not None
+        while True:
+            await asyncio.sleep(self.ttl if ok else min(self.ttl, RATES_RETRY))
+            ok = await self.refresh()
+    
+    def stats(self):
+        return {
+            "source": self.source.name,
+            "age": time.time() - self.updated_at if self.updated_at else None,
+            "refreshes": self.refreshes,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            **self.current()
+        }
+
+def make_rate_source(kind=RATES_SOURCE):
+    if kind == "file":
+        return FileRateSource(RATES_FILE)
+    if kind == "cryptopay":
+        if cryptobot:
+            return CryptoPayRateSource(cryptobot)
+        logger.warning("RATES_SOURCE=cryptopay, но CryptoBot не настроен - курсы из настроек")
+    elif kind != "static":
+        logger.warning(f"Неизвестный RATES_SOURCE={kind} - курсы из настроек")
+    return StaticRateSource({"usd": USD_RATE, "star": STAR_RATE})
+
+rates = RateProvider(make_rate_source())
+
+# ========== УВЕДОМЛЕНИЯ АДМИНАМ ==========
+class AdminNotifier:
+    """Рассылка уведомлений всем админам: параллельно (не больше concurrency
+    отправок сразу), в фоне - обработчик не ждет доставки. Ошибки логируются"""
+    
+    def __init__(self, admin_ids, concurrency=ADMIN_NOTIFY_CONCURRENCY):
+        self.admin_ids = admin_ids
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+        self.sent = 0
+        self.failed = 0
+    
+    async def _deliver(self, admin_id, send, label):
+        send_priority.set(PRIORITY_NOTIFY)  # контекст своей задачи
+        async with self.semaphore:
+            try:
+                await send(admin_id)
+                self.sent += 1
+                return True
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"Уведомление ({label}) админу {admin_id} не доставлено: {e}")
+                return False
+    
+    async def send_all(self, send, label=""):
+        """send(admin_id) - корутина отправки одному админу.
+        Возвращает число админов, которым доставлено"""
+        results = await asyncio.gather(*(self._deliver(admin_id, send, label) for admin_id in self.admin_ids))
+        delivered = sum(results)
+        if self.admin_ids and not delivered:
+            logger.error(f"Уведомление ({label}) не доставлено ни одному админу")
+        return delivered
+    
+    def notify(self, send, label=""):
+        """Отправить в фоне"""
+        task = asyncio.create_task(self.send_all(send, label))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+    
+    async def drain(self, timeout=10):
+        """Дождаться недоставленных уведомлений (при остановке)"""
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=timeout)
+    
+    def stats(self):
+        return {"pending": len(self.tasks), "sent": self.sent, "failed": self.failed}
+
+admin_notifier = AdminNotifier(ADMIN_IDS)
+
+# Показатели насыщения для /metrics
+metrics.gauge("pido_updates_in_flight", "Апдейтов в обработке", lambda: update_metrics.in_flight)
+metrics.gauge("pido_db_pending_writes", "Записей в очереди писателя", db.pending_writes)
+metrics.gauge("pido_send_queue_depth", "Сообщений ждут отправки", lambda: outbound.stats()["depth"])
+metrics.gauge("pido_send_sent_total", "Отправлено сообщений", lambda: outbound.sent, "counter")
+metrics.gauge("pido_send_retries_total", "Повторов отправки", lambda: outbound.retries, "counter")
+metrics.gauge("pido_send_flood_waits_total", "Флуд-пауз Telegram", lambda: outbound.flood_waits, "counter")
+metrics.gauge("pido_send_failed_total", "Не отправлено после повторов", lambda: outbound.failed, "counter")
+metrics.gauge("pido_order_cache_entries", "Заказов в кэше", lambda: len(db.order_cache.entries))
+metrics.gauge("pido_fsm_cache_entries", "Состояний в памяти", lambda: fsm_storage.stats()["entries"])
+metrics.gauge("pido_admin_notify_pending", "Уведомлений админам в работе", lambda: len(admin_notifier.tasks))
 
 # ========== ОСНОВНЫЕ ОБРАБОТЧИКИ ==========
 @dp.message(CommandStart())
@@ -293,265 +2206,158 @@ async def cmd_start(message: types.Message):
     username = message.from_user.username or ""
     full_name = message.from_user.full_name
     
-    db.add_user(user_id, username, full_name)
-    
-    caption = (
-        "🪐 **Digi Store - Главное меню**\n\n"
-        "C помощью нашего магазина вы можете:\n"
-        "• ⭐️ Купить Telegram Stars\n"
-        "• 👑 Купить Telegram Premium\n"
-        "• 💱 Обменять рубли на доллары\n\n"
-        "Выберите действие:"
-    )
+    await db.add_user(user_id, username, full_name)
     
     await message.answer(
-        text=caption,
-        reply_markup=main_menu_kb(),
+        text=MAIN_MENU_TEXT,
+        reply_markup=MAIN_MENU_KB,
         parse_mode="Markdown"
     )
 
 async def show_main_menu(message: types.Message):
     """Показать главное меню"""
-    caption = (
-        "🪐 **Digi Store - Главное меню**\n\n"
-        "C помощью нашего магазина вы можете:\n"
-        "• ⭐️ Купить Telegram Stars\n"
-        "• 👑 Купить Telegram Premium\n"
-        "• 💱 Обменять рубли на доллары\n\n"
-        "Выберите действие:"
-    )
-    
     await message.answer(
-        text=caption,
-        reply_markup=main_menu_kb(),
+        text=MAIN_MENU_TEXT,
+        reply_markup=MAIN_MENU_KB,
         parse_mode="Markdown"
     )
 
 # ========== ВСЕ ОБРАБОТЧИКИ КНОПОК ==========
-@dp.callback_query(F.data == "main_menu")
-async def main_menu_handler(callback: types.CallbackQuery):
-    caption = (
-        "🪐 **Digi Store - Главное меню**\n\n"
-        "C помощью нашего магазина вы можете:\n"
-        "• ⭐️ Купить Telegram Stars\n"
-        "• 👑 Купить Telegram Premium\n"
-        "• 💱 Обменять рубли на доллары\n\n"
-        "Выберите действие:"
-    )
-    
+@callback_route(MenuCB, "main")
+async def main_menu_handler(callback: types.CallbackQuery, cb: MenuCB):
     await callback.message.edit_text(
-        text=caption,
-        reply_markup=main_menu_kb(),
+        text=MAIN_MENU_TEXT,
+        reply_markup=MAIN_MENU_KB,
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "buy_stars")
-async def buy_stars_handler(callback: types.CallbackQuery):
-    user_states[callback.from_user.id] = {"action": "waiting_stars_recipient"}
-    
-    caption = (
-        "⭐️ **Покупка Telegram Stars**\n\n"
-        f"Курс: **1 звезда = {STAR_RATE} RUB**\n"
-        "Диапазон: от 50 до 1,000,000 звезд\n\n"
-        "✏️ Введите username получателя (можно с @):"
-    )
+@callback_route(MenuCB, "stars")
+async def buy_stars_handler(callback: types.CallbackQuery, cb: MenuCB, state: FSMContext):
+    await set_user_state(state, "waiting_stars_recipient")
     
     await callback.message.edit_text(
-        text=caption,
-        reply_markup=back_kb("main_menu"),
+        text=renderer.stars_text,
+        reply_markup=back_kb(CB_MAIN_MENU),
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "buy_premium")
-async def buy_premium_handler(callback: types.CallbackQuery):
-    price_text = ""
-    for key, value in PREMIUM_PRICES.items():
-        price_text += f"• {value['name']}: {value['rub']:.2f} RUB\n"
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="3 месяца", callback_data="premium_3m")],
-        [InlineKeyboardButton(text="6 месяцев", callback_data="premium_6m")],
-        [InlineKeyboardButton(text="1 год", callback_data="premium_1y")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
-    ])
-    
-    caption = (
-        "👑 **Покупка Telegram Premium**\n\n"
-        "Выберите период:\n\n"
-        f"{price_text}"
-    )
-    
+@callback_route(MenuCB, "premium")
+async def buy_premium_handler(callback: types.CallbackQuery, cb: MenuCB):
     await callback.message.edit_text(
-        text=caption,
-        reply_markup=keyboard,
+        text=renderer.premium_text,
+        reply_markup=renderer.premium_kb,
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("premium_"))
-async def premium_period_handler(callback: types.CallbackQuery):
-    period = callback.data.replace("premium_", "")
+@callback_route(MenuCB, "period")
+async def premium_period_handler(callback: types.CallbackQuery, cb: MenuCB, state: FSMContext):
+    period = cb.arg
     
     if period in PREMIUM_PRICES:
-        user_states[callback.from_user.id] = {
-            "action": "waiting_premium_recipient",
-            "period": period,
-            "amount_rub": PREMIUM_PRICES[period]["rub"]
-        }
-        
-        caption = (
-            f"👑 **Telegram Premium - {PREMIUM_PRICES[period]['name']}**\n\n"
-            f"Цена: **{PREMIUM_PRICES[period]['rub']:.2f} RUB**\n\n"
-            "✏️ Введите username получателя (можно с @):"
+        await set_user_state(
+            state, "waiting_premium_recipient",
+            period=period,
+            amount_rub=PREMIUM_PRICES[period]["rub"]
         )
         
         await callback.message.edit_text(
-            text=caption,
-            reply_markup=back_kb("buy_premium"),
+            text=renderer.premium_period_texts[period],
+            reply_markup=back_kb(CB_BUY_PREMIUM),
             parse_mode="Markdown"
         )
     
     await callback.answer()
 
-@dp.callback_query(F.data == "exchange")
-async def exchange_handler(callback: types.CallbackQuery):
-    user_states[callback.from_user.id] = {"action": "waiting_exchange_amount"}
-    
-    caption = (
-        "💱 **Обмен валют**\n\n"
-        f"Курс: **1 USD = {USD_RATE} RUB**\n\n"
-        "Введите сумму в рублях для обмена:\n"
-        "(Минимум: 100 RUB)\n\n"
-        "💳 **Оплата только картой!**"
-    )
+@callback_route(MenuCB, "exchange")
+async def exchange_handler(callback: types.CallbackQuery, cb: MenuCB, state: FSMContext):
+    await set_user_state(state, "waiting_exchange_amount")
     
     await callback.message.edit_text(
-        text=caption,
-        reply_markup=back_kb("main_menu"),
+        text=renderer.exchange_text,
+        reply_markup=back_kb(CB_MAIN_MENU),
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "info")
-async def info_handler(callback: types.CallbackQuery):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📈 Репутация", url=REPUTATION_CHANNEL)],
-        [InlineKeyboardButton(text="📰 Новости", url=NEWS_CHANNEL)],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
-    ])
-    
+@callback_route(MenuCB, "info")
+async def info_handler(callback: types.CallbackQuery, cb: MenuCB):
     caption = "📊 **Информация**\n\nВыберите раздел:"
     
     await callback.message.edit_text(
         text=caption,
-        reply_markup=keyboard,
+        reply_markup=INFO_KB,
         parse_mode="Markdown"
     )
     await callback.answer()
 
 # ========== ОБРАБОТКА ФОТО ОПЛАТЫ ==========
 @dp.message(F.photo)
-async def handle_payment_photo(message: types.Message):
+async def handle_payment_photo(message: types.Message, state: FSMContext):
     """Обработка фото оплаты"""
-    user_id = message.from_user.id
+    action = await state.get_state()
     
-    if user_id not in user_states:
+    if action is None:
         await message.answer("Пожалуйста, используйте кнопки меню.")
         return
     
-    state = user_states[user_id]
-    
-    if state.get("action") == "waiting_payment_photo":
-        order_id = state.get("order_id")
-        order = db.get_order(order_id)
+    if action == "waiting_payment_photo":
+        order_id = (await state.get_data()).get("order_id")
+        order = await db.get_order(order_id)
         
         if not order:
             await message.answer("❌ Заказ не найден")
             return
         
-        user_id_db, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
-        
         # Получаем file_id фото
         photo_file_id = message.photo[-1].file_id
         
         # Сохраняем фото в базу
-        try:
-            details_dict = json.loads(details) if details else {}
-            details_dict["payment_photo"] = photo_file_id
-            db.add_payment_photo(order_id, photo_file_id)
-        except:
-            pass
+        await db.add_payment_photo(order_id, photo_file_id)
         
         # Обновляем статус
-        db.update_order_status(order_id, "waiting_confirmation")
+        await db.update_order_status(order_id, "waiting_confirmation")
         
         # Удаляем состояние
-        del user_states[user_id]
+        await state.clear()
         
-        # Уведомляем админа с фото
-        for admin_id in ADMIN_IDS:
-            try:
-                # Сначала отправляем фото
-                photo_caption = "📸 **Фото оплаты получено**"
-                
-                if order_type == "exchange":
-                    try:
-                        details_dict = json.loads(details) if details else {}
-                        amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                        photo_caption += f"\n💱 Обмен валют"
-                    except:
-                        photo_caption += f"\n💱 Обмен валют"
-                
-                await bot.send_photo(
-                    admin_id,
-                    photo=photo_file_id,
-                    caption=photo_caption
-                )
-                
-                # Затем отправляем детали заказа
-                admin_message = f"🆕 Ожидает проверки картой\n"
-                admin_message += f"🆔 Заказ: #{order_id}\n"
-                admin_message += f"👤 Пользователь: {message.from_user.username or 'Нет юзернейма'}\n"
-                admin_message += f"🆔 ID: {message.from_user.id}\n"
-                admin_message += f"💰 Сумма: {amount_rub:.2f} RUB\n"
-                admin_message += f"📦 Тип: {order_type}\n"
-                
-                if order_type == "exchange":
-                    try:
-                        details_dict = json.loads(details) if details else {}
-                        amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                        admin_message += f"💸 К выдаче: {amount_usd:.2f} USD\n"
-                    except:
-                        pass
-                else:
-                    admin_message += f"👤 Получатель: {recipient}\n"
-                
-                admin_message += f"\nДля проверки: /check_{order_id}"
-                
-                await bot.send_message(admin_id, admin_message)
-                
-            except Exception as e:
-                print(f"Ошибка отправки админу: {e}")
+        # Уведомляем админов с фото (в фоне, пользователь не ждет)
+        photo_caption = "📸 **Фото оплаты получено**"
+        if order.order_type == "exchange":
+            photo_caption += f"\n💱 Обмен валют"
+        
+        admin_message = f"🆕 Ожидает проверки картой\n"
+        admin_message += f"🆔 Заказ: #{order_id}\n"
+        admin_message += f"👤 Пользователь: {message.from_user.username or 'Нет юзернейма'}\n"
+        admin_message += f"🆔 ID: {message.from_user.id}\n"
+        admin_message += f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+        admin_message += f"📦 Тип: {order.order_type}\n"
+        
+        if order.order_type == "exchange":
+            admin_message += f"💸 К выдаче: {order.usd():.2f} USD\n"
+        else:
+            admin_message += f"👤 Получатель: {order.recipient}\n"
+        
+        admin_message += f"\nДля проверки: /check_{order_id}"
+        
+        async def send_to_admin(admin_id):
+            # Сначала фото, затем детали заказа
+            await bot.send_photo(admin_id, photo=photo_file_id, caption=photo_caption)
+            await bot.send_message(admin_id, admin_message)
+        
+        admin_notifier.notify(send_to_admin, f"фото оплаты #{order_id}")
         
         # Сообщение пользователю
-        if order_type == "exchange":
-            try:
-                details_dict = json.loads(details) if details else {}
-                amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                user_message = (
-                    f"✅ Фото оплаты получено!\n"
-                    f"💸 Вы получаете: {amount_usd:.2f} USD\n"
-                    f"💰 Оплачено: {amount_rub:.2f} RUB\n\n"
-                    "Заказ передан админу на проверку.\n"
-                    "После проверки USD будут отправлены вам в течение 15 минут - 3 часа."
-                )
-            except:
-                user_message = (
-                    "✅ Фото оплаты получено! Заказ передан админу на проверку.\n"
-                    "После проверки USD будут отправлены вам в течение 15 минут - 3 часа."
-                )
+        if order.order_type == "exchange":
+            user_message = (
+                f"✅ Фото оплаты получено!\n"
+                f"💸 Вы получаете: {order.usd():.2f} USD\n"
+                f"💰 Оплачено: {order.amount_rub:.2f} RUB\n\n"
+                "Заказ передан админу на проверку.\n"
+                "После проверки USD будут отправлены вам в течение 15 минут - 3 часа."
+            )
         else:
             user_message = (
                 "✅ Фото оплаты получено! Заказ передан админу на проверку.\n"
@@ -579,7 +2385,7 @@ async def admin_panel(message: types.Message):
         return
     
     # Получаем статистику
-    stats = db.get_statistics()
+    stats = await db.get_statistics()
     
     caption = (
         f"🛠️ **Админ панель**\n\n"
@@ -593,6 +2399,204 @@ async def admin_panel(message: types.Message):
     
     await message.answer(caption, reply_markup=admin_menu_kb(), parse_mode="Markdown")
 
+@dp.message(Command("recount"))
+async def recount_command(message: types.Message):
+    """Сверка счетчиков статистики с таблицами (и исправление)"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    mismatches = await db.check_counters(fix=True)
+    
+    if not mismatches:
+        await message.answer("✅ Счетчики статистики в порядке")
+        return
+    
+    text = "⚠️ **Счетчики расходились и пересчитаны:**\n\n"
+    for name, (value, expected) in sorted(mismatches.items()):
+        text += f"• {name}: {value:g} → {expected:g}\n"
+    
+    await message.answer(text, parse_mode="Markdown")
+
+# ========== РАССЫЛКА ==========
+# Рассылки, которые ведет этот процесс
+broadcast_tasks = {}
+
+def broadcast_progress_text(broadcast, started, done_at_start):
+    broadcast_id, text, status, last_user_id, total, sent, failed, blocked = broadcast[:8]
+    done = sent + failed + blocked
+    elapsed = max(time.monotonic() - started, 0.001)
+    rate = (done - done_at_start) / elapsed
+    left = max(total - done, 0)
+    eta = f"{left / rate / 60:.1f} мин" if rate > 0 and left else "—"
+    titles = {"running": "⏳ идет", "done": "✅ завершена", "cancelled": "🛑 остановлена"}
+    
+    return (
+        f"📣 **Рассылка #{broadcast_id}** - {titles.get(status, status)}\n\n"
+        f"📨 Отправлено: {sent} из {total}\n"
+        f"🚫 Заблокировали бота: {blocked}\n"
+        f"⚠️ Ошибок: {failed}\n"
+        f"⚡️ Скорость: {rate:.1f} сообщ/с\n"
+        f"⏱ Осталось: {eta}"
+    )
+
+async def send_broadcast_message(user_id, text, semaphore):
+    """Возвращает 'sent', 'blocked' или 'failed'"""
+    async with semaphore:
+        try:
+            await bot.send_message(user_id, text)
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramBadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "blocked"
+            logger.warning(f"Рассылка: пользователю {user_id} не отправлено: {e}")
+            return "failed"
+        except Exception as e:
+            logger.warning(f"Рассылка: пользователю {user_id} не отправлено: {e}")
+            return "failed"
+
+async def report_broadcast(broadcast, started, done_at_start):
+    chat_id, message_id = broadcast[8], broadcast[9]
+    if not chat_id or not message_id:
+        return
+    try:
+        await bot.edit_message_text(
+            broadcast_progress_text(broadcast, started, done_at_start),
+            chat_id=chat_id, message_id=message_id, parse_mode="Markdown"
+        )
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            logger.warning(f"Рассылка: прогресс не обновлен: {e}")
+
+async def broadcast_heartbeat(broadcast_id, interval=BROADCAST_HEARTBEAT):
+    """Отметка ведущего процесса по таймеру: пачка при медленной отправке (кластер
+    делит TG_GLOBAL_RATE между воркерами) может идти дольше BROADCAST_STALE"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await db.touch_broadcast(broadcast_id)
+        except Exception as e:
+            logger.warning(f"Рассылка #{broadcast_id}: отметка не сохранена: {e}")
+
+async def run_broadcast(broadcast_id):
+    """Отправить рассылку с места, где она остановилась. Пачки читаются
+    потоком по user_id, прогресс сохраняется после каждой пачки"""
+    send_priority.set(PRIORITY_BULK)  # заказы и уведомления идут вперед
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    broadcast = await db.get_broadcast(broadcast_id)
+    text, last_user_id = broadcast[1], broadcast[3]
+    done_at_start = sum(broadcast[5:8])
+    started = time.monotonic()
+    reported = 0.0
+    logger.info(f"Рассылка #{broadcast_id}: старт с user_id > {last_user_id}")
+    heartbeat = asyncio.create_task(broadcast_heartbeat(broadcast_id))
+    
+    try:
+        while True:
+            recipients = await db.get_broadcast_recipients(last_user_id)
+            if not recipients:
+                await db.finish_broadcast(broadcast_id, "done")
+                break
+            
+            results = await asyncio.gather(*(
+                send_broadcast_message(user_id, text, semaphore) for user_id in recipients
+            ))
+            last_user_id = recipients[-1]
+            blocked_ids = [user_id for user_id, result in zip(recipients, results) if result == "blocked"]
+            await db.save_broadcast_progress(
+                broadcast_id, last_user_id,
+                results.count("sent"), results.count("failed"), blocked_ids
+            )
+            
+            broadcast = await db.get_broadcast(broadcast_id)
+            if broadcast[2] != "running":
+                break  # остановлена командой
+            
+            if time.monotonic() - reported >= BROADCAST_REPORT_INTERVAL:
+                reported = time.monotonic()
+                await report_broadcast(broadcast, started, done_at_start)
+    finally:
+        heartbeat.cancel()
+        broadcast_tasks.pop(broadcast_id, None)
+    
+    broadcast = await db.get_broadcast(broadcast_id)
+    logger.info(f"Рассылка #{broadcast_id}: {broadcast[2]}, отправлено {broadcast[5]} из {broadcast[4]}")
+    await report_broadcast(broadcast, started, done_at_start)
+
+def start_broadcast_task(broadcast_id):
+    task = asyncio.create_task(run_broadcast(broadcast_id))
+    broadcast_tasks[broadcast_id] = task
+    return task
+
+async def resume_broadcasts():
+    """После перезапуска подхватить брошенные рассылки"""
+    for broadcast_id in await db.get_running_broadcasts():
+        if broadcast_id in broadcast_tasks:
+            continue
+        if await db.claim_broadcast(broadcast_id, time.time() - BROADCAST_STALE):
+            start_broadcast_task(broadcast_id)
+
+async def broadcast_watchdog(interval=BROADCAST_STALE):
+    """Фоновая задача: продолжить рассылки, оставшиеся без процесса"""
+    while True:
+        try:
+            await resume_broadcasts()
+        except Exception as e:
+            logger.warning(f"Рассылка: ошибка проверки: {e}")
+        await asyncio.sleep(interval)
+
+@dp.message(Command("broadcast"))
+async def broadcast_command(message: types.Message, command: CommandObject):
+    """Рассылка всем пользователям: /broadcast текст"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    if not command.args:
+        await message.answer(
+            "📣 Формат: /broadcast текст сообщения\n"
+            "/broadcast_status - прогресс, /broadcast_stop - остановить"
+        )
+        return
+    
+    if await db.get_running_broadcasts():
+        await message.answer("⏳ Уже идет рассылка. /broadcast_status - прогресс")
+        return
+    
+    report = await message.answer("📣 Рассылка запускается...")
+    broadcast_id = await db.create_broadcast(command.args, report.chat.id, report.message_id)
+    start_broadcast_task(broadcast_id)
+
+@dp.message(Command("broadcast_status"))
+async def broadcast_status_command(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    broadcast = await db.get_broadcast()
+    if not broadcast:
+        await message.answer("📣 Рассылок еще не было")
+        return
+    
+    # Скорость - по этому процессу не известна, показываем только счетчики
+    await message.answer(
+        broadcast_progress_text(broadcast, time.monotonic(), sum(broadcast[5:8])),
+        parse_mode="Markdown"
+    )
+
+@dp.message(Command("broadcast_stop"))
+async def broadcast_stop_command(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    running = await db.get_running_broadcasts()
+    for broadcast_id in running:
+        await db.finish_broadcast(broadcast_id, "cancelled")
+    
+    if running:
+        await message.answer(f"🛑 Рассылка #{running[-1]} останавливается (после текущей пачки)")
+    else:
+        await message.answer("📣 Нет активной рассылки")
+
 # ========== СТАРЫЕ ФОРМАТЫ КОМАНД (для совместимости) ==========
 @dp.message(F.text.startswith("/check_"))
 async def check_order_command_old(message: types.Message):
@@ -601,137 +2605,121 @@ async def check_order_command_old(message: types.Message):
         return
     
     try:
-        order_id = int(message.text.split("_")[1])
-        order = db.get_order(order_id)
-        
-        if not order:
-            await message.answer(f"❌ Заказ #{order_id} не найден")
-            return
-        
-        user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
-        
-        # Получаем дополнительные данные
-        details_dict = {}
-        amount_usd = 0
-        stars_count = 0
-        period_name = ""
-        
-        try:
-            if details:
-                details_dict = json.loads(details)
-                if order_type == "exchange":
-                    amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                elif order_type == "stars":
-                    stars_count = details_dict.get("stars", 0)
-                elif order_type == "premium":
-                    period = details_dict.get("period", "")
-                    period_name = PREMIUM_PRICES.get(period, {}).get("name", "")
-        except:
-            pass
-        
-        # Формируем текст
-        text = (
-            f"🔍 **Заказ #{order_id}**\n\n"
-            f"👤 User ID: `{user_id}`\n"
-            f"📦 Тип: {order_type}\n"
-        )
-        
-        if order_type == "stars":
-            text += f"⭐️ Количество: {stars_count} звезд\n"
-        elif order_type == "premium":
-            text += f"👑 Период: {period_name}\n"
-        elif order_type == "exchange":
-            text += f"💸 К выдаче: {amount_usd:.2f} USD\n"
-        
-        if order_type != "exchange" and recipient:
-            text += f"👤 Получатель: @{recipient}\n"
-        
-        text += (
-            f"💰 Сумма: {amount_rub:.2f} RUB\n"
-            f"💳 Метод: {payment_method}\n"
-            f"📊 Статус: {status}\n\n"
-            "**Управление заказом:**"
-        )
-        
-        # Кнопки управления в зависимости от статуса
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-        
-        if status == "waiting_confirmation":
-            # Заказ ожидает проверки фото
-            keyboard.inline_keyboard = [
-                [
-                    InlineKeyboardButton(text="✅ Подтвердить оплату", callback_data=f"order_confirm_{order_id}"),
-                    InlineKeyboardButton(text="❌ Отклонить", callback_data=f"order_reject_{order_id}")
-                ],
-                [
-                    InlineKeyboardButton(text="📦 Выполнить заказ", callback_data=f"order_complete_{order_id}"),
-                    InlineKeyboardButton(text="💬 Написать пользователю", callback_data=f"order_msg_{order_id}")
-                ],
-                [
-                    InlineKeyboardButton(text="🔄 Обновить", callback_data=f"order_refresh_{order_id}"),
-                    InlineKeyboardButton(text="🔙 К заказам", callback_data="admin_orders")
-                ]
+        order_id = int(message.text.split("_")[1])
+    except (ValueError, IndexError):
+        await message.answer("❌ Формат: /check_123")
+        return
+    
+    await send_order_card(message, order_id)
+
+async def send_order_card(message: types.Message, order_id):
+    """Карточка заказа для админа (/check): детали, кнопки управления, фото оплаты"""
+    order = await db.get_order(order_id)
+    
+    if not order:
+        await message.answer(f"❌ Заказ #{order_id} не найден")
+        return
+    
+    # Формируем текст
+    text = (
+        f"🔍 **Заказ #{order_id}**\n\n"
+        f"👤 User ID: `{order.user_id}`\n"
+        f"📦 Тип: {order.order_type}\n"
+    )
+    
+    if order.order_type == "stars":
+        text += f"⭐️ Количество: {order.stars or 0} звезд\n"
+    elif order.order_type == "premium":
+        text += f"👑 Период: {order.period_name}\n"
+    elif order.order_type == "exchange":
+        text += f"💸 К выдаче: {order.usd():.2f} USD\n"
+    
+    if order.order_type != "exchange" and order.recipient:
+        text += f"👤 Получатель: @{order.recipient}\n"
+    
+    text += (
+        f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+        f"💳 Метод: {order.payment_method}\n"
+        f"📊 Статус: {order.status}\n\n"
+        "**Управление заказом:**"
+    )
+    
+    # Кнопки управления в зависимости от статуса
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    
+    if order.status == "waiting_confirmation":
+        # Заказ ожидает проверки фото
+        keyboard.inline_keyboard = [
+            [
+                InlineKeyboardButton(text="✅ Подтвердить оплату", callback_data=OrderCB(action="confirm", id=order_id).pack()),
+                InlineKeyboardButton(text="❌ Отклонить", callback_data=OrderCB(action="reject", id=order_id).pack())
+            ],
+            [
+                InlineKeyboardButton(text="📦 Выполнить заказ", callback_data=OrderCB(action="complete", id=order_id).pack()),
+                InlineKeyboardButton(text="💬 Написать пользователю", callback_data=OrderCB(action="msg", id=order_id).pack())
+            ],
+            [
+                InlineKeyboardButton(text="🔄 Обновить", callback_data=OrderCB(action="refresh", id=order_id).pack()),
+                InlineKeyboardButton(text="🔙 К заказам", callback_data=CB_ADMIN_ORDERS)
             ]
-        elif status == "waiting_crypto":
-            # CryptoBot оплата
-            keyboard.inline_keyboard = [
-                [
-                    InlineKeyboardButton(text="✅ Проверить оплату", callback_data=f"check_crypto_{order_id}"),
-                    InlineKeyboardButton(text="🔁 Статус", callback_data=f"crypto_status_{order_id}")
-                ],
-                [
-                    InlineKeyboardButton(text="📦 Выполнить заказ", callback_data=f"order_complete_{order_id}"),
-                    InlineKeyboardButton(text="❌ Отменить", callback_data=f"order_cancel_{order_id}")
-                ],
-                [
-                    InlineKeyboardButton(text="💬 Написать пользователю", callback_data=f"order_msg_{order_id}"),
-                    InlineKeyboardButton(text="🔙 К заказам", callback_data="admin_orders")
-                ]
+        ]
+    elif order.status == "waiting_crypto":
+        # CryptoBot оплата
+        keyboard.inline_keyboard = [
+            [
+                InlineKeyboardButton(text="✅ Проверить оплату", callback_data=PayCB(action="check", id=order_id).pack()),
+                InlineKeyboardButton(text="🔁 Статус", callback_data=OrderCB(action="crypto_status", id=order_id).pack())
+            ],
+            [
+                InlineKeyboardButton(text="📦 Выполнить заказ", callback_data=OrderCB(action="complete", id=order_id).pack()),
+                InlineKeyboardButton(text="❌ Отменить", callback_data=OrderCB(action="cancel", id=order_id).pack())
+            ],
+            [
+                InlineKeyboardButton(text="💬 Написать пользователю", callback_data=OrderCB(action="msg", id=order_id).pack()),
+                InlineKeyboardButton(text="🔙 К заказам", callback_data=CB_ADMIN_ORDERS)
             ]
-        elif status == "confirmed":
-            # Заказ подтвержден, нужно выполнить
-            keyboard.inline_keyboard = [
-                [
-                    InlineKeyboardButton(text="📦 Выполнить заказ", callback_data=f"order_complete_{order_id}"),
-                    InlineKeyboardButton(text="✅ Пометить выполненным", callback_data=f"order_finish_{order_id}")
-                ],
-                [
-                    InlineKeyboardButton(text="💬 Написать пользователю", callback_data=f"order_msg_{order_id}"),
-                    InlineKeyboardButton(text="🔙 К заказам", callback_data="admin_orders")
-                ]
+        ]
+    elif order.status == "confirmed":
+        # Заказ подтвержден, нужно выполнить
+        keyboard.inline_keyboard = [
+            [
+                InlineKeyboardButton(text="📦 Выполнить заказ", callback_data=OrderCB(action="complete", id=order_id).pack()),
+                InlineKeyboardButton(text="✅ Пометить выполненным", callback_data=OrderCB(action="finish", id=order_id).pack())
+            ],
+            [
+                InlineKeyboardButton(text="💬 Написать пользователю", callback_data=OrderCB(action="msg", id=order_id).pack()),
+                InlineKeyboardButton(text="🔙 К заказам", callback_data=CB_ADMIN_ORDERS)
             ]
-        else:
-            # Другие статусы
-            keyboard.inline_keyboard = [
-                [
-                    InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"order_confirm_{order_id}"),
-                    InlineKeyboardButton(text="❌ Отменить", callback_data=f"order_cancel_{order_id}")
-                ],
-                [
-                    InlineKeyboardButton(text="📦 Выполнить", callback_data=f"order_complete_{order_id}"),
-                    InlineKeyboardButton(text="💬 Написать", callback_data=f"order_msg_{order_id}")
-                ],
-                [
-                    InlineKeyboardButton(text="🔄 Обновить", callback_data=f"order_refresh_{order_id}"),
-                    InlineKeyboardButton(text="🔙 К заказам", callback_data="admin_orders")
-                ]
+        ]
+    else:
+        # Другие статусы
+        keyboard.inline_keyboard = [
+            [
+                InlineKeyboardButton(text="✅ Подтвердить", callback_data=OrderCB(action="confirm", id=order_id).pack()),
+                InlineKeyboardButton(text="❌ Отменить", callback_data=OrderCB(action="cancel", id=order_id).pack())
+            ],
+            [
+                InlineKeyboardButton(text="📦 Выполнить", callback_data=OrderCB(action="complete", id=order_id).pack()),
+                InlineKeyboardButton(text="💬 Написать", callback_data=OrderCB(action="msg", id=order_id).pack())
+            ],
+            [
+                InlineKeyboardButton(text="🔄 Обновить", callback_data=OrderCB(action="refresh", id=order_id).pack()),
+                InlineKeyboardButton(text="🔙 К заказам", callback_data=CB_ADMIN_ORDERS)
             ]
-        
-        await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
-        
-        # Показываем фото оплаты если есть
-        try:
-            if details and "payment_photo" in details_dict:
-                await bot.send_photo(
-                    message.chat.id,
-                    photo=details_dict["payment_photo"],
-                    caption=f"📸 Фото оплаты заказа #{order_id}"
-                )
-        except:
-            pass
+        ]
     
-    except (ValueError, IndexError):
-        await message.answer("❌ Формат: /check_123")
+    await message.answer(text, reply_markup=keyboard, parse_mode="Markdown")
+    
+    # Показываем фото оплаты если есть
+    try:
+        if order.payment_photo:
+            await bot.send_photo(
+                message.chat.id,
+                photo=order.payment_photo,
+                caption=f"📸 Фото оплаты заказа #{order_id}"
+            )
+    except Exception as e:
+        logger.warning(f"Фото оплаты заказа #{order_id} не отправлено: {e}")
 
 # НОВЫЕ КОМАНДЫ С АРГУМЕНТАМИ
 @dp.message(Command("check"))
@@ -746,10 +2734,11 @@ async def check_order_command_new(message: types.Message, command: CommandObject
     
     try:
         order_id = int(command.args)
-        # Вызываем старую функцию для обработки
-        await check_order_command_old(message)
     except ValueError:
         await message.answer("❌ Неверный номер заказа")
+        return
+    
+    await send_order_card(message, order_id)
 
 # СТАРЫЕ КОМАНДЫ АДМИНА (для совместимости)
 @dp.message(F.text.startswith("/confirm_"))
@@ -760,7 +2749,7 @@ async def confirm_order_command_old(message: types.Message):
     
     try:
         order_id = int(message.text.split("_")[1])
-        success = db.update_order_status(order_id, "completed")
+        success = await db.update_order_status(order_id, "completed")
         
         if success:
             await message.answer(f"✅ Заказ #{order_id} подтвержден")
@@ -778,7 +2767,7 @@ async def complete_order_command_old(message: types.Message):
     
     try:
         order_id = int(message.text.split("_")[1])
-        success = db.update_order_status(order_id, "completed")
+        success = await db.update_order_status(order_id, "completed")
         
         if success:
             await message.answer(f"✅ Заказ #{order_id} выполнен")
@@ -796,7 +2785,7 @@ async def cancel_order_command_old(message: types.Message):
     
     try:
         order_id = int(message.text.split("_")[1])
-        success = db.update_order_status(order_id, "cancelled")
+        success = await db.update_order_status(order_id, "cancelled")
         
         if success:
             await message.answer(f"❌ Заказ #{order_id} отменен")
@@ -819,7 +2808,7 @@ async def confirm_order_cmd_new(message: types.Message, command: CommandObject):
     
     try:
         order_id = int(command.args)
-        success = db.update_order_status(order_id, "completed")
+        success = await db.update_order_status(order_id, "completed")
         
         if success:
             await message.answer(f"✅ Заказ #{order_id} подтвержден")
@@ -840,7 +2829,7 @@ async def complete_order_cmd_new(message: types.Message, command: CommandObject)
     
     try:
         order_id = int(command.args)
-        success = db.update_order_status(order_id, "completed")
+        success = await db.update_order_status(order_id, "completed")
         
         if success:
             await message.answer(f"✅ Заказ #{order_id} выполнен")
@@ -861,7 +2850,7 @@ async def cancel_order_cmd_new(message: types.Message, command: CommandObject):
     
     try:
         order_id = int(command.args)
-        success = db.update_order_status(order_id, "cancelled")
+        success = await db.update_order_status(order_id, "cancelled")
         
         if success:
             await message.answer(f"❌ Заказ #{order_id} отменен")
@@ -871,24 +2860,22 @@ async def cancel_order_cmd_new(message: types.Message, command: CommandObject):
         await message.answer("❌ Неверный номер заказа")
 
 # ========== ОПЛАТА КАРТОЙ ==========
-@dp.callback_query(F.data.startswith("card_pay_"))
-async def card_payment_handler(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("card_pay_", ""))
-    order = db.get_order(order_id)
+@callback_route(PayCB, "card")
+async def card_payment_handler(callback: types.CallbackQuery, cb: PayCB):
+    order_id = cb.id
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
-    
     # Обновляем статус
-    db.update_order_status(order_id, "waiting_payment")
+    await db.update_order_status(order_id, "waiting_payment")
     
     caption = (
         f"💳 **Оплата картой**\n\n"
         f"🆔 Заказ: #{order_id}\n"
-        f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
+        f"💰 Сумма: {order.amount_rub:.2f} RUB\n\n"
         f"**Реквизиты для перевода:**\n"
         f"`{CARD_NUMBER}`\n\n"
         "**Инструкция:**\n"
@@ -907,41 +2894,170 @@ async def card_payment_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
+# ========== СЧЕТА CRYPTOBOT ==========
+class InvoiceCoordinator:
+    """Прослойка над CryptoBotAPI: у заказа один активный счет, одинаковые
+    одновременные запросы идут в API одним вызовом, статусы - в коротком кэше"""
+    
+    FINAL_STATUSES = ("paid", "expired")
+    
+    def __init__(self, api, status_ttl=CRYPTO_STATUS_TTL, final_ttl=CRYPTO_FINAL_TTL,
+                 max_entries=CRYPTO_STATUS_CACHE_SIZE):
+        self.api = api
+        self.status_ttl = status_ttl
+        self.final_ttl = final_ttl
+        self.max_entries = max_entries
+        self.statuses = OrderedDict()  # invoice_id -> (результат check_invoice_status, истекает)
+        self.inflight = {}  # ключ -> задача, которую ждут все одинаковые запросы
+        self.api_calls = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.reused = 0
+    
+    async def _single_flight(self, key, make):
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.ensure_future(make())
+            task.add_done_callback(lambda done: self.inflight.pop(key, None) if self.inflight.get(key) is done else None)
+        else:
+            self.coalesced += 1
+        # shield: отмена одного ожидающего не отменяет запрос остальным
+        return await asyncio.shield(task)
+    
+    def remember(self, invoice_id, info):
+        """Положить известный статус счета в кэш (поллер, вебхук, новый счет)"""
+        key = str(invoice_id)
+        ttl = self.final_ttl if info.get("status") in self.FINAL_STATUSES else self.status_ttl
+        self.statuses[key] = ({"success": True, **info}, time.monotonic() + ttl)
+        self.statuses.move_to_end(key)
+        if len(self.statuses) > self.max_entries:
+            self.statuses.popitem(last=False)
+    
+    def cached_status(self, invoice_id):
+        key = str(invoice_id)
+        entry = self.statuses.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self.statuses[key]
+            return None
+        return entry[0]
+    
+    async def status(self, invoice_id):
+        """То же, что check_invoice_status, но из кэша или общим запросом"""
+        cached = self.cached_status(invoice_id)
+        if cached is not None:
+            self.cache_hits += 1
+            return cached
+        
+        async def fetch():
+            self.api_calls += 1
+            result = await self.api.check_invoice_status(invoice_id)
+            if result["success"]:
+                self.remember(invoice_id, {k: v for k, v in result.items() if k != "success"})
+            return result
+        
+        return await self._single_flight(("status", str(invoice_id)), fetch)
+    
+    async def get_or_create(self, order, amount_usdt, description):
+        """Действующий счет заказа или новый. Ответ как у create_invoice
+        плюс status ("active"/"paid") и reused"""
+        async def obtain():
+            if order.invoice_id:
+                current = await self.status(order.invoice_id)
+                if not current["success"]:
+                    # Не знаем, жив ли старый счет - второй не выставляем
+                    return current
+                if current["status"] != "expired" and current.get("pay_url"):
+                    self.reused += 1
+                    # Заказ могли перевести на карту - поллер и вебхук завершают только waiting_crypto
+                    if order.status in ("pending", "waiting_payment"):
+                        await db.update_order_status(order.id, "waiting_crypto", from_status=order.status)
+                    return {
+                        "success": True,
+                        "invoice_id": str(order.invoice_id),
+                        "pay_url": current["pay_url"],
+                        "amount": current["amount"],
+                        "status": current["status"],
+                        "reused": True
+                    }
+            
+            self.api_calls += 1
+            result = await self.api.create_invoice(amount_usdt=amount_usdt, description=description)
+            if not result["success"]:
+                return result
+            
+            await db.update_invoice_id(order.id, result["invoice_id"])
+            await db.update_order_status(order.id, "waiting_crypto")
+            self.remember(result["invoice_id"], {
+                "status": "active", "paid_at": None, "amount": result["amount"], "pay_url": result["pay_url"]
+            })
+            return {**result, "status": "active", "reused": False}
+        
+        return await self._single_flight(("order", order.id), obtain)
+    
+    def stats(self):
+        return {
+            "entries": len(self.statuses),
+            "inflight": len(self.inflight),
+            "api_calls": self.api_calls,
+            "cache_hits": self.cache_hits,
+            "coalesced": self.coalesced,
+            "reused": self.reused
+        }
+
+invoices = InvoiceCoordinator(cryptobot) if cryptobot else None
+
+if invoices:
+    metrics.gauge("pido_crypto_api_calls_total", "Запросов счетов к Crypto Pay", lambda: invoices.api_calls, "counter")
+    metrics.gauge("pido_crypto_cache_hits_total", "Статусов счетов из кэша", lambda: invoices.cache_hits, "counter")
+    metrics.gauge("pido_crypto_coalesced_total", "Запросов, слитых с уже идущим", lambda: invoices.coalesced, "counter")
+    metrics.gauge("pido_crypto_circuit_open", "Предохранитель Crypto Pay разомкнут",
+                  lambda: int(not cryptobot.breaker.available))
+    metrics.gauge("pido_crypto_rejected_total", "Вызовов Crypto Pay отклонено сразу",
+                  lambda: cryptobot.breaker.rejected + cryptobot.overloaded, "counter")
+    metrics.gauge("pido_crypto_retries_total", "Повторов вызовов Crypto Pay", lambda: cryptobot.retries, "counter")
+
 # ========== ОПЛАТА CRYPTOBOT ==========
-@dp.callback_query(F.data.startswith("crypto_pay_"))
-async def crypto_payment_handler(callback: types.CallbackQuery):
-    if not cryptobot:
+@callback_route(PayCB, "crypto")
+async def crypto_payment_handler(callback: types.CallbackQuery, cb: PayCB):
+    if not crypto_available():
         await callback.answer("❌ CryptoBot временно недоступен")
         return
     
-    order_id = int(callback.data.replace("crypto_pay_", ""))
-    order = db.get_order(order_id)
+    order_id = cb.id
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
+    if order.status not in ("pending", "waiting_payment", "waiting_crypto"):
+        await callback.answer("❌ Заказ уже оплачен или закрыт")
+        return
+    
+    # Сумма в USDT по текущему курсу - для нового счета
+    amount_usdt = order.amount_rub / USD_RATE
     
-    # Создаем счет в CryptoBot
-    result = await cryptobot.create_invoice(
-        amount=amount_rub,
-        description=f"Заказ #{order_id} | {order_type}"
+    # Действующий счет заказа или новый (повторные нажатия не плодят счета)
+    result = await invoices.get_or_create(
+        order,
+        amount_usdt=amount_usdt,
+        description=f"Заказ #{order_id} | {order.order_type}"
     )
     
+    if result["success"] and result["status"] == "paid":
+        await callback.answer("✅ Счет уже оплачен, нажмите '✅ Проверить оплату'", show_alert=True)
+        return
+    
     if result["success"]:
-        # Сохраняем invoice_id
-        db.update_invoice_id(order_id, result["invoice_id"])
-        db.update_order_status(order_id, "waiting_crypto")
-        
-        # Рассчитываем USDT сумму
-        amount_usdt = amount_rub / 85.0
+        crypto_poll_wakeup.set()
         
         caption = (
             f"💎 **Оплата через CryptoBot**\n\n"
             f"🆔 Заказ: #{order_id}\n"
-            f"💰 Сумма: {amount_rub:.2f} RUB\n"
-            f"💱 К оплате: {amount_usdt:.2f} USDT\n\n"
+            f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+            f"💱 К оплате: {float(result['amount']):.2f} USDT\n\n"
             "**Для оплаты:**\n"
             "1. Нажмите кнопку ниже\n"
             "2. Оплатите счет в CryptoBot\n"
@@ -949,15 +3065,9 @@ async def crypto_payment_handler(callback: types.CallbackQuery):
             "✅ Оплата проверяется автоматически, товар доставляется в течение 15 минут - 3 часа"
         )
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💎 Оплатить в CryptoBot", url=result["pay_url"])],
-            [InlineKeyboardButton(text="✅ Проверить оплату", callback_data=f"check_crypto_{order_id}")],
-            [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
-        ])
-        
         await callback.message.edit_text(
             text=caption,
-            reply_markup=keyboard,
+            reply_markup=renderer.crypto_invoice_kb(order_id, result["pay_url"]),
             parse_mode="Markdown"
         )
     else:
@@ -966,83 +3076,134 @@ async def crypto_payment_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # ========== ПРОВЕРКА CRYPTOBOT ОПЛАТЫ (ИСПРАВЛЕННАЯ) ==========
-@dp.callback_query(F.data.startswith("check_crypto_"))
-async def check_crypto_payment(callback: types.CallbackQuery):
-    if not cryptobot:
+async def notify_crypto_paid(order_id, user_id, order_type, recipient, amount_rub):
+    """Уведомления об оплаченном CryptoBot заказе (админам и пользователю)"""
+    # Уведомляем админов в фоне
+    admin_message = (
+        f"💎 **CryptoBot оплата ПОДТВЕРЖДЕНА**\n\n"
+        f"🆔 Заказ: #{order_id}\n"
+        f"💰 Сумма: {amount_rub:.2f} RUB\n"
+        f"📦 Тип: {order_type}\n"
+    )
+    
+    if order_type != "exchange":
+        admin_message += f"👤 Получатель: {recipient}\n"
+    
+    admin_message += f"\n✅ Статус: ОПЛАЧЕНО"
+    
+    admin_notifier.notify(
+        lambda admin_id: bot.send_message(admin_id, admin_message),
+        f"CryptoBot оплата #{order_id}"
+    )
+    
+    # Уведомляем пользователя
+    try:
+        await bot.send_message(
+            user_id,
+            f"✅ **Оплата подтверждена!**\n\n"
+            f"🆔 Ваш заказ: #{order_id}\n"
+            f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
+            f"Товар будет отправлен в течение 15 минут - 3 часа!"
+        )
+    except Exception as e:
+        logger.warning(f"Уведомление об оплате #{order_id} пользователю {user_id} не доставлено: {e}")
+
+async def complete_crypto_order(order_id, user_id, order_type, recipient, amount_rub):
+    """Завершить оплаченный CryptoBot заказ. Повторный вызов ничего не делает"""
+    if not await db.update_order_status(order_id, "completed", from_status="waiting_crypto"):
+        return False
+    
+    await notify_crypto_paid(order_id, user_id, order_type, recipient, amount_rub)
+    return True
+
+# Счета заказов вне waiting_crypto, по которым все ясно (оплата доложена или счет просрочен)
+stray_crypto_done = set()
+
+def report_stray_crypto_payment(order, invoice_id):
+    """Счет оплачен, а заказ уже не ждет CryptoBot - сам не завершится, нужен админ"""
+    invoice_id = str(invoice_id)
+    if invoice_id in stray_crypto_done:
+        return
+    stray_crypto_done.add(invoice_id)
+    
+    logger.warning(f"CryptoBot: счет {invoice_id} оплачен, но заказ #{order.id} в статусе {order.status}")
+    admin_message = (
+        f"⚠️ CryptoBot: оплачен счет заказа, который не ждет оплаты\n\n"
+        f"🆔 Заказ: #{order.id}\n"
+        f"🧾 Счет: {invoice_id}\n"
+        f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+        f"📌 Статус заказа: {order.status}\n\n"
+        f"Автоматически заказ не завершен - проверьте вручную."
+    )
+    admin_notifier.notify(
+        lambda admin_id: bot.send_message(admin_id, admin_message),
+        f"CryptoBot оплата вне ожидания #{order.id}"
+    )
+
+async def notify_crypto_expired(order_id, user_id):
+    """Уведомить пользователя о просроченном счете"""
+    try:
+        await bot.send_message(
+            user_id,
+            f"❌ Счет по заказу #{order_id} просрочен, заказ отменен.\n"
+            f"Вы можете оформить новый заказ в главном меню."
+        )
+    except Exception as e:
+        logger.warning(f"Уведомление о просрочке #{order_id} пользователю {user_id} не доставлено: {e}")
+
+@callback_route(PayCB, "check")
+async def check_crypto_payment(callback: types.CallbackQuery, cb: PayCB):
+    if not crypto_available():
         await callback.answer("❌ CryptoBot временно недоступен")
         return
     
-    order_id = int(callback.data.replace("check_crypto_", ""))
-    order = db.get_order(order_id)
+    order_id = cb.id
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
-    
-    if not invoice_id:
+    if not order.invoice_id:
         await callback.answer("❌ Нет invoice_id для проверки")
         return
     
     # Показываем "проверяем..."
     await callback.answer("🔍 Проверяем оплату...")
     
-    # РЕАЛЬНАЯ проверка статуса в CryptoBot
-    result = await cryptobot.check_invoice_status(invoice_id)
+    # РЕАЛЬНАЯ проверка статуса в CryptoBot (одновременные нажатия - одним запросом)
+    result = await invoices.status(order.invoice_id)
     
     if result["success"]:
         if result["status"] == "paid":
-            # ОПЛАТА ПРОШЛА!
-            db.update_order_status(order_id, "completed")
-            
-            # Уведомляем админа
-            for admin_id in ADMIN_IDS:
-                try:
-                    admin_message = (
-                        f"💎 **CryptoBot оплата ПОДТВЕРЖДЕНА**\n\n"
-                        f"🆔 Заказ: #{order_id}\n"
-                        f"💰 Сумма: {amount_rub:.2f} RUB\n"
-                        f"📦 Тип: {order_type}\n"
-                    )
-                    
-                    if order_type != "exchange":
-                        admin_message += f"👤 Получатель: {recipient}\n"
-                    
-                    admin_message += f"\n✅ Статус: ОПЛАЧЕНО"
-                    
-                    await bot.send_message(admin_id, admin_message)
-                except:
-                    pass
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"✅ **Оплата подтверждена!**\n\n"
-                    f"🆔 Ваш заказ: #{order_id}\n"
-                    f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
+            # ОПЛАТА ПРОШЛА! Завершаем, только если заказ еще ждет CryptoBot
+            if await complete_crypto_order(order_id, order.user_id, order.order_type, order.recipient, order.amount_rub):
+                # ОСТАЕМСЯ НА ТЕКУЩЕЙ СТРАНИЦЕ с сообщением об успехе
+                caption = (
+                    f"💎 **Оплата подтверждена!**\n\n"
+                    f"🆔 Заказ: #{order_id}\n"
+                    f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+                    f"✅ Статус: ОПЛАЧЕНО\n\n"
                     f"Товар будет отправлен в течение 15 минут - 3 часа!"
                 )
-            except:
-                pass
-            
-            # ОСТАЕМСЯ НА ТЕКУЩЕЙ СТРАНИЦЕ с сообщением об успехе
-            caption = (
-                f"💎 **Оплата подтверждена!**\n\n"
-                f"🆔 Заказ: #{order_id}\n"
-                f"💰 Сумма: {amount_rub:.2f} RUB\n"
-                f"✅ Статус: ОПЛАЧЕНО\n\n"
-                f"Товар будет отправлен в течение 15 минут - 3 часа!"
-            )
-            
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
-            ])
+            else:
+                order = await db.get_order(order_id)
+                if order.status == "completed":
+                    # Уже завершил поллер или вебхук - уведомления отправлены там
+                    caption = (
+                        f"✅ **Заказ #{order_id} уже оплачен**\n\n"
+                        f"Товар будет отправлен в течение 15 минут - 3 часа!"
+                    )
+                else:
+                    report_stray_crypto_payment(order, order.invoice_id)
+                    caption = (
+                        f"⚠️ **Счет оплачен, но заказ #{order_id} в статусе {order.status}**\n\n"
+                        f"Напишите администратору - проверим вручную."
+                    )
             
             await callback.message.edit_text(
                 text=caption,
-                reply_markup=keyboard,
+                reply_markup=BACK_TO_MAIN_KB,
                 parse_mode="Markdown"
             )
             
@@ -1055,16 +3216,12 @@ async def check_crypto_payment(callback: types.CallbackQuery):
             
         elif result["status"] == "expired":
             # Счет просрочен
-            db.update_order_status(order_id, "cancelled")
+            await db.update_order_status(order_id, "cancelled", from_status="waiting_crypto")
             
             caption = f"❌ **Счет просрочен!**\n\nЗаказ #{order_id} отменен."
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
-            ])
-            
             await callback.message.edit_text(
                 text=caption,
-                reply_markup=keyboard,
+                reply_markup=BACK_TO_MAIN_KB,
                 parse_mode="Markdown"
             )
             
@@ -1075,128 +3232,97 @@ async def check_crypto_payment(callback: types.CallbackQuery):
         )
 
 # ========== ПОДТВЕРЖДЕНИЕ ОПЛАТЫ КАРТОЙ ==========
-@dp.callback_query(F.data.startswith("confirm_paid_"))
-async def confirm_card_payment(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("confirm_paid_", ""))
-    order = db.get_order(order_id)
+@callback_route(PayCB, "paid")
+async def confirm_card_payment(callback: types.CallbackQuery, cb: PayCB, state: FSMContext):
+    order_id = cb.id
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
-    
     # Добавляем ожидание фото
-    user_states[callback.from_user.id] = {
-        "action": "waiting_payment_photo",
-        "order_id": order_id
-    }
+    await set_user_state(state, "waiting_payment_photo", order_id=order_id)
     
     # Для обмена валют показываем особое сообщение
-    if order_type == "exchange":
-        try:
-            details_dict = json.loads(details) if details else {}
-            amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-            
-            await callback.message.edit_text(
-                f"💱 **Обмен валют**\n\n"
-                f"🆔 Заказ: #{order_id}\n"
-                f"💸 Вы получаете: {amount_usd:.2f} USD\n"
-                f"💰 К оплате: {amount_rub:.2f} RUB\n\n"
-                "📸 **Пришлите фото/скриншот оплаты**\n\n"
-                "Пожалуйста, отправьте скриншот перевода.\n"
-                "После проверки админом USD будут отправлены вам в течение 15 минут - 3 часа.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"cancel_photo_{order_id}")]
-                ])
-            )
-            
-        except:
-            await callback.message.edit_text(
-                f"💱 **Обмен валют**\n\n"
-                f"🆔 Заказ: #{order_id}\n"
-                f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
-                "📸 **Пришлите фото/скриншот оплаты**\n\n"
-                "Пожалуйста, отправьте скриншот перевода.\n"
-                "После проверки админом USD будут отправлены вам в течение 15 минут - 3 часа.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"cancel_photo_{order_id}")]
-                ])
-            )
+    if order.order_type == "exchange":
+        await callback.message.edit_text(
+            f"💱 **Обмен валют**\n\n"
+            f"🆔 Заказ: #{order_id}\n"
+            f"💸 Вы получаете: {order.usd():.2f} USD\n"
+            f"💰 К оплате: {order.amount_rub:.2f} RUB\n\n"
+            "📸 **Пришлите фото/скриншот оплаты**\n\n"
+            "Пожалуйста, отправьте скриншот перевода.\n"
+            "После проверки админом USD будут отправлены вам в течение 15 минут - 3 часа.",
+            reply_markup=renderer.cancel_photo_kb(order_id)
+        )
     else:
         # Для звезд и премиума обычное сообщение
         await callback.message.edit_text(
             f"📸 **Пришлите фото/скриншот оплаты**\n\n"
             f"🆔 Заказ: #{order_id}\n"
-            f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
+            f"💰 Сумма: {order.amount_rub:.2f} RUB\n\n"
             "Пожалуйста, отправьте скриншот перевода или фото чека.\n"
             "После отправки фото заказ будет передан админу на проверку.\n"
             "Товар будет доставлен в течение 15 минут - 3 часа.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"cancel_photo_{order_id}")]
-            ])
+            reply_markup=renderer.cancel_photo_kb(order_id)
         )
     
     await callback.answer()
 
 # Обработчик отмены отправки фото
-@dp.callback_query(F.data.startswith("cancel_photo_"))
-async def cancel_photo_handler(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("cancel_photo_", ""))
-    
+@callback_route(PayCB, "cancel_photo")
+async def cancel_photo_handler(callback: types.CallbackQuery, cb: PayCB, state: FSMContext):
     # Удаляем состояние
-    if callback.from_user.id in user_states:
-        del user_states[callback.from_user.id]
+    await state.clear()
     
     # Возвращаем к оплате картой
-    await card_payment_handler(callback)
+    await card_payment_handler(callback, cb)
 
 # ========== КНОПКИ УПРАВЛЕНИЯ ЗАКАЗАМИ ==========
 # Подтверждение заказа
-@dp.callback_query(F.data.startswith("order_confirm_"))
-async def order_confirm_handler(callback: types.CallbackQuery):
+@callback_route(OrderCB, "confirm")
+async def order_confirm_handler(callback: types.CallbackQuery, cb: OrderCB):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("order_confirm_", ""))
-    db.update_order_status(order_id, "confirmed")
+    order_id = cb.id
+    await db.update_order_status(order_id, "confirmed")
     
     await callback.answer(f"✅ Заказ #{order_id} подтвержден!")
     await check_order_refresh(callback, order_id)
 
 # Отклонение заказа
-@dp.callback_query(F.data.startswith("order_reject_"))
-async def order_reject_handler(callback: types.CallbackQuery):
+@callback_route(OrderCB, "reject")
+async def order_reject_handler(callback: types.CallbackQuery, cb: OrderCB):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("order_reject_", ""))
-    db.update_order_status(order_id, "cancelled")
+    order_id = cb.id
+    await db.update_order_status(order_id, "cancelled")
     
     await callback.answer(f"❌ Заказ #{order_id} отклонен!")
     await callback.message.delete()
 
 # Выполнение заказа
-@dp.callback_query(F.data.startswith("order_complete_"))
-async def order_complete_handler(callback: types.CallbackQuery):
+@callback_route(OrderCB, "complete")
+async def order_complete_handler(callback: types.CallbackQuery, cb: OrderCB):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("order_complete_", ""))
-    order = db.get_order(order_id)
+    order_id = cb.id
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
-    
     # ДЛЯ CRYPTOBOT: проверяем оплату перед выполнением
-    if invoice_id and cryptobot and status == "waiting_crypto":
-        result = await cryptobot.check_invoice_status(invoice_id)
+    if order.invoice_id and cryptobot and order.status == "waiting_crypto":
+        result = await invoices.status(order.invoice_id)
         
         if not result["success"] or result["status"] != "paid":
             await callback.answer(
@@ -1206,85 +3332,85 @@ async def order_complete_handler(callback: types.CallbackQuery):
             return
     
     # Если оплата подтверждена или это карта - выполняем
-    db.update_order_status(order_id, "confirmed")
+    await db.update_order_status(order_id, "confirmed")
     
     # Уведомляем пользователя
     try:
         await bot.send_message(
-            user_id,
+            order.user_id,
             f"✅ Ваш заказ #{order_id} выполняется!\n"
             f"Товар будет отправлен в течение 15 минут - 3 часа."
         )
-    except:
-        pass
+    except Exception as e:
+        logger.warning(f"Уведомление о заказе #{order_id} пользователю {order.user_id} не доставлено: {e}")
     
     await callback.answer(f"📦 Заказ #{order_id} выполняется...")
     await check_order_refresh(callback, order_id)
 
 # Пометить как выполненный
-@dp.callback_query(F.data.startswith("order_finish_"))
-async def order_finish_handler(callback: types.CallbackQuery):
+@callback_route(OrderCB, "finish")
+async def order_finish_handler(callback: types.CallbackQuery, cb: OrderCB):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("order_finish_", ""))
-    db.update_order_status(order_id, "completed")
+    order_id = cb.id
+    await db.update_order_status(order_id, "completed")
     
     # Получаем данные заказа
-    order = db.get_order(order_id)
+    order = await db.get_order(order_id)
     if order:
-        user_id = order[0]
+        user_id = order.user_id
         try:
             await bot.send_message(
                 user_id,
                 f"🎉 Ваш заказ #{order_id} выполнен!\n"
                 f"Спасибо за покупку! 😊"
             )
-        except:
-            pass
+        except Exception as e:
+            logger.warning(f"Уведомление о заказе #{order_id} пользователю {user_id} не доставлено: {e}")
     
     await callback.answer(f"✅ Заказ #{order_id} помечен как выполненный!")
     await callback.message.delete()  # Удаляем сообщение с заказом
 
 # Отмена заказа
-@dp.callback_query(F.data.startswith("order_cancel_"))
-async def order_cancel_handler(callback: types.CallbackQuery):
+@callback_route(OrderCB, "cancel")
+async def order_cancel_handler(callback: types.CallbackQuery, cb: OrderCB):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("order_cancel_", ""))
-    db.update_order_status(order_id, "cancelled")
+    order_id = cb.id
+    await db.update_order_status(order_id, "cancelled")
     
     # Уведомляем пользователя
-    order = db.get_order(order_id)
+    order = await db.get_order(order_id)
     if order:
-        user_id = order[0]
+        user_id = order.user_id
         try:
             await bot.send_message(
                 user_id,
                 f"❌ Ваш заказ #{order_id} отменен.\n"
                 f"По вопросам обращайтесь в поддержку."
             )
-        except:
-            pass
+        except Exception as e:
+            logger.warning(f"Уведомление о заказе #{order_id} пользователю {user_id} не доставлено: {e}")
     
     await callback.answer(f"❌ Заказ #{order_id} отменен")
     await callback.message.delete()
 
 # Написать пользователю
-@dp.callback_query(F.data.startswith("order_msg_"))
-async def order_msg_handler(callback: types.CallbackQuery):
+@callback_route(OrderCB, "msg")
+async def order_msg_handler(callback: types.CallbackQuery, cb: OrderCB):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("order_msg_", ""))
-    order = db.get_order(order_id)
+    order_id = cb.id
+    order = await db.get_order(order_id)
     
     if order:
-        user_id = order[0]
+        user_id = order.user_id
         await callback.answer(f"👤 ID пользователя: {user_id}")
         await callback.message.answer(
             f"✏️ **Написать пользователю**\n\n"
@@ -1297,37 +3423,35 @@ async def order_msg_handler(callback: types.CallbackQuery):
         await callback.answer("❌ Заказ не найден")
 
 # Обновить информацию о заказе
-@dp.callback_query(F.data.startswith("order_refresh_"))
-async def order_refresh_handler(callback: types.CallbackQuery):
+@callback_route(OrderCB, "refresh")
+async def order_refresh_handler(callback: types.CallbackQuery, cb: OrderCB):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("order_refresh_", ""))
+    order_id = cb.id
     await check_order_refresh(callback, order_id)
 
 # Статус CryptoBot
-@dp.callback_query(F.data.startswith("crypto_status_"))
-async def crypto_status_handler(callback: types.CallbackQuery):
-    if not cryptobot:
+@callback_route(OrderCB, "crypto_status")
+async def crypto_status_handler(callback: types.CallbackQuery, cb: OrderCB):
+    if not crypto_available():
         await callback.answer("❌ CryptoBot временно недоступен")
         return
     
-    order_id = int(callback.data.replace("crypto_status_", ""))
-    order = db.get_order(order_id)
+    order_id = cb.id
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
-    
-    if not invoice_id:
+    if not order.invoice_id:
         await callback.answer("❌ Нет invoice_id")
         return
     
     # Проверяем статус
-    result = await cryptobot.check_invoice_status(invoice_id)
+    result = await invoices.status(order.invoice_id)
     
     if result["success"]:
         status_text = {
@@ -1339,7 +3463,7 @@ async def crypto_status_handler(callback: types.CallbackQuery):
         message = (
             f"💎 **Статус CryptoBot**\n\n"
             f"🆔 Заказ: #{order_id}\n"
-            f"💰 Сумма: {amount_rub:.2f} RUB\n"
+            f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
             f"📊 Статус: {status_text}\n"
         )
         
@@ -1354,24 +3478,22 @@ async def crypto_status_handler(callback: types.CallbackQuery):
 
 async def check_order_refresh(callback: types.CallbackQuery, order_id: int):
     """Обновить информацию о заказе"""
-    order = db.get_order(order_id)
+    order = await db.get_order(order_id)
     
     if order:
-        user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id = order
-        
         text = (
             f"🔍 **Заказ #{order_id}** (обновлено)\n\n"
-            f"👤 User ID: `{user_id}`\n"
-            f"📦 Тип: {order_type}\n"
+            f"👤 User ID: `{order.user_id}`\n"
+            f"📦 Тип: {order.order_type}\n"
         )
         
-        if order_type != "exchange" and recipient:
-            text += f"👤 Получатель: @{recipient}\n"
+        if order.order_type != "exchange" and order.recipient:
+            text += f"👤 Получатель: @{order.recipient}\n"
         
         text += (
-            f"💰 Сумма: {amount_rub:.2f} RUB\n"
-            f"💳 Метод: {payment_method}\n"
-            f"📊 Статус: {status}\n\n"
+            f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+            f"💳 Метод: {order.payment_method}\n"
+            f"📊 Статус: {order.status}\n\n"
             "✅ Статус обновлен!"
         )
         
@@ -1381,21 +3503,31 @@ async def check_order_refresh(callback: types.CallbackQuery, order_id: int):
         await callback.answer("❌ Заказ не найден")
 
 # ========== РАЗДЕЛЫ АДМИН ПАНЕЛИ ==========
-@dp.callback_query(F.data == "admin_orders")
-async def admin_orders_handler(callback: types.CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("❌ Доступ запрещен")
-        return
+# Фильтры браузера заказов: ключ в callback_data -> (статус, заголовок)
+ORDER_FILTERS = {
+    "all": (None, "📦 Все заказы"),
+    "pending": ("pending", "⏳ В ожидании"),
+    "waiting": ("waiting_payment", "💳 На оплате"),
+    "confirmation": ("waiting_confirmation", "📸 На проверке"),
+    "crypto": ("waiting_crypto", "💎 CryptoBot")
+}
+ORDERS_FILTER_CBS = {key: OrdersCB(action=key).pack() for key in ORDER_FILTERS}
+
+async def show_orders_page(callback: types.CallbackQuery, filter_key="all", before_id=None, after_id=None):
+    """Страница браузера заказов с фильтром и листанием"""
+    status, title = ORDER_FILTERS[filter_key]
+    orders, has_more = await db.get_orders_page(status, before_id=before_id, after_id=after_id)
     
-    orders = db.get_all_active_orders()
+    # Листали назад и дошли до начала - показываем первую страницу
+    if after_id is not None and not orders:
+        orders, has_more = await db.get_orders_page(status)
+        after_id = None
     
     if not orders:
-        text = "📦 **Все заказы**\n\nНет активных заказов"
+        text = f"**{title}**\n\nНет заказов"
     else:
-        text = "📦 **Все заказы**\n\n"
-        for order in orders[:10]:  # Показываем первые 10
-            order_id, user_id, order_type, recipient, amount_rub, payment_method, status, created_at = order
-            
+        text = f"**{title}**\n\n"
+        for order in orders:
             # Статусы в emoji
             status_emoji = {
                 'pending': '⏳',
@@ -1403,157 +3535,189 @@ async def admin_orders_handler(callback: types.CallbackQuery):
                 'waiting_confirmation': '📸',
                 'waiting_crypto': '💎',
                 'confirmed': '✅'
-            }.get(status, '❓')
+            }.get(order.status, '❓')
             
             # Форматируем дату
-            created_short = str(created_at)[:16] if created_at else "---"
+            created_short = str(order.created_at)[:16] if order.created_at else "---"
             
-            text += f"{status_emoji} **#{order_id}** | {order_type}\n"
-            text += f"👤 @{recipient if recipient else 'Нет'} | 💰 {amount_rub:.2f} RUB\n"
+            text += f"{status_emoji} **#{order.id}** | {order.order_type}\n"
+            text += f"👤 @{order.recipient if order.recipient else 'Нет'} | 💰 {order.amount_rub:.2f} RUB\n"
             text += f"📅 {created_short}\n"
-            text += f"🔍 /check_{order_id}\n\n"
+            text += f"🔍 /check_{order.id}\n\n"
+    
+    # Есть ли страницы новее / старше текущей
+    if after_id is not None:
+        has_newer, has_older = has_more, True
+    elif before_id is not None:
+        has_newer, has_older = True, has_more
+    else:
+        has_newer, has_older = False, has_more
+    
+    pager = []
+    if orders and has_newer:
+        pager.append(InlineKeyboardButton(text="◀️ Новее", callback_data=OrdersCB(action=filter_key, after=orders[0].id).pack()))
+    if orders and has_older:
+        pager.append(InlineKeyboardButton(text="Старше ▶️", callback_data=OrdersCB(action=filter_key, before=orders[-1].id).pack()))
     
     # Кнопки для управления
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_orders"),
-            InlineKeyboardButton(text="📦 Все", callback_data="orders_all")
+            InlineKeyboardButton(text="🔄 Обновить", callback_data=ORDERS_FILTER_CBS[filter_key]),
+            InlineKeyboardButton(text="📦 Все", callback_data=ORDERS_FILTER_CBS["all"])
         ],
         [
-            InlineKeyboardButton(text="⏳ В ожидании", callback_data="orders_pending"),
-            InlineKeyboardButton(text="💳 На оплате", callback_data="orders_waiting")
+            InlineKeyboardButton(text="⏳ В ожидании", callback_data=ORDERS_FILTER_CBS["pending"]),
+            InlineKeyboardButton(text="💳 На оплате", callback_data=ORDERS_FILTER_CBS["waiting"])
         ],
         [
-            InlineKeyboardButton(text="📸 На проверке", callback_data="orders_confirmation"),
-            InlineKeyboardButton(text="💎 CryptoBot", callback_data="orders_crypto")
+            InlineKeyboardButton(text="📸 На проверке", callback_data=ORDERS_FILTER_CBS["confirmation"]),
+            InlineKeyboardButton(text="💎 CryptoBot", callback_data=ORDERS_FILTER_CBS["crypto"])
         ],
         [
-            InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")
+            InlineKeyboardButton(text="🔙 Назад", callback_data=CB_ADMIN_BACK)
         ]
     ])
+    if pager:
+        keyboard.inline_keyboard.insert(0, pager)
     
-    await callback.message.edit_text(
-        text=text,
-        reply_markup=keyboard,
-        parse_mode="Markdown"
-    )
+    try:
+        await callback.message.edit_text(
+            text=text,
+            reply_markup=keyboard,
+            parse_mode="Markdown"
+        )
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_stats")
-async def admin_stats_handler(callback: types.CallbackQuery):
+@callback_route(AdminCB, "orders")
+async def admin_orders_handler(callback: types.CallbackQuery, cb: AdminCB):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("❌ Доступ запрещен")
+        return
+    
+    await show_orders_page(callback, "all")
+
+@callback_route(OrdersCB, *ORDER_FILTERS)
+async def orders_filter_handler(callback: types.CallbackQuery, cb: OrdersCB):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("❌ Доступ запрещен")
+        return
+    
+    await show_orders_page(callback, cb.action, before_id=cb.before, after_id=cb.after)
+
+BREAKER_STATES = {
+    "closed": "🟢 Crypto Pay на связи",
+    "open": "🔴 Crypto Pay недоступен",
+    "half_open": "🟡 Crypto Pay: пробный запрос"
+}
+
+@callback_route(AdminCB, "stats")
+async def admin_stats_handler(callback: types.CallbackQuery, cb: AdminCB):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    stats = db.get_statistics()
+    stats = await db.get_statistics()
+    fsm_stats = fsm_storage.stats()
+    render_stats = renderer.stats()
+    notify_stats = admin_notifier.stats()
+    send_stats = outbound.stats()
+    order_stats = db.order_cache.stats()
+    rate_stats = rates.stats()
+    invoice_stats = invoices.stats() if invoices else None
+    breaker_stats = cryptobot.breaker.stats() if cryptobot else None
     
     caption = (
         f"📊 **Статистика магазина**\n\n"
         f"👥 Пользователей: {stats['total_users']}\n"
         f"✅ Выполнено заказов: {stats['completed_orders']}\n"
         f"💰 Выручка: {stats['total_revenue']:.2f} RUB\n"
-        f"⏳ Ожидают проверки: {stats['pending_orders']}"
+        f"⏳ Ожидают проверки: {stats['pending_orders']}\n\n"
+        f"🧠 Состояния в памяти: {fsm_stats['entries']} "
+        f"(попаданий {fsm_stats['hit_rate']:.0%}, вытеснено {fsm_stats['evictions']})\n"
+        f"📦 Заказы в кэше: {order_stats['entries']} (попаданий {order_stats['hit_rate']:.0%}, "
+        f"промахов {order_stats['misses']})\n"
+        f"⌨️ Клавиатуры в кэше: {render_stats['entries']} (попаданий {render_stats['hit_rate']:.0%})\n"
+        f"📨 Уведомления админам: доставлено {notify_stats['sent']}, "
+        f"ошибок {notify_stats['failed']}, в очереди {notify_stats['pending']}\n"
+        f"📤 Отправка: очередь {send_stats['depth']}, p50 {send_stats['p50'] * 1000:.0f} мс, "
+        f"p99 {send_stats['p99'] * 1000:.0f} мс, флуд-пауз {send_stats['flood_waits']}, "
+        f"повторов {send_stats['retries']}, потеряно {send_stats['failed']}\n"
+        f"📉 Курсы ({rate_stats['source']}): USD {rate_stats['usd']}, звезда {rate_stats['star']}, "
+        + (f"обновлены {rate_stats['age']:.0f} с назад" if rate_stats['age'] is not None else "не обновлялись")
+        + (f", ошибок {rate_stats['errors']}" if rate_stats['errors'] else "")
+        + (f"\n💎 Счета CryptoBot: запросов {invoice_stats['api_calls']}, из кэша {invoice_stats['cache_hits']}, "
+           f"слито {invoice_stats['coalesced']}, выдано повторно {invoice_stats['reused']}; "
+           f"{BREAKER_STATES[breaker_stats['state']]}, отклонено {breaker_stats['rejected']}, "
+           f"повторов {cryptobot.retries}" if invoices else "")
     )
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-    ])
-    
     await callback.message.edit_text(
         text=caption,
-        reply_markup=keyboard,
+        reply_markup=ADMIN_STATS_KB,
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_pending")
-async def admin_pending_handler(callback: types.CallbackQuery):
+@callback_route(AdminCB, "pending")
+async def admin_pending_handler(callback: types.CallbackQuery, cb: AdminCB):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    orders = db.get_pending_orders()
-    
-    if not orders:
-        text = "⏳ Нет заказов, ожидающих проверки"
-    else:
-        text = "⏳ **Заказы, ожидающие проверки:**\n\n"
-        for order in orders:
-            order_id, user_id, order_type, recipient, amount_rub, payment_method, created_at = order
-            text += f"🆔 #{order_id} | {order_type} | {amount_rub:.2f} RUB\n"
-            text += f"👤 {recipient} | 💳 {payment_method}\n"
-            text += f"📅 {created_at}\n"
-            text += f"🔍 /check_{order_id}\n\n"
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_pending")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-    ])
-    
-    await callback.message.edit_text(
-        text=text,
-        reply_markup=keyboard,
-        parse_mode="Markdown"
-    )
-    await callback.answer()
+    await show_orders_page(callback, "pending")
 
-@dp.callback_query(F.data == "admin_completed")
-async def admin_completed_handler(callback: types.CallbackQuery):
+@callback_route(AdminCB, "completed")
+async def admin_completed_handler(callback: types.CallbackQuery, cb: AdminCB):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    orders = db.get_completed_orders()
+    orders = await db.get_completed_orders()
     
     if not orders:
         text = "✅ **Выполненные заказы**\n\nНет выполненных заказов"
     else:
         text = "✅ **Выполненные заказы**\n\n"
-        total_amount = sum(order[4] for order in orders)  # amount_rub
+        total_amount = sum(order.amount_rub for order in orders)
         
         for order in orders[:15]:  # Показываем 15 последних
-            order_id, user_id, order_type, recipient, amount_rub, payment_method, created_at = order
-            
             # Короткая дата
-            if isinstance(created_at, str):
-                created_short = created_at.split()[0]
+            if isinstance(order.created_at, str):
+                created_short = order.created_at.split()[0]
             else:
-                created_short = str(created_at)[:10]
+                created_short = str(order.created_at)[:10]
             
-            text += f"🆔 #{order_id} | {order_type} | {amount_rub:.2f} RUB\n"
+            text += f"🆔 #{order.id} | {order.order_type} | {order.amount_rub:.2f} RUB\n"
             
-            if order_type != "exchange":
-                text += f"👤 {recipient} | "
+            if order.order_type != "exchange":
+                text += f"👤 {order.recipient} | "
             
-            text += f"💳 {payment_method}\n"
+            text += f"💳 {order.payment_method}\n"
             text += f"📅 {created_short}\n"
-            text += f"🔍 /check_{order_id}\n\n"
+            text += f"🔍 /check_{order.id}\n\n"
         
         if len(orders) > 15:
             text += f"... и ещё {len(orders) - 15} заказов\n"
         
         text += f"\n📊 Всего: {len(orders)} заказов на {total_amount:.2f} RUB"
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_completed")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-    ])
-    
     await callback.message.edit_text(
         text=text,
-        reply_markup=keyboard,
+        reply_markup=ADMIN_COMPLETED_KB,
         parse_mode="Markdown"
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_back")
-async def admin_back_handler(callback: types.CallbackQuery):
+@callback_route(AdminCB, "back")
+async def admin_back_handler(callback: types.CallbackQuery, cb: AdminCB):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    stats = db.get_statistics()
+    stats = await db.get_statistics()
     
     caption = (
         f"🛠️ **Админ панель**\n\n"
@@ -1574,25 +3738,25 @@ async def admin_back_handler(callback: types.CallbackQuery):
 
 # ========== ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ (В САМОМ КОНЦЕ) ==========
 @dp.message(F.text)
-async def handle_text_messages(message: types.Message):
+async def handle_text_messages(message: types.Message, state: FSMContext):
     # Пропускаем команды (они начинаются с /)
     if message.text.startswith('/'):
         return
     
     # Проверяем, не ожидается ли фото
     user_id = message.from_user.id
-    if user_id in user_states and user_states[user_id].get("action") == "waiting_payment_photo":
+    action = await state.get_state()
+    if action == "waiting_payment_photo":
         await message.answer("📸 Пожалуйста, отправьте фото/скриншот оплаты")
         return
     
     text = message.text.strip()
     
-    if user_id not in user_states:
+    if action is None:
         await message.answer("Используйте меню", reply_markup=main_menu_kb())
         return
     
-    state = user_states[user_id]
-    action = state.get("action")
+    data = await state.get_data()
     
     if action == "waiting_stars_recipient":
         # ✅ РАЗРЕШАЕМ ВВОД С @
@@ -1605,13 +3769,13 @@ async def handle_text_messages(message: types.Message):
             await message.answer("❌ Введите username получателя (можно с @)")
             return
         
-        state["recipient"] = recipient
-        state["action"] = "waiting_stars_amount"
+        await state.update_data(recipient=recipient)
+        await state.set_state("waiting_stars_amount")
         
         await message.answer(
             f"✅ Получатель: @{recipient}\n\n"
             "Теперь введите количество звезд (от 50 до 1,000,000):",
-            reply_markup=back_kb("buy_stars")
+            reply_markup=back_kb(CB_BUY_STARS)
         )
     
     elif action == "waiting_stars_amount":
@@ -1622,29 +3786,19 @@ async def handle_text_messages(message: types.Message):
                 return
             
             amount_rub = stars * STAR_RATE
-            recipient = state.get("recipient", "")
+            recipient = data.get("recipient", "")
             
-            state["stars_amount"] = stars
-            state["amount_rub"] = amount_rub
+            await state.update_data(stars_amount=stars, amount_rub=amount_rub)
             
             # Создаем заказ
-            order_id = db.add_order(
+            order_id = await db.add_order(
                 user_id, "stars", recipient, 
-                json.dumps({"stars": stars}), 
+                {"stars": stars}, 
                 amount_rub, "card"
             )
             
-            # Создаем клавиатуру оплаты
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=f"card_pay_{order_id}")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="buy_stars")]
-            ])
-            
-            # Добавляем CryptoBot если есть токен
-            if cryptobot:
-                keyboard.inline_keyboard.insert(0, [
-                    InlineKeyboardButton(text="💎 CryptoBot", callback_data=f"crypto_pay_{order_id}")
-                ])
+            # Клавиатура оплаты (CryptoBot - если есть токен и Crypto Pay отвечает)
+            keyboard = renderer.payment_kb(order_id, CB_BUY_STARS, crypto=crypto_available())
             
             await message.answer(
                 f"✅ {stars} звезд для @{recipient}\n"
@@ -1663,30 +3817,21 @@ async def handle_text_messages(message: types.Message):
         if recipient.startswith('@'):
             recipient = recipient[1:]
             
-        period = state.get("period")
-        amount_rub = state.get("amount_rub")
+        period = data.get("period")
+        amount_rub = data.get("amount_rub")
         
         if period and amount_rub:
-            state["recipient"] = recipient
+            await state.update_data(recipient=recipient)
             
             # Создаем заказ
-            order_id = db.add_order(
+            order_id = await db.add_order(
                 user_id, "premium", recipient,
-                json.dumps({"period": period}),
+                {"period": period},
                 amount_rub, "card"
             )
             
-            # Создаем клавиатуру оплаты
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=f"card_pay_{order_id}")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="buy_premium")]
-            ])
-            
-            # Добавляем CryptoBot если есть токен
-            if cryptobot:
-                keyboard.inline_keyboard.insert(0, [
-                    InlineKeyboardButton(text="💎 CryptoBot", callback_data=f"crypto_pay_{order_id}")
-                ])
+            # Клавиатура оплаты (CryptoBot - если есть токен и Crypto Pay отвечает)
+            keyboard = renderer.payment_kb(order_id, CB_BUY_PREMIUM, crypto=crypto_available())
             
             await message.answer(
                 f"✅ {PREMIUM_PRICES[period]['name']} для @{recipient}\n"
@@ -1705,21 +3850,18 @@ async def handle_text_messages(message: types.Message):
             amount_usd = amount_rub / USD_RATE
             
             # Создаем заказ
-            order_id = db.add_order(
+            order_id = await db.add_order(
                 user_id, "exchange", "",
-                json.dumps({
+                {
                     "amount_rub": amount_rub, 
                     "amount_usd": amount_usd,
                     "exchange_rate": USD_RATE
-                }),
+                },
                 amount_rub, "card"  # Только карта!
             )
             
             # ✅ ДЛЯ ОБМЕНА ВАЛЮТ ТОЛЬКО КАРТА!
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💳 Оплатить картой", callback_data=f"card_pay_{order_id}")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="exchange")]
-            ])
+            keyboard = renderer.card_only_kb(order_id, CB_EXCHANGE)
             
             await message.answer(
                 f"✅ **Обмен валют**\n"
@@ -1734,7 +3876,484 @@ async def handle_text_messages(message: types.Message):
         except ValueError:
             await message.answer("❌ Пожалуйста, введите число")
 
+# ========== ФОНОВАЯ ПРОВЕРКА CRYPTOBOT ==========
+# Будит поллер, когда выставлен новый счет
+crypto_poll_wakeup = asyncio.Event()
+
+async def poll_crypto_invoices():
+    """Один проход: проверить все waiting_crypto заказы пачками (и счета недавних
+    заказов, ушедших из waiting_crypto - их оплату докладываем админам).
+    Возвращает (ожидающих заказов, изменённых заказов)"""
+    orders = await db.get_waiting_crypto_orders()
+    strays = [o for o in await db.get_stray_crypto_orders() if str(o.invoice_id) not in stray_crypto_done]
+    if not orders and not strays:
+        return 0, 0
+    
+    by_invoice = {str(order.invoice_id): order for order in strays}
+    by_invoice.update((str(order.invoice_id), order) for order in orders)
+    result = await cryptobot.get_invoices(list(by_invoice))
+    
+    if not result["success"]:
+        raise RuntimeError(result["error"])
+    
+    paid, expired = [], []
+    for invoice_id, invoice in result["items"].items():
+        invoices.remember(invoice_id, invoice)
+        order = by_invoice.get(invoice_id)
+        if not order:
+            continue
+        if order.status != "waiting_crypto":
+            if invoice["status"] == "paid":
+                report_stray_crypto_payment(order, invoice_id)
+            elif invoice["status"] == "expired":
+                stray_crypto_done.add(invoice_id)
+            continue
+        if invoice["status"] == "paid":
+            paid.append(order)
+        elif invoice["status"] == "expired":
+            expired.append(order)
+    
+    # Переходы статусов - одной транзакцией на каждый статус
+    paid_ids = set(await db.update_orders_status([o.id for o in paid], "completed", from_status="waiting_crypto"))
+    expired_ids = set(await db.update_orders_status([o.id for o in expired], "cancelled", from_status="waiting_crypto"))
+    
+    notifications = [
+        notify_crypto_paid(o.id, o.user_id, o.order_type, o.recipient, o.amount_rub)
+        for o in paid
+        if o.id in paid_ids
+    ]
+    notifications += [
+        notify_crypto_expired(o.id, o.user_id)
+        for o in expired
+        if o.id in expired_ids
+    ]
+    await asyncio.gather(*notifications)
+    
+    return len(orders), len(paid_ids) + len(expired_ids)
+
+async def crypto_invoice_poller(min_interval=CRYPTO_POLL_MIN):
+    """Фоновая задача: авто-подтверждение CryptoBot оплат с адаптивным интервалом"""
+    send_priority.set(PRIORITY_NOTIFY)
+    interval = min_interval
+    
+    while True:
+        crypto_poll_wakeup.clear()
+        try:
+            waiting, changed = await poll_crypto_invoices()
+            
+            if not waiting:
+                interval = CRYPTO_POLL_MAX
+            elif changed:
+                interval = min_interval
+            else:
+                interval = min(interval * 1.5, CRYPTO_POLL_MAX)
+            
+            if changed:
+                logger.info(f"CryptoBot poller: {changed} из {waiting} заказов обновлено")
+        
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"CryptoBot poller: ошибка проверки счетов: {e}")
+            interval = min(interval * 2, CRYPTO_POLL_MAX)
+        
+        try:
+            await asyncio.wait_for(crypto_poll_wakeup.wait(), interval)
+            # Выставлен новый счет - возвращаемся к частой проверке
+            interval = min_interval
+            await asyncio.sleep(interval)
+        except asyncio.TimeoutError:
+            pass
+
+# ========== ВЕБХУК CRYPTOBOT ==========
+def check_crypto_signature(body, signature):
+    """Подпись Crypto Pay: HMAC-SHA256 тела, ключ - SHA256 от токена"""
+    secret = hashlib.sha256(CRYPTOBOT_TOKEN.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+async def crypto_webhook_handler(request):
+    """Приём invoice_paid от Crypto Pay. Дубли доставки безопасны"""
+    body = await request.read()
+    
+    if not check_crypto_signature(body, request.headers.get("crypto-pay-api-signature")):
+        logger.warning("CryptoBot webhook: неверная подпись")
+        return web.Response(status=401)
+    
+    try:
+        update = json.loads(body)
+    except ValueError:
+        return web.Response(status=400)
+    
+    if update.get("update_type") == "invoice_paid":
+        invoice = update.get("payload") or {}
+        order = await db.get_order_by_invoice(invoice.get("invoice_id"))
+        if invoices and invoice.get("invoice_id"):
+            invoices.remember(invoice["invoice_id"], {
+                "status": "paid",
+                "paid_at": invoice.get("paid_at"),
+                "amount": invoice.get("amount"),
+                "pay_url": invoice.get("pay_url") or invoice.get("bot_invoice_url")
+            })
+        
+        if order and not await complete_crypto_order(
+            order.id, order.user_id, order.order_type, order.recipient, order.amount_rub
+        ):
+            # Не из waiting_crypto: либо уже завершен (дубль доставки), либо деньги пришли мимо заказа
+            order = await db.get_order(order.id)
+            if order.status != "completed":
+                report_stray_crypto_payment(order, invoice.get("invoice_id"))
+        elif not order:
+            logger.warning(f"CryptoBot webhook: заказ для invoice {invoice.get('invoice_id')} не найден")
+    
+    return web.json_response({"ok": True})
+
+def setup_crypto_webhook(app):
+    """Подключить вебхук CryptoBot к aiohttp приложению"""
+    app.router.add_post(CRYPTO_WEBHOOK_PATH, crypto_webhook_handler)
+
+async def start_crypto_webhook():
+    """Поднять HTTP сервер для вебхука CryptoBot"""
+    app = web.Application()
+    setup_crypto_webhook(app)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, CRYPTO_WEBHOOK_HOST, CRYPTO_WEBHOOK_PORT).start()
+    
+    logger.info(f"CryptoBot webhook: {CRYPTO_WEBHOOK_HOST}:{CRYPTO_WEBHOOK_PORT}{CRYPTO_WEBHOOK_PATH}")
+    return runner
+
+# ========== КЛАСТЕР (НЕСКОЛЬКО ВОРКЕРОВ) ==========
+class HashRing:
+    """Консистентное хеширование: user_id -> воркер. При падении воркера
+    переезжают только его пользователи"""
+    
+    def __init__(self, nodes, replicas=100):
+        self.ring = sorted(
+            (self._hash(f"worker-{node}#{replica}"), node)
+            for node in nodes for replica in range(replicas)
+        )
+        self.keys = [key for key, _ in self.ring]
+        self.node_count = len(set(nodes))
+    
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], "big")
+    
+    def nodes_for(self, key):
+        """Воркеры в порядке обхода кольца, начиная с владельца ключа"""
+        start = bisect.bisect(self.keys, self._hash(key)) % len(self.ring)
+        seen = []
+        for i in range(len(self.ring)):
+            node = self.ring[(start + i) % len(self.ring)][1]
+            if node not in seen:
+                seen.append(node)
+                if len(seen) == self.node_count:
+                    break  # все воркеры уже есть - остаток кольца не нужен
+        return seen
+
+def update_routing_key(update):
+    """user_id отправителя апдейта (или чат), чтобы диалог шел через один воркер"""
+    for name, event in update.items():
+        if name == "update_id" or not isinstance(event, dict):
+            continue
+        for field in ("from", "user"):
+            if isinstance(event.get(field), dict) and "id" in event[field]:
+                return event[field]["id"]
+        for field in ("chat", "message"):
+            if isinstance(event.get(field), dict):
+                chat = event[field].get("chat", event[field])
+                if "id" in chat:
+                    return chat["id"]
+    return update.get("update_id", 0)
+
+async def wait_for_shutdown(parent_pid=None):
+    """Ждать SIGTERM/SIGINT (или смерти родительского процесса)"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    
+    while not stop.is_set():
+        if parent_pid and os.getppid() != parent_pid:
+            logger.warning("Родительский процесс завершился - останавливаюсь")
+            break
+        try:
+            await asyncio.wait_for(stop.wait(), 1)
+        except asyncio.TimeoutError:
+            pass
+
+def worker_process(index, parent_pid):
+    """Точка входа процесса-воркера (spawn: модуль импортируется заново)"""
+    asyncio.run(run_worker(index, parent_pid))
+
+async def run_worker(index, parent_pid=None):
+    """Воркер: принимает апдейты от фронта, общие данные - через SQLite"""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path="/update")
+    setup_application(app, dp, bot=bot)
+    
+    async def health(request):
+        return web.json_response({"ok": True, "worker": index, "pid": os.getpid()})
+    app.router.add_get("/health", health)
+    
+    if cryptobot and CRYPTO_WEBHOOK_PORT:
+        setup_crypto_webhook(app)
+    
+    # Фоновые задачи CryptoBot - только в одном воркере
+    background = await start_background(
+        crypto=index == 0,
+        metrics_port=METRICS_PORT + 1 + index if METRICS_PORT else 0
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", WORKER_BASE_PORT + index).start()
+    logger.info(f"Воркер {index} (pid {os.getpid()}): 127.0.0.1:{WORKER_BASE_PORT + index}")
+    
+    try:
+        await wait_for_shutdown(parent_pid)
+    finally:
+        await runner.cleanup()
+        await stop_background(background)
+
+class ClusterFront:
+    """Фронт кластера: принимает вебхук Telegram и раздает апдейты воркерам,
+    следит за их здоровьем и перезапускает упавших"""
+    
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.ring = HashRing(range(workers))
+        self.processes = {}
+        self.started_at = {}
+        self.healthy = set()
+        self.failures = {}
+        self.context = multiprocessing.get_context("spawn")
+        self.session = None
+    
+    def start_worker(self, index):
+        process = self.context.Process(target=worker_process, args=(index, os.getpid()),
+                                       name=f"worker-{index}", daemon=True)
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        self.failures[index] = 0
+        self.healthy.discard(index)
+        logger.info(f"Кластер: воркер {index} запущен (pid {process.pid})")
+    
+    async def restart_worker(self, index):
+        process = self.processes.get(index)
+        if process and process.is_alive():
+            process.terminate()
+            await asyncio.to_thread(process.join, 5)
+        logger.warning(f"Кластер: перезапуск воркера {index}")
+        self.start_worker(index)
+    
+    async def check_health(self):
+        for index in range(self.workers):
+            process = self.processes[index]
+            if not process.is_alive():
+                await self.restart_worker(index)
+                continue
+            
+            try:
+                url = f"http://127.0.0.1:{WORKER_BASE_PORT + index}/health"
+                async with self.session.get(url, timeout=aiohttp.ClientTimeout(total=2)) as response:
+                    ok = response.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                ok = False
+            
+            if ok:
+                self.healthy.add(index)
+                self.failures[index] = 0
+            elif time.monotonic() - self.started_at[index] < WORKER_START_TIMEOUT and index not in self.healthy:
+                continue  # ещё запускается
+            else:
+                self.healthy.discard(index)
+                self.failures[index] += 1
+                # Не ответил 3 раза подряд (после старта) - перезапускаем
+                if self.failures[index] >= 3:
+                    await self.restart_worker(index)
+    
+    async def health_loop(self):
+        while True:
+            try:
+                await self.check_health()
+            except Exception as e:
+                logger.warning(f"Кластер: ошибка проверки воркеров: {e}")
+            await asyncio.sleep(WORKER_HEALTH_INTERVAL)
+    
+    async def forward(self, index, path, body, headers=None):
+        url = f"http://127.0.0.1:{WORKER_BASE_PORT + index}{path}"
+        async with self.session.post(url, data=body, headers=headers) as response:
+            return response.status
+    
+    async def route(self, key, path, body, headers=None):
+        """Отправить воркеру-владельцу ключа, при недоступности - следующему по кольцу"""
+        return await self.route_to(self.ring.nodes_for(key), path, body, headers)
+    
+    async def route_to(self, nodes, path, body, headers=None):
+        """Отправить первому ответившему воркеру из nodes"""
+        # Сначала живые воркеры (порядок сохраняется), остальные - на крайний случай
+        nodes = sorted(nodes, key=lambda index: index not in self.healthy)
+        for index in nodes:
+            try:
+                status = await self.forward(index, path, body, headers)
+                if status < 500:
+                    return status
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self.healthy.discard(index)
+        return 503
+    
+    async def telegram_handler(self, request):
+        if not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+            return web.Response(status=401)
+        
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        
+        status = await self.route(update_routing_key(update), "/update", body,
+                                  {"Content-Type": "application/json"})
+        return web.Response(status=200 if status < 500 else status)
+    
+    async def crypto_handler(self, request):
+        body = await request.read()
+        headers = {
+            "Content-Type": "application/json",
+            "crypto-pay-api-signature": request.headers.get("crypto-pay-api-signature", "")
+        }
+        # Проверкой и обработкой занимается воркер 0 (там же поллер CryptoBot), если он жив - следующий
+        return web.Response(status=await self.route_to(range(self.workers), CRYPTO_WEBHOOK_PATH, body, headers))
+    
+    async def run(self):
+        for index in range(self.workers):
+            self.start_worker(index)
+        
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=60)
+        )
+        
+        # Ждем запуска воркеров, прежде чем принимать апдейты
+        deadline = time.monotonic() + WORKER_START_TIMEOUT
+        while len(self.healthy) < self.workers and time.monotonic() < deadline:
+            await self.check_health()
+            await asyncio.sleep(0.5)
+        
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.telegram_handler)
+        if cryptobot and CRYPTO_WEBHOOK_PORT == WEBHOOK_PORT:
+            app.router.add_post(CRYPTO_WEBHOOK_PATH, self.crypto_handler)
+        
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        logger.info(f"Кластер: фронт {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, воркеров: {self.workers}")
+        
+        health_task = asyncio.create_task(self.health_loop())
+        
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+        
+        try:
+            await wait_for_shutdown()
+        finally:
+            health_task.cancel()
+            if WEBHOOK_URL:
+                await bot.delete_webhook()
+            await runner.cleanup()
+            await self.session.close()
+            for process in self.processes.values():
+                process.terminate()
+            for process in self.processes.values():
+                process.join(10)
+
 # ========== ЗАПУСК БОТА ==========
+async def run_webhook():
+    """Приём обновлений Telegram через вебхук (за reverse proxy)"""
+    app = web.Application()
+    
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    
+    # Вебхук CryptoBot на том же порту - на том же сервере
+    if cryptobot and CRYPTO_WEBHOOK_PORT == WEBHOOK_PORT:
+        setup_crypto_webhook(app)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Telegram webhook: {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+    
+    try:
+        # SIGTERM (остановка сервиса) - штатный выход через finally, как и Ctrl+C
+        await wait_for_shutdown()
+    finally:
+        if WEBHOOK_URL:
+            await bot.delete_webhook()
+        await runner.cleanup()
+
+async def start_background(crypto=True, metrics_port=None):
+    """Фоновые задачи бота (и серверы вебхука CryptoBot и /metrics на отдельных портах)"""
+    background = {"tasks": [asyncio.create_task(fsm_cleanup_loop(fsm_storage))], "runners": []}
+    
+    metrics_port = METRICS_PORT if metrics_port is None else metrics_port
+    if metrics_port:
+        try:
+            background["runners"].append(await start_metrics_server(metrics_port))
+        except OSError as e:
+            # Метрики не повод не запускать бота
+            logger.warning(f"Метрики: порт {metrics_port} недоступен ({e}) - работаем без /metrics")
+    
+    # Курсы - в каждом процессе. Первое обновление ждем (не дольше RATES_TIMEOUT), дальше - в фоне
+    await rates.refresh()
+    background["tasks"].append(asyncio.create_task(rates.run()))
+    
+    if crypto:
+        # Только в одном процессе кластера (вместе с поллером CryptoBot)
+        background["tasks"].append(asyncio.create_task(broadcast_watchdog()))
+    
+    if cryptobot and crypto:
+        if CRYPTO_WEBHOOK_PORT:
+            if not (BOT_MODE in ("webhook", "cluster") and CRYPTO_WEBHOOK_PORT == WEBHOOK_PORT):
+                background["runners"].append(await start_crypto_webhook())
+            # С вебхуком поллер остается только страховкой
+            background["tasks"].append(asyncio.create_task(crypto_invoice_poller(min_interval=CRYPTO_POLL_MAX)))
+        else:
+            background["tasks"].append(asyncio.create_task(crypto_invoice_poller()))
+    
+    return background
+
+async def stop_background(background):
+    """Остановить фоновые задачи и закрыть соединения"""
+    for task in list(background["tasks"]) + list(broadcast_tasks.values()):
+        task.cancel()
+    await admin_notifier.drain()
+    for runner in background["runners"]:
+        await runner.cleanup()
+    if cryptobot:
+        await cryptobot.close()
+    await db.close()
+    await bot.session.close()
+
 async def main():
     print("=" * 50)
     print("🚀 Digi Store Bot запускается...")
@@ -1745,12 +4364,24 @@ async def main():
         print("ℹ️  Установите переменную окружения BOT_TOKEN")
         exit(1)
     
+    if BOT_MODE in ("webhook", "cluster") and not WEBHOOK_SECRET:
+        # Без секрета любой, кто достучится до порта, пришлет апдейт "от админа"
+        print(f"❌ ОШИБКА: для режима {BOT_MODE} нужен WEBHOOK_SECRET!")
+        print("ℹ️  Задайте WEBHOOK_SECRET (1-256 символов: A-Z, a-z, 0-9, _ и -)")
+        exit(1)
+    
     print(f"🤖 Бот: ✅ Настроен")
+    print(f"📡 Режим: {BOT_MODE}" + (f" ({WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH})" if BOT_MODE in ("webhook", "cluster") else ""))
+    if BOT_MODE == "cluster":
+        print(f"🧩 Воркеров: {WORKERS} (порты {WORKER_BASE_PORT}-{WORKER_BASE_PORT + WORKERS - 1})")
     print(f"👑 Админ ID: {ADMIN_IDS}")
     print(f"💎 CryptoBot: {'✅ Настроен' if CRYPTOBOT_TOKEN else '❌ Нет токена'}")
+    print(f"🔔 CryptoBot webhook: {'✅ порт ' + str(CRYPTO_WEBHOOK_PORT) if CRYPTO_WEBHOOK_PORT else '❌ Выключен'}")
+    print(f"📈 Метрики: {f'✅ http://{METRICS_HOST}:{METRICS_PORT}/metrics' if METRICS_PORT else '❌ Выключены'}")
     print(f"💳 Карта: {CARD_NUMBER}")
     print(f"⭐️ Курс звезд: 1 звезда = {STAR_RATE} RUB")
     print(f"💱 Курс обмена: 1 USD = {USD_RATE} RUB")
+    print(f"📉 Источник курсов: {rates.source.name}, обновление раз в {RATES_TTL:.0f} с")
     print("=" * 50)
     print("✅ Все команды готовы к работе!")
     print("📋 Поддерживаемые команды:")
@@ -1761,16 +4392,34 @@ async def main():
     print(f"👉 /confirm_11 или /confirm 11 - подтвердить заказ")
     print(f"👉 /complete_11 или /complete 11 - выполнить заказ")
     print(f"👉 /cancel_11 или /cancel 11 - отменить заказ")
+    print("👉 /recount - сверить счетчики статистики")
+    print("👉 /broadcast текст - рассылка всем пользователям")
     print("=" * 50)
     print("ℹ️  Старые форматы (/check_11) и новые (/check 11) работают одновременно!")
     print("=" * 50)
     
+    if BOT_MODE == "cluster":
+        # Фронт сам апдейты не обрабатывает - только раздает воркерам
+        try:
+            await ClusterFront().run()
+        except Exception as e:
+            print(f"❌ Ошибка: {e}")
+        finally:
+            await db.close()
+            await bot.session.close()
+        return
+    
+    background = await start_background()
+    
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
     except Exception as e:
         print(f"❌ Ошибка: {e}")
     finally:
-        await bot.session.close()
+        await stop_background(background)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file